@@ -0,0 +1,232 @@
+"""
+Apply a gradient from an Adobe .grd file to large arrays of scalars, eg
+multi-gigapixel rasters, producing uint8 RGB(A) images.
+
+Values are mapped through a precomputed lookup table (see
+GrdReader.grd_to_lut), in fixed-size chunks spread over a pool of threads
+(NumPy releases the GIL while indexing), straight into an output array that
+the caller may provide, eg a memory-mapped file. Apart from the output, no
+full-size arrays are allocated: each thread reuses scratch buffers of one
+chunk in size.
+"""
+import argparse, multiprocessing, sys, threading, timeit
+
+import numpy as np
+from concurrent import futures
+
+import grd_reader
+
+DEFAULT_LUT_SIZE = 4096
+DEFAULT_CHUNK_SIZE = 1 << 18  # Values per chunk
+
+
+def command_line():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filename",
+                        help="Path to an Adobe .grd file")
+    parser.add_argument("values",
+                        help="NumPy .npy file of scalars, eg a raster")
+    parser.add_argument("out",
+                        help="NumPy .npy file to write uint8 colors to")
+    parser.add_argument("--name", default=None,
+                        help="Name of the gradient to apply (default: the first)")
+    parser.add_argument("--vmin", type=float, default=None,
+                        help="Value mapped to the start of the gradient "
+                             "(default: the minimum of the values)")
+    parser.add_argument("--vmax", type=float, default=None,
+                        help="Value mapped to the end of the gradient "
+                             "(default: the maximum of the values)")
+    parser.add_argument("--size", type=int, default=DEFAULT_LUT_SIZE,
+                        help="Number of entries in the lookup table")
+    parser.add_argument("--alpha", action="store_true",
+                        help="Write RGBA rather than RGB colors")
+    parser.add_argument("--engine", choices=grd_reader.COLOR_ENGINES,
+                        default="chroma",
+                        help="Color conversion engine (numpy is vectorized)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="Number of values mapped at a time by each thread")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of threads (default: one per CPU)")
+
+    return parser.parse_args()
+
+
+def gradient_lut(grd, name=None, size=DEFAULT_LUT_SIZE, alpha=False):
+    """
+    Lookup table of the named gradient (or the first) of an open GrdReader,
+    as a (size, 3 or 4) uint8 array
+    """
+    for gradient_name, gradient in grd.iter_gradients():
+        if name is None or gradient_name == name:
+            return grd.grd_to_lut(gradient, size, alpha)
+    raise KeyError(name)
+
+
+def value_range(values, chunk_size=DEFAULT_CHUNK_SIZE):
+    """(min, max) of an array ignoring NaNs, a chunk of rows at a time"""
+    values = np.asanyarray(values)
+    if values.ndim == 0:
+        values = values.reshape(1)
+    rows = max(1, chunk_size // max(1, values[:1].size))
+    low, high = np.inf, -np.inf
+    for start in range(0, len(values), rows):
+        chunk = values[start:start + rows]
+        if chunk.dtype.kind == "f":
+            chunk = chunk[~np.isnan(chunk)]
+        if chunk.size:
+            low, high = min(low, chunk.min()), max(high, chunk.max())
+    return float(low), float(high)
+
+
+class _Scratch(threading.local):
+    """Per-thread buffers, grown to the largest chunk seen"""
+    def buffers(self, n, dtype):
+        if getattr(self, "size", 0) < n or self.positions.dtype != dtype:
+            self.positions = np.empty(n, dtype=dtype)
+            self.indices = np.empty(n, dtype=np.intp)
+            self.size = n
+        return self.positions[:n], self.indices[:n]
+
+
+def _position_dtype(values):
+    """
+    Float type that values are normalised in: as matplotlib's Normalize,
+    float32 for float32 values and small integers, else float64
+    """
+    return np.promote_types(values.dtype, np.float32)
+
+
+def _apply_chunk(values, lut, out, vmin, vmax, bad, scratch):
+    """
+    Map one chunk of values to colors, in place in out. RGBA entries are
+    copied as single 32-bit words when out is contiguous, which is much
+    faster.
+    """
+    positions, indices = scratch.buffers(values.size, _position_dtype(values))
+    positions = positions.reshape(values.shape)
+    indices = indices.reshape(values.shape)
+
+    # LUT entry as a matplotlib colormap of len(lut) entries picks it: the
+    #  value normalised to 0..1, times the size, rounded down and clipped
+    np.subtract(values, vmin, out=positions, casting="unsafe")
+    np.divide(positions, vmax - vmin, out=positions)
+    np.multiply(positions, len(lut), out=positions)
+    np.clip(positions, 0., len(lut) - 1, out=positions)
+    np.copyto(indices, positions, casting="unsafe")
+    if lut.shape[1] == 4 and out.flags.c_contiguous:
+        np.take(lut.view(np.uint32)[:, 0], indices,
+                out=out.view(np.uint32)[..., 0], mode="clip")
+    else:
+        np.take(lut, indices, axis=0, out=out, mode="clip")
+
+    if bad is not None and values.dtype.kind == "f":
+        missing = np.isnan(values)
+        if missing.any():
+            out[missing] = bad
+
+
+def apply_colormap(values, lut, out=None, vmin=0., vmax=1., bad=None,
+                   chunk_size=DEFAULT_CHUNK_SIZE, workers=None, executor=None):
+    """
+    Map an array of scalars to colors through a lookup table, choosing
+    entries as a matplotlib colormap with len(lut) entries does. Colors
+    match those of the gradient's matplotlib colormap (GrdReader.grd_to_cmap,
+    with N=len(lut) and bytes=True) to within 1, as lookup tables are
+    rounded where matplotlib truncates.
+    values: Array of any shape (eg a np.memmap); vmin and vmax map to the
+        first and last entries of lut, values outside are clipped
+    lut: (size, channels) uint8 array, eg from gradient_lut
+    out: Array of shape values.shape + (channels,) and dtype uint8 to write
+        the colors to (eg a np.memmap). Allocated if not given.
+    bad: Color for NaN values (default: all zeros, ie black, or transparent
+        with an alpha channel)
+    chunk_size: Approximate number of values mapped at a time per thread;
+        chunks are whole rows of the first axis
+    workers: Number of threads, if no executor is given (default: one per CPU)
+    executor: concurrent.futures executor to run chunks on, to reuse threads
+        between calls
+    Returns out
+    """
+    lut = np.ascontiguousarray(lut, dtype=np.uint8)
+    if lut.ndim != 2 or not len(lut):
+        raise ValueError("lut must be a (size, channels) array")
+    values = np.asanyarray(values)
+    shape = values.shape + lut.shape[1:]
+    if out is None:
+        out = np.empty(shape, dtype=np.uint8)
+    elif out.shape != shape or out.dtype != np.uint8:
+        raise ValueError("out must be a uint8 array of shape {0}".format(shape))
+    if bad is None:
+        bad = np.zeros(lut.shape[1], dtype=np.uint8)
+    if vmax == vmin:
+        vmax = vmin + 1.
+
+    if values.ndim == 0:
+        _apply_chunk(values.reshape(1), lut, out.reshape(1, -1), vmin, vmax,
+                     bad, _Scratch())
+        return out
+
+    row_size = max(1, values[:1].size)
+    rows = max(1, chunk_size // row_size)
+    chunks = [(start, min(start + rows, len(values)))
+              for start in range(0, len(values), rows)]
+    scratch = _Scratch()
+
+    def apply(chunk):
+        start, stop = chunk
+        _apply_chunk(values[start:stop], lut, out[start:stop], vmin, vmax,
+                     bad, scratch)
+
+    if executor is None and (workers == 1 or len(chunks) == 1):
+        for chunk in chunks:
+            apply(chunk)
+        return out
+
+    own_executor = executor is None
+    if own_executor:
+        executor = futures.ThreadPoolExecutor(
+            max_workers=workers or multiprocessing.cpu_count())
+    try:
+        for result in [executor.submit(apply, chunk) for chunk in chunks]:
+            result.result()  # Raises the first error, if any
+    finally:
+        if own_executor:
+            executor.shutdown()
+    return out
+
+
+if __name__ == "__main__":
+    parsed_args = command_line()
+    try:
+        grd = grd_reader.GrdReader(parsed_args.filename, parsed_args.engine)
+    except IOError:
+        print("File not found")
+        sys.exit(1)
+
+    with grd:
+        try:
+            lut = gradient_lut(grd, parsed_args.name and parsed_args.name.decode("utf-8"),
+                               parsed_args.size, parsed_args.alpha)
+        except KeyError:
+            print("No gradient named {0}".format(parsed_args.name))
+            sys.exit(1)
+        except grd_reader.GrdFormatError as e:
+            print("Error occurred while reading file: {0}".format(e))
+            sys.exit(1)
+
+    values = np.load(parsed_args.values, mmap_mode="r")
+    vmin, vmax = parsed_args.vmin, parsed_args.vmax
+    if vmin is None or vmax is None:
+        low, high = value_range(values, parsed_args.chunk_size)
+        vmin = low if vmin is None else vmin
+        vmax = high if vmax is None else vmax
+
+    out = np.lib.format.open_memmap(parsed_args.out, mode="w+", dtype=np.uint8,
+                                    shape=values.shape + lut.shape[1:])
+    started = timeit.default_timer()
+    apply_colormap(values, lut, out, vmin, vmax,
+                   chunk_size=parsed_args.chunk_size, workers=parsed_args.workers)
+    out.flush()
+    elapsed = max(timeit.default_timer() - started, 1e-9)
+    print("Mapped {0} values in {1:.2f} s ({2:.1f} million/s)".format(
+        values.size, elapsed, values.size / elapsed / 1e6))
@@ -0,0 +1,489 @@
+"""
+Convert many Adobe gradient files (.grd) at once, spreading files over a
+pool of worker processes. Writes matplotlib (.py), JS (.js), binary (.grdb)
+and/or lookup table (.npz) output next to each input file, or into a
+separate output directory.
+
+With --pipeline, reading inputs, converting them (on the worker processes)
+and writing outputs run as overlapping stages (see grd_pipeline), which
+keeps the CPU busy while files are read from or written to slow storage.
+"""
+import argparse, collections, multiprocessing, os, sys, threading, time
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from concurrent import futures
+
+import binary_converter, build_manifest, grd_cache, grd_convert, grd_pipeline, grd_reader, jsgradient_converter, lut_converter, matplotlib_converter
+
+# Output format name: (converter module, output file extension)
+CONVERTERS = {"matplotlib": (matplotlib_converter, ".py"),
+              "js": (jsgradient_converter, ".js"),
+              "binary": (binary_converter, ".grdb")}
+if grd_reader.have_numpy():  # Lookup tables need NumPy
+    CONVERTERS["lut"] = (lut_converter, ".npz")
+
+
+def command_line():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="+",
+                        help="Adobe .grd files, directories or glob patterns")
+    parser.add_argument("--format", dest="formats", action="append",
+                        choices=sorted(CONVERTERS),
+                        help="Output format; may be repeated "
+                             "(default: matplotlib)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of worker processes (default: one per CPU)")
+    parser.add_argument("--engine", choices=grd_reader.COLOR_ENGINES,
+                        default="chroma",
+                        help="Color conversion engine (numpy is vectorized)")
+    parser.add_argument("--out-dir", default=None,
+                        help="Directory for output files, in which the "
+                             "layout of input directories is kept "
+                             "(default: alongside input)")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Reuse parsed results cached in this directory")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only convert files whose input or options have "
+                             "changed since the last build")
+    parser.add_argument("--manifest", default=None,
+                        help="Build manifest used by --incremental (default: "
+                             "{0} in the output directory, or the current "
+                             "directory)".format(build_manifest.MANIFEST_NAME))
+    parser.add_argument("--max-error", type=float, default=None,
+                        help="Merge color stops that interpolation reproduces "
+                             "to within this error per RGB channel (0..1). "
+                             "Requires NumPy")
+    parser.add_argument("--recover", action="store_true",
+                        help="Convert what can be read of damaged files, "
+                             "dropping damaged gradients with a warning, "
+                             "rather than failing them")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Overlap reading, parsing and writing of files, "
+                             "and report how busy each stage was")
+    parser.add_argument("--read-threads", type=int, default=4,
+                        help="Threads reading input files, with --pipeline")
+    parser.add_argument("--write-threads", type=int, default=2,
+                        help="Threads writing outputs, with --pipeline")
+    parser.add_argument("--queue-size", type=int,
+                        default=grd_pipeline.DEFAULT_QUEUE_SIZE,
+                        help="Files held between stages, with --pipeline")
+
+    return parser.parse_args()
+
+
+def output_dir(filename, out_dir=None, root=None):
+    """
+    Directory for the outputs of a file: None (alongside the input), or
+    out_dir, with the input's directory relative to root recreated in it,
+    so that inputs of the same name in different directories are kept apart
+    """
+    if out_dir is None or root is None:
+        return out_dir
+    relative = os.path.relpath(os.path.dirname(filename) or os.curdir,
+                               root or os.curdir)
+    return os.path.normpath(os.path.join(out_dir, relative))
+
+
+def output_dirs(filenames, out_dir=None, roots=None):
+    """{filename: output directory} for each file (see output_dir)"""
+    roots = roots or {}
+    return dict((fn, output_dir(fn, out_dir, roots.get(fn))) for fn in filenames)
+
+
+def output_filename(filename, extension, out_dir=None):
+    base = os.path.splitext(filename)[0]
+    if out_dir is not None:
+        base = os.path.join(out_dir, os.path.basename(base))
+    return base + extension
+
+
+def duplicate_outputs(filenames, formats, out_dirs=None):
+    """
+    Outputs that more than one input would be written to, as a list of
+    (output filename, inputs) pairs
+    out_dirs: {input filename: output directory}, as given by output_dir
+    """
+    writers = collections.defaultdict(list)
+    for fn in filenames:
+        for fmt in formats:
+            out_fn = output_filename(fn, CONVERTERS[fmt][1],
+                                     (out_dirs or {}).get(fn))
+            writers[os.path.abspath(out_fn)].append(fn)
+    return sorted((out_fn, inputs) for out_fn, inputs in writers.items()
+                  if len(inputs) > 1)
+
+
+def _make_dirs(path):
+    """Create a directory and its parents, if missing; safe in parallel"""
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def convert_file(filename, formats, color_engine="chroma", out_dir=None,
+                 cache_dir=None, incremental=False, max_error=None,
+                 recover=False):
+    """
+    Convert one file to each of the requested formats. Runs in a worker
+    process, so errors are reported in the return value rather than raised:
+    returns (filename, input size in bytes, list of outputs, error message,
+    list of warnings, color stops before and after simplification)
+    out_dir: Directory for the outputs, created if missing (see output_dir)
+    incremental: Only replace outputs whose contents have changed
+    max_error: Simplify gradients to within this RGB error (GrdReader.max_error)
+    recover: Drop damaged gradients, with a warning for each, rather than
+        fail a malformed file (see GrdReader strict)
+    """
+    try:
+        if os.path.splitext(filename)[1] != ".grd":
+            raise ValueError("not an Adobe PS gradient file with .grd extension")
+        if out_dir is not None:
+            _make_dirs(out_dir)
+
+        size = os.path.getsize(filename)
+        with grd_reader.GrdReader(filename, color_engine,
+                                  strict=not recover) as grd:
+            grd.max_error = max_error
+            if cache_dir is not None:
+                cache = grd_cache.GrdCache(cache_dir)
+                if not cache.load(grd):
+                    grd.parse()
+                    cache.store(grd)
+            elif len(formats) > 1:
+                # Parse once; each converter then reuses the stored gradients
+                grd.parse()
+
+            outputs = []
+
+            def write(fmt):
+                converter, extension = CONVERTERS[fmt]
+                out_fn = output_filename(filename, extension, out_dir)
+                if incremental:
+                    build_manifest.update_outfile(converter.write_outfile, grd, out_fn)
+                else:
+                    converter.generate_outfile(grd, out_fn)
+                outputs.append(out_fn)
+
+            stops_in, stops_out = convert_formats(grd, formats, write)
+            warnings = [grd_reader.describe(d) for d in grd.diagnostics]
+    except Exception as e:
+        return filename, 0, [], "{0}: {1}".format(type(e).__name__, e), [], 0, 0
+
+    return filename, size, outputs, None, warnings, stops_in, stops_out
+
+
+def convert_formats(grd, formats, write):
+    """
+    Call write(format) for each format, and count the color stops that
+    simplification (GrdReader.max_error) dropped. Each format that simplifies
+    does so for the same gradients, so the counts are of one format, rather
+    than summed over them. Returns (stops before, stops after)
+    """
+    stops = (0, 0)
+    for fmt in formats:
+        stops_in, stops_out = grd.stops_in, grd.stops_out
+        write(fmt)
+        stops = max(stops, (grd.stops_in - stops_in, grd.stops_out - stops_out))
+    return stops
+
+
+def convert_all(filenames, formats, workers=None, color_engine="chroma",
+                out_dir=None, cache_dir=None, report=None, manifest=None,
+                max_error=None, roots=None, recover=False):
+    """
+    Convert files in parallel. `report` is called with each convert_file
+    result as it completes. Returns the list of results, in completion order.
+    manifest: Optional build_manifest.BuildManifest. Only outputs that are
+        out of date are built, and the manifest is updated (but not saved)
+        for files converted without warnings
+    roots: Optional {filename: root}, as given by grd_convert.search_paths; each file's
+        outputs then keep its directory under out_dir (see output_dir)
+    recover: Convert what can be read of damaged files (see convert_file)
+    """
+    out_dirs = output_dirs(filenames, out_dir, roots)
+
+    # Each job is a file, and the formats that need building for it
+    jobs = [(fn, formats) for fn in filenames]
+    if manifest is not None:
+        jobs = [(fn, stale_formats(manifest, fn, formats, color_engine,
+                                   out_dirs[fn], max_error))
+                for fn in filenames]
+        jobs = [(fn, job_formats) for fn, job_formats in jobs if job_formats]
+
+    results = []
+    with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = [executor.submit(convert_file, fn, job_formats, color_engine,
+                                   out_dirs[fn], cache_dir, manifest is not None,
+                                   max_error, recover)
+                   for fn, job_formats in jobs]
+        for job in futures.as_completed(pending):
+            result = job.result()
+            results.append(result)
+            if manifest is not None and is_complete(result):
+                record_outputs(manifest, result, color_engine,
+                               out_dirs[result[0]], max_error)
+            if report is not None:
+                report(result)
+    return results
+
+
+def convert_buffer(data, filename, formats, color_engine="chroma",
+                   cache_dir=None, max_error=None, recover=False):
+    """
+    Parse the contents of a .grd file and convert them to each of the
+    requested formats, in memory. Runs in a worker process, so that only
+    disk I/O is left to the threads of convert_pipelined.
+    Returns ({format: output bytes}, list of warnings, color stops before
+    and after simplification)
+    """
+    grd = grd_reader.GrdReader.from_buffer(data, color_engine, filename=filename,
+                                           strict=not recover)
+    grd.max_error = max_error
+    if cache_dir is not None:
+        cache = grd_cache.GrdCache(cache_dir)
+        if not cache.load(grd):
+            grd.parse()
+            cache.store(grd)
+    elif len(formats) > 1:
+        grd.parse()
+
+    outputs = {}
+
+    def write(fmt):
+        out_f = StringIO()
+        CONVERTERS[fmt][0].write_outfile(grd, out_f)
+        outputs[fmt] = out_f.getvalue()
+
+    stops_in, stops_out = convert_formats(grd, formats, write)
+    return (outputs, [grd_reader.describe(d) for d in grd.diagnostics],
+            stops_in, stops_out)
+
+
+class PipelineJob(object):
+    """A file passing through the stages of convert_pipelined"""
+    def __init__(self, filename, formats):
+        self.filename = filename
+        self.formats = formats
+        self.size = 0
+        self.data = None  # File contents, once read
+        self.converted = None  # {format: output bytes}, once converted
+        self.outputs = []
+        self.error = None
+        self.warnings = []
+        self.stops_in = self.stops_out = 0
+
+    def fail(self, e):
+        self.error = "{0}: {1}".format(type(e).__name__, e)
+        self.data = self.converted = None
+
+    def result(self):
+        """Same form as the result of convert_file"""
+        if self.error is not None:
+            return self.filename, 0, [], self.error, [], 0, 0
+        return (self.filename, self.size, self.outputs, None, self.warnings,
+                self.stops_in, self.stops_out)
+
+
+def convert_pipelined(filenames, formats, workers=None, color_engine="chroma",
+                      out_dir=None, cache_dir=None, report=None, manifest=None,
+                      read_threads=4, write_threads=2,
+                      queue_size=grd_pipeline.DEFAULT_QUEUE_SIZE, max_error=None,
+                      roots=None, recover=False):
+    """
+    Convert files in three overlapping stages: threads read whole files,
+    a pool of `workers` processes parses and converts them (see
+    convert_buffer), and threads write the outputs to disk. Arguments and
+    results are as convert_all.
+    Returns (results, grd_pipeline.Pipeline with stage statistics)
+    """
+    out_dirs = output_dirs(filenames, out_dir, roots)
+    jobs = [PipelineJob(fn, formats) for fn in filenames]
+    if manifest is not None:
+        for job in jobs:
+            job.formats = stale_formats(manifest, job.filename, formats,
+                                        color_engine, out_dirs[job.filename],
+                                        max_error)
+        jobs = [job for job in jobs if job.formats]
+
+    workers = workers or multiprocessing.cpu_count()
+    results = []
+    results_lock = threading.Lock()
+
+    def read(job):
+        try:
+            if os.path.splitext(job.filename)[1] != ".grd":
+                raise ValueError("not an Adobe PS gradient file with .grd extension")
+            with open(job.filename, 'rb') as f:
+                job.data = f.read()
+            job.size = len(job.data)
+        except Exception as e:
+            job.fail(e)
+        return job
+
+    def convert(job):
+        if job.error is not None:
+            return job
+        try:
+            (job.converted, job.warnings, job.stops_in,
+             job.stops_out) = executor.submit(
+                convert_buffer, job.data, job.filename, job.formats,
+                color_engine, cache_dir, max_error, recover).result()
+            job.data = None
+        except Exception as e:
+            job.fail(e)
+        return job
+
+    def write(job):
+        for fmt in job.formats:
+            if job.error is not None:
+                break
+            out_fn = output_filename(job.filename, CONVERTERS[fmt][1],
+                                     out_dirs[job.filename])
+            data = job.converted[fmt]
+            try:
+                if out_dirs[job.filename] is not None:
+                    _make_dirs(out_dirs[job.filename])
+                if manifest is not None:
+                    build_manifest.write_if_changed(out_fn, data)
+                else:
+                    grd_convert.stream_outfile(lambda out_f: out_f.write(data),
+                                               out_fn, 'wb')
+                job.outputs.append(out_fn)
+            except Exception as e:
+                job.fail(e)
+        job.converted = None
+
+        result = job.result()
+        with results_lock:
+            results.append(result)
+            if manifest is not None and is_complete(result):
+                record_outputs(manifest, result, color_engine,
+                               out_dirs[job.filename], max_error)
+            if report is not None:
+                report(result)
+
+    pipeline = grd_pipeline.Pipeline(queue_size)
+    pipeline.add_stage("read", read, read_threads)
+    # Each convert thread waits on one worker process at a time
+    pipeline.add_stage("convert", convert, workers)
+    pipeline.add_stage("write", write, write_threads)
+    with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pipeline.run(jobs)
+    return results, pipeline
+
+
+def stale_formats(manifest, filename, formats, color_engine, out_dir,
+                  max_error=None):
+    """Formats whose output for this file is missing or out of date"""
+    return [fmt for fmt in formats
+            if not manifest.is_current(
+                filename,
+                output_filename(filename, CONVERTERS[fmt][1], out_dir),
+                CONVERTERS[fmt][0].generator_options(color_engine,
+                                                     max_error=max_error))]
+
+
+def is_complete(result):
+    """Whether a file was converted, without dropping any damaged gradients"""
+    return result[3] is None and not result[4]
+
+
+def record_outputs(manifest, result, color_engine, out_dir, max_error=None):
+    filename, size, outputs = result[:3]
+    input_sha1 = build_manifest.file_digest(filename)
+    for converter, extension in CONVERTERS.values():
+        out_fn = output_filename(filename, extension, out_dir)
+        if out_fn in outputs:
+            manifest.record(filename, out_fn,
+                            converter.generator_options(color_engine,
+                                                        max_error=max_error),
+                            input_sha1)
+
+
+def print_result(result):
+    filename, size, outputs, error, warnings = result[:5]
+    if error is None:
+        print("OK      {0} -> {1}".format(filename, ", ".join(outputs)))
+    else:
+        print("FAILED  {0}: {1}".format(filename, error))
+    for warning in warnings:
+        print(u"WARNING {0}: {1}".format(filename, warning).encode("utf-8"))
+
+
+def print_summary(results, elapsed):
+    failed = sum(1 for r in results if r[3] is not None)
+    damaged = sum(1 for r in results if r[4])
+    total_bytes = sum(r[1] for r in results)
+    elapsed = max(elapsed, 1e-9)
+    print("{0} converted, {1} failed in {2:.2f} s "
+          "({3:.1f} files/s, {4:.2f} MB/s)".format(
+              len(results) - failed, failed, elapsed,
+              len(results) / elapsed, total_bytes / elapsed / 1e6))
+    if damaged:
+        print("{0} damaged files converted in part".format(damaged))
+    stops_in = sum(r[5] for r in results)
+    if stops_in:  # Simplified, with --max-error
+        stops_out = sum(r[6] for r in results)
+        print("Simplified {0} color stops to {1} ({2:.1%})".format(
+            stops_in, stops_out, stops_out / float(stops_in)))
+
+
+if __name__ == "__main__":
+    parsed_args = command_line()
+    formats = parsed_args.formats or ["matplotlib"]
+
+    found = grd_convert.search_paths(parsed_args.paths)
+    if not found:
+        print("No .grd files found")
+        sys.exit(1)
+    filenames = [fn for fn, _ in found]
+    roots = dict(found)
+
+    # Inputs of the same name, eg given as files from different directories
+    duplicates = duplicate_outputs(filenames, formats,
+                                   output_dirs(filenames, parsed_args.out_dir, roots))
+    for out_fn, inputs in duplicates:
+        print("FAILED  {0} would be written by each of {1}".format(
+            out_fn, ", ".join(inputs)))
+    if duplicates:
+        sys.exit(1)
+
+    if parsed_args.out_dir is not None and not os.path.isdir(parsed_args.out_dir):
+        os.makedirs(parsed_args.out_dir)
+
+    manifest = None
+    if parsed_args.incremental:
+        manifest = build_manifest.BuildManifest(
+            parsed_args.manifest or os.path.join(parsed_args.out_dir or "",
+                                                 build_manifest.MANIFEST_NAME))
+
+    start = time.time()
+    if parsed_args.pipeline:
+        results, pipeline = convert_pipelined(
+            filenames, formats, parsed_args.workers, parsed_args.engine,
+            parsed_args.out_dir, parsed_args.cache_dir, report=print_result,
+            manifest=manifest, read_threads=parsed_args.read_threads,
+            write_threads=parsed_args.write_threads,
+            queue_size=parsed_args.queue_size, max_error=parsed_args.max_error,
+            roots=roots, recover=parsed_args.recover)
+    else:
+        results = convert_all(filenames, formats, parsed_args.workers,
+                              parsed_args.engine, parsed_args.out_dir,
+                              parsed_args.cache_dir, report=print_result,
+                              manifest=manifest, max_error=parsed_args.max_error,
+                              roots=roots, recover=parsed_args.recover)
+    if manifest is not None:
+        manifest.save()
+        print("{0} files up to date".format(len(filenames) - len(results)))
+    print_summary(results, time.time() - start)
+    if parsed_args.pipeline:
+        pipeline.report()
+
+    if any(r[3] is not None for r in results):
+        sys.exit(1)
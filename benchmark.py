@@ -0,0 +1,166 @@
+"""
+Benchmark the parse and conversion hot paths on synthetic .grd files.
+
+Each case runs in a fresh subprocess so that its peak memory can be measured
+on its own. Results (time, stops/s, MB/s, peak RSS) are printed and can be
+saved as JSON, then compared with a previous run.
+"""
+import argparse, json, os, shutil, subprocess, sys, tempfile, time
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+import grd_reader, synthetic_grd
+
+# Phase name: function(grd, gradients) timed after the file is parsed
+PHASES = {
+    "cleanup": lambda grd, gradients: [grd._cleanup_gradient(g) for g in gradients],
+    "grd_to_cmap": lambda grd, gradients: [grd.grd_to_cmap(g) for g in gradients],
+    "grd_to_js": lambda grd, gradients: [grd.grd_to_js(g) for g in gradients],
+}
+
+# (gradients, stops per gradient) for the scaling curve
+DEFAULT_SIZES = [(10, 16), (100, 16), (1000, 16), (100, 256)]
+
+
+def command_line():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs="+", default=None, metavar="GxS",
+                        help="File sizes to run, as gradients x stops "
+                             "(default: {0})".format(" ".join(
+                                 "{0}x{1}".format(*s) for s in DEFAULT_SIZES)))
+    parser.add_argument("--depth", type=int, default=2,
+                        help="Nesting depth of extra VlLs/Objc payload")
+    parser.add_argument("--engines", nargs="+", default=list(grd_reader.COLOR_ENGINES),
+                        choices=grd_reader.COLOR_ENGINES)
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Best of this many runs is reported")
+    parser.add_argument("--out", default=None,
+                        help="Save results to this JSON file")
+    parser.add_argument("--compare", default=None,
+                        help="Compare with results saved from a previous run")
+    # Internal: run one case and print its result
+    parser.add_argument("--run-case", nargs=3, default=None,
+                        metavar=("FILENAME", "PHASE", "ENGINE"),
+                        help=argparse.SUPPRESS)
+
+    return parser.parse_args()
+
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux, but bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_case(filename, phase, engine, repeat):
+    """Time one phase on one file, in this process. Returns a result dict"""
+    best = None
+    for i in range(repeat):
+        grd = grd_reader.GrdReader(filename, engine)
+        start = time.time()
+        grd.parse()
+        elapsed = time.time() - start
+
+        if phase != "parse":
+            start = time.time()
+            PHASES[phase](grd, grd.gradients)
+            elapsed = time.time() - start
+        grd.close()
+        best = elapsed if best is None else min(best, elapsed)
+
+    n_stops = sum(len(g) for g in grd.gradients)
+    size = os.path.getsize(filename)
+    best = max(best, 1e-9)
+    return {"seconds": best,
+            "gradients": len(grd.gradients),
+            "stops": n_stops,
+            "bytes": size,
+            "stops_per_s": n_stops / best,
+            "mb_per_s": size / best / 1e6,
+            "peak_rss": peak_rss_bytes()}
+
+
+def run_in_subprocess(filename, phase, engine, repeat):
+    cmd = [sys.executable, os.path.abspath(__file__),
+           "--run-case", filename, phase, engine, "--repeat", str(repeat)]
+    return json.loads(subprocess.check_output(cmd).decode("ascii"))
+
+
+def case_name(phase, engine, n_gradients, n_stops):
+    if phase == "parse":
+        # Parsing does not depend on the color engine
+        return "parse {0}x{1}".format(n_gradients, n_stops)
+    return "{0}[{1}] {2}x{3}".format(phase, engine, n_gradients, n_stops)
+
+
+def run_all(sizes, engines, depth, repeat, report=None):
+    """Run every phase for every file size. Returns {case name: result}"""
+    results = {}
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for n_gradients, n_stops in sizes:
+            filename = os.path.join(tmp_dir, "{0}x{1}.grd".format(n_gradients, n_stops))
+            with open(filename, "wb") as f:
+                synthetic_grd.write_grd(f, n_gradients, n_stops, depth=depth)
+
+            cases = [("parse", engines[0])]
+            cases.extend((phase, engine) for phase in sorted(PHASES)
+                         for engine in engines)
+            for phase, engine in cases:
+                name = case_name(phase, engine, n_gradients, n_stops)
+                results[name] = run_in_subprocess(filename, phase, engine, repeat)
+                if report is not None:
+                    report(name, results[name])
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def print_result(name, result, baseline=None):
+    line = "{0:<32} {1:9.4f} s {2:12.0f} stops/s {3:8.2f} MB/s".format(
+        name, result["seconds"], result["stops_per_s"], result["mb_per_s"])
+    if result["peak_rss"] is not None:
+        line += " {0:8.1f} MB peak".format(result["peak_rss"] / 1e6)
+    if baseline is not None:
+        line += "   x{0:.2f} vs baseline".format(
+            baseline["seconds"] / result["seconds"])
+    print(line)
+
+
+def parse_size(text):
+    n_gradients, n_stops = text.lower().split("x")
+    return int(n_gradients), int(n_stops)
+
+
+if __name__ == "__main__":
+    parsed_args = command_line()
+
+    if parsed_args.run_case is not None:
+        filename, phase, engine = parsed_args.run_case
+        print(json.dumps(run_case(filename, phase, engine, parsed_args.repeat)))
+        sys.exit(0)
+
+    baseline = {}
+    if parsed_args.compare is not None:
+        with open(parsed_args.compare) as f:
+            baseline = json.load(f)["results"]
+
+    sizes = DEFAULT_SIZES
+    if parsed_args.sizes is not None:
+        sizes = [parse_size(s) for s in parsed_args.sizes]
+
+    results = run_all(sizes, parsed_args.engines, parsed_args.depth,
+                      parsed_args.repeat,
+                      report=lambda name, result: print_result(
+                          name, result, baseline.get(name)))
+
+    if parsed_args.out is not None:
+        with open(parsed_args.out, "w") as f:
+            json.dump({"python": sys.version.split()[0],
+                       "timestamp": time.time(),
+                       "results": results}, f, indent=1, sort_keys=True)
@@ -0,0 +1,147 @@
+"""
+Read in an adobe gradient file (.grd) and output the converted gradients as
+a compact binary container (.grdb), which ColormapFile can memory-map and
+read single colormaps from, without decoding the others.
+
+Layout (all little-endian):
+    header: magic "GRDB", format version (H), reserved (H), gradient count (L)
+    index: for each gradient, name length (H), UTF-8 name, offset of its
+        data from the start of the file (Q), number of stops (L)
+    data: for each gradient, 8-byte aligned: n stop locations (doubles),
+        then n (red, green, blue) triplets (doubles), all in range 0..1
+"""
+import array, itertools, mmap, struct, sys
+
+import grd_convert
+
+MAGIC = b"GRDB"
+FORMAT_VERSION = 1
+
+_HEADER = struct.Struct("<4sHHL")
+_NAME_LENGTH = struct.Struct("<H")
+_INDEX_ENTRY = struct.Struct("<QL")
+_ALIGNMENT = 8
+
+
+def command_line():
+    return grd_convert.argument_parser().parse_args()
+
+
+def _padding(offset):
+    return -offset % _ALIGNMENT
+
+
+def write_outfile(grd, out_f):
+    """
+    Write converted gradients to an open binary file. The index has to come
+    first, so gradients are packed in memory before anything is written.
+    """
+    names = []
+    blocks = []
+    for name, gradient in grd_convert.iter_named_gradients(grd):
+        gradient_locations, gradient_rgb = grd._cleanup_gradient(gradient)
+        block = array.array('d', gradient_locations)
+        block.extend(itertools.chain.from_iterable(gradient_rgb))
+        if sys.byteorder != "little":
+            block.byteswap()
+        names.append(name.encode("utf-8"))
+        blocks.append((len(gradient_locations), block.tostring()))
+
+    index_size = sum(_NAME_LENGTH.size + len(name) + _INDEX_ENTRY.size
+                     for name in names)
+    offset = _HEADER.size + index_size
+    offset += _padding(offset)
+
+    out_f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(names)))
+    for name, (n_stops, data) in zip(names, blocks):
+        out_f.write(_NAME_LENGTH.pack(len(name)) + name)
+        out_f.write(_INDEX_ENTRY.pack(offset, n_stops))
+        offset += len(data) + _padding(len(data))
+    out_f.write(b"\0" * _padding(_HEADER.size + index_size))
+
+    for n_stops, data in blocks:
+        out_f.write(data + b"\0" * _padding(len(data)))
+    return out_f
+
+
+def generate_outfile(grd, out_fn):
+    """Generate a .grdb file containing converted gradients"""
+    grd_convert.stream_outfile(lambda out_f: write_outfile(grd, out_f), out_fn,
+                               'wb')
+
+
+def generator_options(color_engine="chroma", max_error=None):
+    """Options that affect the output, as recorded in a build manifest"""
+    return grd_convert.generator_options("binary", color_engine, max_error,
+                                         format_version=FORMAT_VERSION)
+
+
+class ColormapFile(object):
+    """
+    Read-only access to a .grdb file. Only the index is read on opening; the
+    stops of a gradient are unpacked when that gradient is asked for.
+    """
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, _, count = _HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a .grdb colormap file: " + filename)
+        if version != FORMAT_VERSION:
+            raise ValueError("Unsupported .grdb format version: {0}".format(version))
+
+        self.names = []
+        self._index = {}  # name: (offset, number of stops)
+        offset = _HEADER.size
+        for i in range(count):
+            [name_length] = _NAME_LENGTH.unpack_from(self.buffer, offset)
+            offset += _NAME_LENGTH.size
+            name = self.buffer[offset:offset + name_length].decode("utf-8")
+            offset += name_length
+            self._index[name] = _INDEX_ENTRY.unpack_from(self.buffer, offset)
+            offset += _INDEX_ENTRY.size
+            self.names.append(name)
+
+    def close(self):
+        self.buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def stops(self, name):
+        """Returns (locations, [(red, green, blue), ...]) of the named gradient"""
+        offset, n_stops = self._index[name]
+        values = struct.unpack_from("<{0}d".format(n_stops * 4), self.buffer, offset)
+        locations = list(values[:n_stops])
+        rgb = zip(*[iter(values[n_stops:])] * 3)
+        return locations, rgb
+
+    def cmap_data(self, name):
+        """The named gradient as a matplotlib cmap spec (as GrdReader.grd_to_cmap)"""
+        locations, rgb = self.stops(name)
+        return {"red": [(loc, c[0], c[0]) for loc, c in zip(locations, rgb)],
+                "green": [(loc, c[1], c[1]) for loc, c in zip(locations, rgb)],
+                "blue": [(loc, c[2], c[2]) for loc, c in zip(locations, rgb)]}
+
+    def get_cmap(self, name):
+        """The named gradient as a matplotlib LinearSegmentedColormap"""
+        from matplotlib.colors import LinearSegmentedColormap
+        return LinearSegmentedColormap(name, self.cmap_data(name))
+
+
+if __name__ == "__main__":
+    parsed_args = command_line()
+    grd_convert.convert(parsed_args, ".grdb",
+                        generator_options(parsed_args.engine,
+                                          max_error=parsed_args.max_error),
+                        write_outfile, generate_outfile)
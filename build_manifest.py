@@ -0,0 +1,146 @@
+"""
+Manifest of converted outputs, for incremental rebuilds.
+
+For each output file the manifest records a hash of the input .grd file and
+the generator options used. An output is up to date when its input and
+options are unchanged; the size and mtime of the input are checked first so
+that a no-op build does not need to read any input. Outputs that are rebuilt
+are only rewritten when their bytes actually differ.
+"""
+import hashlib, json, os
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+MANIFEST_NAME = ".grd_manifest.json"
+MANIFEST_VERSION = 1
+
+
+def file_digest(filename):
+    """SHA-1 of a file's contents"""
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_if_changed(out_fn, data):
+    """Write data to out_fn unless it already holds exactly that. Returns True if written"""
+    try:
+        with open(out_fn, 'rb') as f:
+            if f.read() == data:
+                return False
+    except IOError:
+        pass
+
+    tmp_fn = "{0}.{1}.tmp".format(out_fn, os.getpid())
+    with open(tmp_fn, 'wb') as f:
+        f.write(data)
+    if os.path.exists(out_fn):
+        os.remove(out_fn)
+    os.rename(tmp_fn, out_fn)
+    return True
+
+
+def files_equal(fn_a, fn_b):
+    """True if both files exist and have the same contents"""
+    try:
+        if os.path.getsize(fn_a) != os.path.getsize(fn_b):
+            return False
+        with open(fn_a, 'rb') as f_a, open(fn_b, 'rb') as f_b:
+            for chunk in iter(lambda: f_a.read(1 << 20), b""):
+                if chunk != f_b.read(len(chunk)):
+                    return False
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def replace_if_changed(tmp_fn, out_fn):
+    """
+    Move a newly written tmp_fn over out_fn, unless out_fn already holds the
+    same bytes (in which case tmp_fn is removed). Returns True if replaced
+    """
+    if files_equal(tmp_fn, out_fn):
+        os.remove(tmp_fn)
+        return False
+    if os.path.exists(out_fn):
+        os.remove(out_fn)
+    os.rename(tmp_fn, out_fn)
+    return True
+
+
+def update_outfile(write_outfile, grd, out_fn):
+    """
+    Generate output in memory with a converter's write_outfile function, and
+    only replace out_fn if the result differs. Returns True if written
+    """
+    out_str = StringIO()
+    write_outfile(grd, out_str)
+    return write_if_changed(out_fn, out_str.getvalue())
+
+
+class BuildManifest(object):
+    """Input hashes and generator options of outputs, saved as JSON at `path`"""
+    def __init__(self, path):
+        self.path = path
+        self.base_dir = os.path.dirname(os.path.abspath(path))
+        self.outputs = {}
+        self._changed = False
+
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data.get("version") == MANIFEST_VERSION:
+                self.outputs = data["outputs"]
+        except (IOError, ValueError, KeyError):
+            # No usable manifest: everything will be rebuilt
+            pass
+
+    def _key(self, out_fn):
+        """Outputs are stored relative to the manifest, so the tree can move"""
+        return os.path.relpath(os.path.abspath(out_fn), self.base_dir)
+
+    def is_current(self, in_fn, out_fn, options):
+        """True if out_fn was built from the current in_fn with these options"""
+        entry = self.outputs.get(self._key(out_fn))
+        if entry is None or entry["options"] != options:
+            return False
+        if not os.path.exists(out_fn):
+            return False
+
+        try:
+            st = os.stat(in_fn)
+        except OSError:
+            return False
+        if entry["size"] == st.st_size and entry["mtime"] == st.st_mtime:
+            return True
+
+        # Touched, but possibly with the same contents
+        if file_digest(in_fn) != entry["input_sha1"]:
+            return False
+        entry["size"], entry["mtime"] = st.st_size, st.st_mtime
+        self._changed = True
+        return True
+
+    def record(self, in_fn, out_fn, options, input_sha1=None):
+        """Note that out_fn is now built from in_fn with these options"""
+        st = os.stat(in_fn)
+        self.outputs[self._key(out_fn)] = {
+            "input_sha1": input_sha1 or file_digest(in_fn),
+            "size": st.st_size,
+            "mtime": st.st_mtime,
+            "options": options}
+        self._changed = True
+
+    def save(self):
+        """Write the manifest, if anything has changed"""
+        if not self._changed:
+            return
+        data = json.dumps({"version": MANIFEST_VERSION, "outputs": self.outputs},
+                          indent=1, sort_keys=True)
+        write_if_changed(self.path, data)
+        self._changed = False
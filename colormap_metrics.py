@@ -0,0 +1,364 @@
+"""
+Perceptual metrics of gradients, and an index for finding similar ones
+across a library of .grd files.
+
+Each gradient is sampled at evenly spaced positions (with its midpoints,
+see GrdReader.evaluate; opacity is ignored) and converted to CIE L*a*b*,
+where the Euclidean distance between two colors approximates how different
+they look (Delta E, CIE76). The metrics are computed for all gradients at
+once from these samples:
+    lightness_monotonicity: net change in L* over total change in L*, 1 if
+        lightness only rises (or only falls) along the gradient
+    lightness_range: Largest minus smallest L*
+    delta_e: Mean Delta E between neighbouring samples, ie how fast the
+        color changes
+    delta_e_max: Largest Delta E between neighbouring samples, high at
+        hard edges
+    uniformity: Coefficient of variation of Delta E between neighbouring
+        samples, 0 for perceptually uniform gradients
+
+The index is a NumPy .npz file holding the samples of every gradient. It is
+updated incrementally: gradients from files whose size and mtime have not
+changed are kept rather than read again. Queries compare the samples of all
+gradients in one matrix product; the distance between two gradients is the
+RMS Delta E between their samples.
+"""
+import argparse, os, sys, timeit
+
+import numpy as np
+
+import grd_convert, grd_reader, vector_color
+
+INDEX_VERSION = 1
+DEFAULT_SAMPLES = 64
+DEFAULT_COUNT = 10
+# Near-duplicate threshold; a Delta E of about 2 is barely noticeable
+DEFAULT_MAX_DELTA_E = 2.
+# Perceptually uniform: lightness only rises or falls, at an even pace
+UNIFORM_MONOTONICITY = 0.99
+UNIFORM_VARIATION = 0.2
+# Rows compared at a time when looking for duplicates, to bound memory
+_BLOCK_ROWS = 1024
+
+METRICS = ("lightness_monotonicity", "lightness_range", "delta_e",
+           "delta_e_max", "uniformity")
+
+
+def command_line():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("index",
+                        help="Index file (.npz) to query, or to build or "
+                             "update if paths are given")
+    parser.add_argument("paths", nargs="*",
+                        help=".grd files, directories (searched recursively) "
+                             "or glob patterns to index")
+    parser.add_argument("--samples", type=int, default=DEFAULT_SAMPLES,
+                        help="Positions sampled along each gradient, when building")
+    parser.add_argument("--engine", choices=grd_reader.COLOR_ENGINES,
+                        default="numpy",
+                        help="Color conversion engine, when building")
+    parser.add_argument("--like", default=None, metavar="NAME",
+                        help="List the gradients most similar to this one")
+    parser.add_argument("--source", default=None, metavar="FILENAME",
+                        help="File of the --like gradient, if its name is not unique")
+    parser.add_argument("--count", type=int, default=DEFAULT_COUNT,
+                        help="Number of similar gradients to list")
+    parser.add_argument("--reverse", action="store_true",
+                        help="With --like, also match gradients that run the "
+                             "other way")
+    parser.add_argument("--duplicates", action="store_true",
+                        help="List pairs of near-duplicate gradients")
+    parser.add_argument("--max-delta-e", type=float, default=DEFAULT_MAX_DELTA_E,
+                        help="RMS Delta E below which gradients are duplicates "
+                             "(default: %(default)s)")
+    parser.add_argument("--uniform", action="store_true",
+                        help="List perceptually uniform gradients, most uniform "
+                             "first")
+
+    return parser.parse_args()
+
+
+def sample_lab(grd, gradient, samples=DEFAULT_SAMPLES):
+    """(samples, 3) L*a*b* values along a gradient of an open GrdReader"""
+    rgba = grd.evaluate(gradient, np.linspace(0., 1., samples))
+    return vector_color.rgb_to_lab(rgba[:, :3])
+
+
+def perceptual_metrics(lab):
+    """
+    Metrics of many gradients at once (see the module docstring), from an
+    (n, samples, 3) array of L*a*b* values. Returns {name: (n,) array}
+    """
+    lab = np.asarray(lab, dtype=float)
+    steps = np.sqrt((np.diff(lab, axis=1) ** 2).sum(axis=2))
+    lightness_steps = np.diff(lab[..., 0], axis=1)
+    lightness_travel = np.abs(lightness_steps).sum(axis=1)
+    delta_e = steps.mean(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        monotonicity = np.where(lightness_travel > 0,
+                                np.abs(lightness_steps.sum(axis=1)) / lightness_travel,
+                                1.)
+        uniformity = np.where(delta_e > 0, steps.std(axis=1) / delta_e, 0.)
+    return {"lightness_monotonicity": monotonicity,
+            "lightness_range": np.ptp(lab[..., 0], axis=1),
+            "delta_e": delta_e,
+            "delta_e_max": steps.max(axis=1),
+            "uniformity": uniformity}
+
+
+class ColormapIndex(object):
+    """L*a*b* samples of the gradients of many .grd files, for similarity queries"""
+    def __init__(self, filename, names, sources, lab, files):
+        """
+        names: Gradient names; sources: the file each one comes from
+        lab: (n, samples, 3) float32 array of L*a*b* samples
+        files: {filename: (size, mtime)} of the indexed files
+        """
+        self.filename = filename
+        self.names = list(names)
+        self.sources = list(sources)
+        self.lab = np.asarray(lab, dtype=np.float32)
+        self.files = files
+        self.samples = self.lab.shape[1]
+        self.metrics = perceptual_metrics(self.lab)
+
+        # Squared distances are |a|^2 + |b|^2 - 2 a.b, so one matrix
+        #  product compares a query with every gradient
+        self._features = self.lab.reshape(len(self.lab), -1)
+        self._norms = (self._features.astype(float) ** 2).sum(axis=1)
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def build(cls, filename, grd_files, samples=DEFAULT_SAMPLES,
+              color_engine="numpy", previous=None, report=None):
+        """
+        Index the gradients of grd_files. Gradients of files unchanged since
+        `previous` (a ColormapIndex) was built are taken from it.
+        report: Optional function called with (filename, number of
+            gradients, error message or None) for each file read
+        """
+        reuse = previous is not None and previous.samples == samples
+        names, sources, lab, files = [], [], [], {}
+        for fn in grd_files:
+            if not isinstance(fn, unicode):
+                fn = fn.decode(sys.getfilesystemencoding() or "utf-8")
+            try:
+                st = os.stat(fn)
+            except OSError as e:
+                if report is not None:
+                    report(fn, 0, str(e))
+                continue
+            files[fn] = (st.st_size, st.st_mtime)
+            if reuse and previous.files.get(fn) == files[fn]:
+                rows = [i for i, source in enumerate(previous.sources) if source == fn]
+                names.extend(previous.names[i] for i in rows)
+                sources.extend([fn] * len(rows))
+                lab.extend(previous.lab[rows])
+                continue
+
+            count, error = 0, None
+            try:
+                with grd_reader.GrdReader(fn, color_engine) as grd:
+                    for name, gradient in grd.iter_gradients():
+                        try:
+                            gradient_lab = sample_lab(grd, gradient, samples)
+                        except (ValueError, ZeroDivisionError, NotImplementedError):
+                            # Eg a single stop, or an unsupported color type
+                            continue
+                        names.append(name)
+                        sources.append(fn)
+                        lab.append(gradient_lab)
+                        count += 1
+            except Exception as e:
+                # Drop whatever was read from the file
+                del names[len(names) - count:], sources[len(sources) - count:]
+                del lab[len(lab) - count:], files[fn]
+                count, error = 0, "{0}: {1}".format(type(e).__name__, e)
+            if report is not None:
+                report(fn, count, error)
+
+        lab = np.array(lab, dtype=np.float32).reshape(len(names), samples, 3)
+        return cls(filename, names, sources, lab, files)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a saved index. Returns None if it is missing or out of date"""
+        try:
+            with np.load(filename) as data:
+                if (int(data["version"]) != INDEX_VERSION or
+                        int(data["parser_version"]) != grd_reader.PARSER_VERSION):
+                    return None
+                files = data["files"].tolist()
+                stats = data["file_stats"].tolist()
+                return cls(filename, data["names"].tolist(),
+                           [files[i] for i in data["source_ids"]], data["lab"],
+                           dict(zip(files, map(tuple, stats))))
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+
+    def save(self):
+        """Save the index, replacing the file only once it is complete"""
+        files = sorted(self.files)
+        file_ids = dict((fn, i) for i, fn in enumerate(files))
+        tmp_fn = "{0}.{1}.tmp".format(self.filename, os.getpid())
+        with open(tmp_fn, 'wb') as f:
+            np.savez(f, version=INDEX_VERSION,
+                     parser_version=grd_reader.PARSER_VERSION,
+                     names=np.array(self.names, dtype=unicode),
+                     source_ids=np.array([file_ids[fn] for fn in self.sources],
+                                         dtype=np.int32),
+                     files=np.array(files, dtype=unicode),
+                     file_stats=np.array([self.files[fn] for fn in files],
+                                         dtype=float).reshape(-1, 2),
+                     lab=self.lab)
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.rename(tmp_fn, self.filename)
+
+    def find(self, name, source=None):
+        """Rows of the gradients with this name (and from this file)"""
+        return [i for i, (row_name, row_source) in enumerate(zip(self.names, self.sources))
+                if row_name == name and (source is None or
+                                         os.path.abspath(row_source) == os.path.abspath(source))]
+
+    def distances(self, lab):
+        """RMS Delta E between (samples, 3) L*a*b* values and every gradient"""
+        query = np.asarray(lab, dtype=np.float32).reshape(-1)
+        squared = self._norms + float(np.dot(query, query)) - 2. * self._features.dot(query)
+        return np.sqrt(np.maximum(squared, 0.) / self.samples)
+
+    def nearest(self, row, count=DEFAULT_COUNT, reverse=False):
+        """
+        The `count` gradients most similar to that in `row`, as a list of
+        (row, RMS Delta E, whether reversed), closest first
+        reverse: Also compare with the gradient run backwards
+        """
+        distances = self.distances(self.lab[row])
+        reversed_rows = np.zeros(len(distances), dtype=bool)
+        if reverse:
+            backwards = self.distances(self.lab[row][::-1])
+            reversed_rows = backwards < distances
+            distances = np.minimum(distances, backwards)
+        distances[row] = np.inf
+        count = min(count, len(distances) - 1)
+        if count <= 0:
+            return []
+        closest = np.argpartition(distances, count - 1)[:count]
+        closest = closest[np.argsort(distances[closest], kind="mergesort")]
+        return [(i, float(distances[i]), bool(reversed_rows[i])) for i in closest]
+
+    def duplicates(self, max_delta_e=DEFAULT_MAX_DELTA_E):
+        """
+        Pairs of gradients within max_delta_e (RMS Delta E) of each other,
+        as a list of (row, row, RMS Delta E), closest first
+        """
+        limit = max_delta_e ** 2 * self.samples
+        pairs = []
+        for start in range(0, len(self), _BLOCK_ROWS):
+            block = self._features[start:start + _BLOCK_ROWS]
+            squared = (self._norms[start:start + _BLOCK_ROWS, np.newaxis] +
+                       self._norms[np.newaxis, :] -
+                       2. * block.dot(self._features.T))
+            rows, columns = np.nonzero(squared <= limit)
+            rows += start
+            later = columns > rows  # Each pair once, and not with itself
+            for i, j in zip(rows[later], columns[later]):
+                pairs.append((i, j, float(np.sqrt(max(squared[i - start, j], 0.) /
+                                                  self.samples))))
+        return sorted(pairs, key=lambda pair: pair[2])
+
+    def uniform(self, min_monotonicity=UNIFORM_MONOTONICITY,
+                max_variation=UNIFORM_VARIATION):
+        """Rows of perceptually uniform gradients, most uniform first"""
+        metrics = self.metrics
+        rows = np.flatnonzero((metrics["lightness_monotonicity"] >= min_monotonicity) &
+                              (metrics["uniformity"] <= max_variation))
+        return rows[np.argsort(metrics["uniformity"][rows], kind="mergesort")].tolist()
+
+    def label(self, row):
+        return u"{0} ({1})".format(self.names[row], self.sources[row])
+
+
+def print_line(text):
+    print(text.encode("utf-8"))
+
+
+def print_metrics(index, rows):
+    print("{0:>6} {1:>6} {2:>7} {3:>7} {4:>10}  gradient".format(
+        "mono", "L*", "dE", "max dE", "uniformity"))
+    for i in rows:
+        values = [index.metrics[metric][i] for metric in METRICS]
+        print_line(u"{0:>6.3f} {1:>6.1f} {2:>7.3f} {3:>7.2f} {4:>10.3f}  {5}".format(
+            *values + [index.label(i)]))
+
+
+def report_file(filename, count, error):
+    if error is None:
+        print("OK      {0}: {1} gradients".format(filename, count))
+    else:
+        print("FAILED  {0}: {1}".format(filename, error))
+
+
+if __name__ == "__main__":
+    parsed_args = command_line()
+
+    failed = []
+    if parsed_args.paths:
+        def report(filename, count, error):
+            report_file(filename, count, error)
+            if error is not None:
+                failed.append(filename)
+
+        started = timeit.default_timer()
+        previous = ColormapIndex.load(parsed_args.index)
+        index = ColormapIndex.build(parsed_args.index,
+                                    grd_convert.find_grd_files(parsed_args.paths),
+                                    parsed_args.samples, parsed_args.engine,
+                                    previous, report=report)
+        index.save()
+        print("Indexed {0} gradients from {1} files in {2:.2f} s".format(
+            len(index), len(index.files), timeit.default_timer() - started))
+    else:
+        index = ColormapIndex.load(parsed_args.index)
+        if index is None:
+            print("No up to date index at {0}; give .grd files to build it".format(
+                parsed_args.index))
+            sys.exit(1)
+
+    started = timeit.default_timer()
+    if parsed_args.like is not None:
+        rows = index.find(parsed_args.like.decode("utf-8"), parsed_args.source)
+        if not rows:
+            print("No gradient named {0}".format(parsed_args.like))
+            sys.exit(1)
+        if len(rows) > 1:
+            print_line(u"{0} gradients are named {1}; using {2}".format(
+                len(rows), index.names[rows[0]], index.label(rows[0])))
+        matches = index.nearest(rows[0], parsed_args.count, parsed_args.reverse)
+        elapsed = timeit.default_timer() - started
+        print("{0:>8}  gradient".format("RMS dE"))
+        for i, distance, backwards in matches:
+            print_line(u"{0:>8.2f}  {1}{2}".format(distance, index.label(i),
+                                                  " (reversed)" if backwards else ""))
+    elif parsed_args.duplicates:
+        pairs = index.duplicates(parsed_args.max_delta_e)
+        elapsed = timeit.default_timer() - started
+        for i, j, distance in pairs:
+            print_line(u"{0:>8.2f}  {1}  {2}".format(distance, index.label(i),
+                                                    index.label(j)))
+        print("{0} near-duplicate pairs".format(len(pairs)))
+    elif parsed_args.uniform:
+        rows = index.uniform()
+        elapsed = timeit.default_timer() - started
+        print_metrics(index, rows)
+    else:
+        rows = range(len(index))
+        elapsed = timeit.default_timer() - started
+        print_metrics(index, rows)
+    print("Query took {0:.1f} ms over {1} gradients".format(elapsed * 1e3, len(index)))
+
+    # Files that could not be read (eg damaged) are left out of the index
+    if failed:
+        sys.exit(1)
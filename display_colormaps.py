@@ -35,9 +35,6 @@ Miscellaneous:
     Colormaps that don't fit into the categories above.
 
 """
-import numpy as np
-import matplotlib.pyplot as plt
-
 
 cmaps = [('Sequential',     ['Blues', 'BuGn', 'BuPu',
                              'GnBu', 'Greens', 'Greys', 'Oranges', 'OrRd',
@@ -58,11 +55,15 @@ cmaps = [('Sequential',     ['Blues', 'BuGn', 'BuPu',
                              'gist_rainbow', 'hsv', 'flag', 'prism'])]
 
 
-nrows = max(len(cmap_list) for cmap_category, cmap_list in cmaps)
-gradient = np.linspace(0, 1, 256)
-gradient = np.vstack((gradient, gradient))
+def plot_color_gradients(cmap_category, cmap_list, nrows):
+    # Imported here, so that importing this module (eg for the cmaps list)
+    #  does not load a plotting backend
+    import numpy as np
+    import matplotlib.pyplot as plt
+
+    gradient = np.linspace(0, 1, 256)
+    gradient = np.vstack((gradient, gradient))
 
-def plot_color_gradients(cmap_category, cmap_list):
     fig, axes = plt.subplots(nrows=nrows)
     fig.subplots_adjust(top=0.95, bottom=0.01, left=0.2, right=0.99)
     axes[0].set_title(cmap_category + ' colormaps', fontsize=14)
@@ -78,7 +79,16 @@ def plot_color_gradients(cmap_category, cmap_list):
     for ax in axes:
         ax.set_axis_off()
 
-for cmap_category, cmap_list in cmaps:
-    plot_color_gradients(cmap_category, cmap_list)
 
-plt.show()
+def main():
+    import matplotlib.pyplot as plt
+
+    nrows = max(len(cmap_list) for cmap_category, cmap_list in cmaps)
+    for cmap_category, cmap_list in cmaps:
+        plot_color_gradients(cmap_category, cmap_list, nrows)
+
+    plt.show()
+
+
+if __name__ == "__main__":
+    main()
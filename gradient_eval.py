@@ -0,0 +1,123 @@
+"""
+Vectorized evaluation of gradients with opacity stops and midpoints, using
+NumPy.
+
+Photoshop gradients have separate color and opacity stops. Between two
+stops, the midpoint (Mdpn, in percent of the way from one to the next) is
+where the two are blended half and half. The midpoint of stop i applies to
+the segment between stops i - 1 and i, so that of the first stop is unused.
+
+Midpoints are modelled with knots: a segment whose midpoint is not 50% is
+split in two at the midpoint, with the mean of the end values there, and
+each half is interpolated linearly. Photoshop's smoothness setting (which
+bends the blend within each half) is not modelled.
+"""
+
+import numpy as np
+
+from gradient_store import DEFAULT_MIDPOINT
+
+
+def midpoint_knots(locations, values, midpoints=None):
+    """
+    Sort stops by location and add a knot at each segment midpoint that is
+    not 50%. values: (n, channels) or (n,); midpoints: percent per stop, NaN
+    where missing. Returns (knot locations, knot values) arrays
+    """
+    locations = np.asarray(locations, dtype=float)
+    values = np.asarray(values, dtype=float)
+    order = np.argsort(locations, kind="mergesort")
+    locations, values = locations[order], values[order]
+    if midpoints is None or len(locations) < 2:
+        return locations, values
+
+    midpoints = np.asarray(midpoints, dtype=float)[order][1:]
+    midpoints = np.clip(np.where(np.isnan(midpoints), DEFAULT_MIDPOINT, midpoints),
+                        0., 100.) / 100.
+    width = np.diff(locations)
+    split = np.flatnonzero((midpoints != 0.5) & (width > 0))
+    return (np.insert(locations, split + 1,
+                      locations[split] + midpoints[split] * width[split]),
+            np.insert(values, split + 1,
+                      (values[split] + values[split + 1]) / 2., axis=0))
+
+
+def interpolate(locations, values, samples, side="right"):
+    """
+    Piecewise linear interpolation of knots (locations increasing, with
+    repeats at hard edges) at an array of samples; beyond the ends, the end
+    values. At a hard edge, the value on the given side ("left" or "right").
+    Returns an array of shape samples.shape + values.shape[1:]
+    """
+    samples = np.asarray(samples, dtype=float)
+    if len(locations) == 1:
+        return np.broadcast_to(values[0], samples.shape + values.shape[1:]).copy()
+
+    i = np.clip(np.searchsorted(locations, samples, side) - 1,
+                0, len(locations) - 2)
+    start, end = locations[i], locations[i + 1]
+    width = end - start
+    past = samples > end if side == "left" else samples >= end
+    t = np.where(width > 0, (samples - start) / np.where(width > 0, width, 1.),
+                 past)
+    t = np.clip(t, 0., 1.).reshape(t.shape + (1,) * (values.ndim - 1))
+    # Exact at the knots, where t is 0 or 1
+    return (1. - t) * values[i] + t * values[i + 1]
+
+
+class Gradient(object):
+    """
+    Color and opacity of a gradient, ready to be evaluated anywhere in 0..1.
+    Calling it with an array of positions gives an array of RGBA values.
+    """
+    def __init__(self, color_locations, colors, color_midpoints=None,
+                 opacity_locations=(), opacities=(), opacity_midpoints=None):
+        """
+        color_locations, colors: positions (0..1) and (n, 3) RGB values (0..1)
+        opacity_locations, opacities: positions and opacities (0..1). Without
+            opacity stops the gradient is opaque
+        *_midpoints: Midpoints in percent, one per stop
+        """
+        self.color_locations, self.colors = midpoint_knots(
+            color_locations, np.reshape(colors, (-1, 3)), color_midpoints)
+        if len(opacity_locations):
+            self.opacity_locations, self.opacities = midpoint_knots(
+                opacity_locations, opacities, opacity_midpoints)
+        else:
+            self.opacity_locations, self.opacities = np.zeros(1), np.ones(1)
+
+    @property
+    def opaque(self):
+        return bool(np.all(self.opacities >= 1.))
+
+    def evaluate(self, samples, side="right"):
+        """RGBA values at samples, an array of positions in 0..1"""
+        samples = np.asarray(samples, dtype=float)
+        rgba = np.empty(samples.shape + (4,))
+        rgba[..., :3] = interpolate(self.color_locations, self.colors,
+                                    samples, side)
+        rgba[..., 3] = interpolate(self.opacity_locations, self.opacities,
+                                   samples, side)
+        return rgba
+
+    __call__ = evaluate
+
+    def knots(self):
+        """
+        Color and opacity knots merged into one list of RGBA stops, which
+        linear interpolation reproduces exactly over 0..1. Hard edges (in
+        color or opacity) get two stops at the same location.
+        Returns (locations, (n, 4) RGBA values)
+        """
+        locations = np.union1d(np.union1d(self.color_locations,
+                                          self.opacity_locations), (0., 1.))
+        locations = locations[(locations >= 0.) & (locations <= 1.)]
+        left = self.evaluate(locations, "left")
+        right = self.evaluate(locations, "right")
+        repeats = np.where(np.any(left != right, axis=1), 2, 1)
+
+        first = np.cumsum(repeats) - repeats
+        rgba = np.empty((repeats.sum(), 4))
+        rgba[first] = left
+        rgba[first + repeats - 1] = right
+        return np.repeat(locations, repeats), rgba
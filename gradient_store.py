@@ -0,0 +1,220 @@
+"""
+Compact, column-oriented storage for the color stops of many gradients.
+
+Rather than one dict per color stop, all stops are kept in a few packed
+arrays: locations, midpoints, palette codes (small ints indexing
+`palette_names`), and channel values (CHANNELS per stop, in the order given
+by PALETTE_KEYS). `offsets` marks where each gradient starts, so gradient i
+holds the stops offsets[i]:offsets[i + 1]. Opacity stops (location, opacity
+and midpoint) are kept the same way, delimited by `opacity_offsets`.
+Memory use is a few dozen bytes per stop.
+
+Indexing a GradientStore gives a GradientView, which can be used wherever a
+list of color stop dicts was expected; dicts are only built on demand.
+"""
+import array, itertools
+
+# Channel keys of each palette, in storage order
+PALETTE_KEYS = {"RGBC": ("Rd", "Grn", "Bl"),
+                "HSBC": ("H", "Strt", "Brgh"),
+                "CMYC": ("Cyn", "Mgnt", "Ylw", "Blck")}
+CHANNELS = 4
+
+# Marks a value that was missing from the file
+MISSING = float("nan")
+
+# Midpoint (Mdpn) of a stop blended evenly with its neighbour, in percent
+DEFAULT_MIDPOINT = 50.
+
+
+class GradientStore(object):
+    """Color stops of a sequence of gradients, in packed arrays"""
+    def __init__(self):
+        self.palette_names = []
+        self._palette_codes = {}
+        self.locations = array.array('d')
+        self.midpoints = array.array('d')
+        self.palettes = array.array('B')
+        self.channels = array.array('d')
+        self.offsets = array.array('L', [0])
+
+        self.opacity_locations = array.array('d')
+        self.opacities = array.array('d')
+        self.opacity_midpoints = array.array('d')
+        self.opacity_offsets = array.array('L', [0])
+
+    def _palette_code(self, palette):
+        try:
+            return self._palette_codes[palette]
+        except KeyError:
+            code = self._palette_codes[palette] = len(self.palette_names)
+            self.palette_names.append(palette)
+            return code
+
+    def append(self, stops, opacity_stops=()):
+        """
+        Add one gradient, given as color stop dicts (as read by GrdReader),
+        and optionally opacity stop dicts (with Lctn, Opct and Mdpn keys)
+        """
+        locations, palettes, channels = self.locations, self.palettes, self.channels
+        for stop in stops:
+            palette = stop["palette"]
+            keys = PALETTE_KEYS.get(palette, ())
+            locations.append(stop.get("Lctn", MISSING))
+            self.midpoints.append(stop.get("Mdpn", MISSING))
+            palettes.append(self._palette_code(palette))
+            channels.extend([stop.get(k, MISSING) for k in keys])
+            channels.extend([MISSING] * (CHANNELS - len(keys)))
+        self.offsets.append(len(locations))
+
+        for stop in opacity_stops:
+            self.opacity_locations.append(stop.get("Lctn", MISSING))
+            self.opacities.append(stop.get("Opct", MISSING))
+            self.opacity_midpoints.append(stop.get("Mdpn", MISSING))
+        self.opacity_offsets.append(len(self.opacity_locations))
+
+    @classmethod
+    def from_gradients(cls, gradients):
+        """Build a store from lists of color stop dicts"""
+        store = cls()
+        for stops in gradients:
+            store.append(stops)
+        return store
+
+    def extend(self, other):
+        """Append all gradients of another store, eg one decoded elsewhere"""
+        codes = [self._palette_code(palette) for palette in other.palette_names]
+        if codes == range(len(codes)):
+            self.palettes.extend(other.palettes)
+        else:
+            self.palettes.extend(array.array('B', [codes[code]
+                                                   for code in other.palettes]))
+        self.locations.extend(other.locations)
+        self.midpoints.extend(other.midpoints)
+        self.channels.extend(other.channels)
+        base = self.offsets.pop()
+        self.offsets.extend(base + offset for offset in other.offsets)
+        self.opacity_locations.extend(other.opacity_locations)
+        self.opacities.extend(other.opacities)
+        self.opacity_midpoints.extend(other.opacity_midpoints)
+        base = self.opacity_offsets.pop()
+        self.opacity_offsets.extend(base + offset for offset in other.opacity_offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        n = len(self)
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError("gradient index out of range")
+        return self._view(index)
+
+    def __iter__(self):
+        return (self._view(i) for i in range(len(self)))
+
+    def _view(self, i):
+        return GradientView(self, self.offsets[i], self.offsets[i + 1],
+                            self.opacity_offsets[i], self.opacity_offsets[i + 1])
+
+    def _arrays(self):
+        return (self.locations, self.midpoints, self.palettes, self.channels,
+                self.offsets, self.opacity_locations, self.opacities,
+                self.opacity_midpoints, self.opacity_offsets)
+
+    @property
+    def nbytes(self):
+        """Bytes used by the stop arrays"""
+        return sum(a.itemsize * len(a) for a in self._arrays())
+
+    def to_data(self):
+        """Palette names and packed array bytes, suitable for marshal"""
+        return (list(self.palette_names),) + tuple(a.tostring() for a in self._arrays())
+
+    @classmethod
+    def from_data(cls, data):
+        """Inverse of to_data"""
+        palette_names, arrays = data[0], data[1:]
+        store = cls()
+        for palette in palette_names:
+            store._palette_code(palette)
+        del store.offsets[:], store.opacity_offsets[:]
+        for a, string in zip(store._arrays(), arrays):
+            a.fromstring(string)
+        return store
+
+
+class GradientView(object):
+    """
+    The color stops of one gradient in a GradientStore. Behaves as a sequence
+    of color stop dicts, and gives direct access to its columns. Opacity
+    stops are in opacity_start:opacity_stop of the store's opacity columns.
+    """
+    __slots__ = ("store", "start", "stop", "opacity_start", "opacity_stop")
+
+    def __init__(self, store, start, stop, opacity_start=0, opacity_stop=0):
+        self.store = store
+        self.start = start
+        self.stop = stop
+        self.opacity_start = opacity_start
+        self.opacity_stop = opacity_stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    @property
+    def locations(self):
+        return self.store.locations[self.start:self.stop].tolist()
+
+    @property
+    def midpoints(self):
+        """Midpoint of each stop, in percent (NaN where missing)"""
+        return self.store.midpoints[self.start:self.stop].tolist()
+
+    @property
+    def opacity_stops(self):
+        """Opacity stops as dicts, with the keys found in the file"""
+        store = self.store
+        stops = []
+        for i in range(self.opacity_start, self.opacity_stop):
+            values = [("Lctn", store.opacity_locations[i]),
+                      ("Opct", store.opacities[i]),
+                      ("Mdpn", store.opacity_midpoints[i])]
+            stops.append(dict((k, v) for k, v in values if v == v))
+        return stops
+
+    @property
+    def palettes(self):
+        names = self.store.palette_names
+        return [names[code] for code in self.store.palettes[self.start:self.stop]]
+
+    def channel_values(self, index):
+        """Channel values of one stop, in PALETTE_KEYS order"""
+        stop = self.start + index
+        n = len(PALETTE_KEYS.get(self.store.palette_names[self.store.palettes[stop]], ()))
+        return self.store.channels[stop * CHANNELS:stop * CHANNELS + n].tolist()
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("color stop index out of range")
+        stop = self.start + index
+        palette = self.store.palette_names[self.store.palettes[stop]]
+        values = [("palette", palette), ("Lctn", self.store.locations[stop]),
+                  ("Mdpn", self.store.midpoints[stop])]
+        values.extend(itertools.izip(PALETTE_KEYS.get(palette, ()),
+                                     self.channel_values(index)))
+        # Leave out values that were missing, as the file did
+        return dict((k, v) for k, v in values if v == v)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+def as_view(gradient):
+    """A GradientView of `gradient`, which may also be a list of stop dicts"""
+    if isinstance(gradient, GradientView):
+        return gradient
+    return GradientStore.from_gradients([gradient])[0]
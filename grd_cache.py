@@ -0,0 +1,155 @@
+"""
+On-disk cache of parsed .grd files, so that unchanged files need not be
+parsed again.
+
+Entries are keyed by a hash of the file contents plus the parser version, and
+hold the decoded gradient names and color stops in compact binary form
+(zlib-compressed marshal data of the GradientStore arrays). The cache has a
+size cap; when it is exceeded the least recently used entries are evicted.
+"""
+import argparse, hashlib, marshal, os, zlib
+
+import gradient_store, grd_reader
+
+DEFAULT_MAX_BYTES = 256 * 2 ** 20
+ENTRY_EXTENSION = ".grdc"
+
+
+class GrdCache(object):
+    """Cache of parsed gradients, stored as one file per entry in cache_dir"""
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # Already exists, possibly created by another worker process
+            if not os.path.isdir(cache_dir):
+                raise
+
+    @staticmethod
+    def key(grd):
+        """Cache key for the contents of an open GrdReader"""
+        digest = hashlib.sha1(grd.buffer)
+        digest.update(":{0}".format(grd_reader.PARSER_VERSION))
+        return digest.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key + ENTRY_EXTENSION)
+
+    def load(self, grd):
+        """
+        Fill an unparsed GrdReader from the cache.
+        Returns True on a hit; on a miss the reader is left unchanged.
+        """
+        path = self._entry_path(self.key(grd))
+        try:
+            with open(path, 'rb') as f:
+                gradient_names, data = marshal.loads(zlib.decompress(f.read()))
+            gradients = gradient_store.GradientStore.from_data(data)
+        except (IOError, OSError, ValueError, EOFError, TypeError, zlib.error):
+            # Missing or unreadable entry: treat as a miss
+            return False
+
+        # Mark as recently used, for LRU eviction
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        grd.restore(gradient_names, gradients)
+        return True
+
+    def store(self, grd):
+        """
+        Save the results of a parsed GrdReader, then enforce the size cap.
+        Results of a damaged file (with diagnostics) are not stored, so that
+        a hit always means a complete parse.
+        Returns whether the results were stored
+        """
+        if grd.diagnostics:
+            return False
+        path = self._entry_path(self.key(grd))
+        data = zlib.compress(marshal.dumps((grd.gradient_names,
+                                            grd.gradients.to_data())))
+
+        # Write under a temporary name so readers never see a partial entry
+        tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+        self.evict()
+        return True
+
+    def invalidate(self, grd):
+        """Remove the entry for the current contents of a GrdReader, if any"""
+        try:
+            os.remove(self._entry_path(self.key(grd)))
+            return True
+        except OSError:
+            return False
+
+    def _entries(self):
+        """List (last used, size, path) of all entries, oldest first"""
+        entries = []
+        for fn in os.listdir(self.cache_dir):
+            if not fn.endswith(ENTRY_EXTENSION):
+                continue
+            path = os.path.join(self.cache_dir, fn)
+            try:
+                st = os.stat(path)
+            except OSError:  # Removed by another process
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return sorted(entries)
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits max_bytes"""
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Remove all entries"""
+        for _, _, path in self._entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def command_line():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cache_dir", help="Path to the cache directory")
+    parser.add_argument("--invalidate", nargs="+", default=[], metavar="FILENAME",
+                        help="Remove the entries for these .grd files")
+    parser.add_argument("--clear", action="store_true",
+                        help="Remove all entries")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    parsed_args = command_line()
+    cache = GrdCache(parsed_args.cache_dir)
+    if parsed_args.clear:
+        cache.clear()
+    for filename in parsed_args.invalidate:
+        try:
+            grd = grd_reader.GrdReader(filename)
+        except IOError:
+            print("File not found: {0}".format(filename))
+            continue
+        with grd:
+            if not cache.invalidate(grd):
+                print("No cache entry for {0}".format(filename))
@@ -0,0 +1,288 @@
+"""
+Parts shared by the single-file converters (matplotlib, JS, lookup table and
+binary): opening and parsing the input, unique colormap names, and the
+command-line options they have in common, with the conversion that handles
+them (incremental builds, the parse cache, profiling and stop simplification).
+Also the search for input files given as directories or glob patterns, used
+by the tools that read many files.
+"""
+import argparse, collections, fnmatch, glob, keyword, os, re, sys, unicodedata
+
+import build_manifest, grd_cache, grd_profile, grd_reader
+
+
+def argument_parser():
+    """Parser for the options of every converter; converters add their own"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filename",
+                        help="Path to an Adobe .grd file")
+    parser.add_argument("--engine", choices=grd_reader.COLOR_ENGINES,
+                        default="chroma",
+                        help="Color conversion engine (numpy is vectorized)")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Reuse parsed results cached in this directory")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Skip conversion if the input and options are "
+                             "unchanged since the last build")
+    parser.add_argument("--manifest", default=None,
+                        help="Build manifest used by --incremental "
+                             "(default: {0} next to the output)".format(
+                                 build_manifest.MANIFEST_NAME))
+    parser.add_argument("--max-error", type=float, default=None,
+                        help="Merge color stops that interpolation reproduces "
+                             "to within this error per RGB channel (0..1, eg "
+                             "0.004 for about 1/255). Requires NumPy")
+    parser.add_argument("--recover", action="store_true",
+                        help="Convert what can be read of a damaged file, "
+                             "dropping damaged gradients and listing the "
+                             "problems, rather than failing")
+    parser.add_argument("--profile", action="store_true",
+                        help="Print time spent per phase and per field type")
+    parser.add_argument("--profile-json", default=None, metavar="FILENAME",
+                        help="Save the profile to this JSON file")
+    return parser
+
+
+#### Functions to process the input file
+def open_file(filename, color_engine="chroma", profile=None, strict=True):
+    """
+    Open a grd file for reading, without parsing it yet
+    profile: Optional grd_profile.ParseProfile to record timings in
+    strict: Fail on a malformed file, rather than drop damaged gradients
+        (see GrdReader)
+    """
+    if os.path.splitext(filename)[1] != ".grd":
+        print("File must be an Adobe PS gradient file with .grd extension")
+        sys.exit(1)
+
+    try:
+        grd = grd_reader.GrdReader(filename, color_engine, profile,
+                                   strict=strict)
+    except IOError:
+        print "File not found"
+        sys.exit(1)
+
+    return grd
+
+
+def parse_file(filename, color_engine="chroma", cache=None, profile=None,
+               strict=True):
+    """
+    Parse a grd file to extract gradient information
+    cache: Optional grd_cache.GrdCache; parsing is skipped on a hit
+    strict: As for open_file
+    """
+    grd = open_file(filename, color_engine, profile, strict)
+    if cache is not None and cache.load(grd):
+        return grd
+
+    try:
+        grd.parse()
+    except Exception as e:
+        read_error(e)
+
+    if cache is not None:
+        cache.store(grd)
+    return grd
+
+
+def read_error(e):
+    """Report an error reading the input file, and exit"""
+    if isinstance(e, grd_reader.GrdFormatError):
+        print("Error occurred while reading file: {0}".format(e))
+        print("Use --recover to convert the gradients that can be read")
+    else:
+        print("Error occurred while reading file")
+    sys.exit(1)
+
+
+def print_diagnostics(grd):
+    """Warn about each damaged gradient dropped with --recover"""
+    for diagnostic in grd.diagnostics:
+        print(u"Warning: {0}".format(grd_reader.describe(diagnostic)).encode("utf-8"))
+
+
+def stream_outfile(write, out_fn, mode="w"):
+    """
+    Stream output to a temporary file with write(open file), then move it
+    to out_fn. If writing fails, eg on a damaged input, any previous out_fn
+    is left as it was.
+    """
+    tmp_fn = "{0}.{1}.tmp".format(out_fn, os.getpid())
+    try:
+        with open(tmp_fn, mode) as out_f:
+            write(out_f)
+        if os.path.exists(out_fn):
+            os.remove(out_fn)
+        os.rename(tmp_fn, out_fn)
+    except Exception:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+        raise
+
+
+def python_name(grd_name):
+    """Gradient names must be valid python variables and len > 0"""
+    if isinstance(grd_name, unicode):
+        # Keep the base letters of accented names (u"Caf\xe9" -> "Cafe")
+        grd_name = unicodedata.normalize("NFKD", grd_name).encode("ascii", "ignore")
+    name = re.sub("[^_A-Za-z][^_a-zA-Z0-9]*", "", grd_name)
+    return name if len(name) > 0 and not keyword.iskeyword(name) else "grd"
+
+
+def unique_grd_names(grd_names_list):
+    """Adobe GRD format allows gradient names to be non-unique.
+
+     Modify gradient names so that each can be referenced uniquely"""
+    return [name for name, _ in iter_unique_grd_names(
+        ((n, None) for n in grd_names_list), grd_names_list)]
+
+
+def iter_unique_grd_names(named_gradients, grd_names=None):
+    """
+    Streaming counterpart to unique_grd_names: yield (name, gradient) pairs,
+    with each name made a valid python name, unique as it arrives.
+    grd_names: Every gradient name in the file, if known in advance (see
+        GrdReader.scan_names). Each use of a repeated name then has its
+        index appended, as unique_grd_names does; otherwise the first use
+        of a name is kept, and only repeats are numbered.
+    A numbered name that is already taken by another gradient gets a
+    further number.
+    """
+    counter = collections.Counter(python_name(n) for n in grd_names or ())
+    # Names that will be used as they are, which numbered names must avoid
+    reserved = set(n for n, count in counter.items() if count == 1)
+    used = set()
+    for i, (grd_name, gradient) in enumerate(named_gradients):
+        name = python_name(grd_name)
+        if counter[name] > 1 or name in used:
+            numbered = name = "{}_{}".format(name, i)
+            suffix = 1
+            while name in used or name in reserved:
+                name = "{}_{}".format(numbered, suffix)
+                suffix += 1
+        used.add(name)
+        yield name, gradient
+
+
+def iter_named_gradients(grd):
+    """(unique name, color stops) of each gradient of a GrdReader, in order"""
+    return iter_unique_grd_names(grd.iter_gradients(), grd.scan_names())
+
+
+def find_grd_files(paths):
+    """Expand files, directories (searched recursively) and glob patterns"""
+    return [fn for fn, _ in search_paths(paths)]
+
+
+def search_paths(paths):
+    """
+    As find_grd_files, but returns (filename, root) pairs, where root is the
+    directory the file was found under: the directory argument, the fixed
+    leading directories of a glob pattern, or a file's own directory
+    """
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                found.extend((os.path.join(root, fn), path)
+                             for fn in sorted(fnmatch.filter(files, "*.grd")))
+        elif glob.has_magic(path):
+            found.extend((fn, _glob_root(path)) for fn in sorted(glob.glob(path)))
+        else:
+            found.append((path, os.path.dirname(path)))
+
+    # The same file may be reached by more than one path argument
+    seen = set()
+    unique = []
+    for fn, root in found:
+        if os.path.abspath(fn) not in seen:
+            seen.add(os.path.abspath(fn))
+            unique.append((fn, root))
+    return unique
+
+
+def _glob_root(pattern):
+    """Leading directories of a glob pattern, up to the first wildcard"""
+    parts = []
+    for part in pattern.split(os.sep):
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    return os.sep.join(parts) or os.curdir
+
+
+def generator_options(fmt, color_engine="chroma", max_error=None, **options):
+    """
+    Options that affect the output of a converter, as recorded in a build
+    manifest. Keyword arguments add the converter's own options.
+    """
+    options.update({"format": fmt,
+                    "engine": color_engine,
+                    "parser_version": grd_reader.PARSER_VERSION})
+    if max_error is not None:
+        options["max_error"] = max_error
+    return options
+
+
+def convert(parsed_args, extension, options, write_outfile, generate_outfile):
+    """
+    Convert parsed_args.filename to a file with the given extension, as
+    asked for by the options of argument_parser. Exits on errors.
+    options: As returned by generator_options
+    write_outfile: Function (grd, open file) writing the output
+    generate_outfile: Function (grd, output filename) writing the output
+    """
+    out_fn = os.path.splitext(parsed_args.filename)[0] + extension
+
+    manifest = None
+    if parsed_args.incremental:
+        manifest = build_manifest.BuildManifest(
+            parsed_args.manifest or os.path.join(os.path.dirname(out_fn),
+                                                 build_manifest.MANIFEST_NAME))
+        if manifest.is_current(parsed_args.filename, out_fn, options):
+            print("{0} is up to date".format(out_fn))
+            manifest.save()
+            sys.exit(0)
+
+    profile = None
+    if parsed_args.profile or parsed_args.profile_json is not None:
+        profile = grd_profile.ParseProfile()
+
+    strict = not parsed_args.recover
+    if parsed_args.cache_dir is not None:
+        grd = parse_file(parsed_args.filename, parsed_args.engine,
+                         grd_cache.GrdCache(parsed_args.cache_dir), profile,
+                         strict)
+    else:
+        # Without a cache, gradients are converted as they are read
+        grd = open_file(parsed_args.filename, parsed_args.engine, profile,
+                        strict)
+
+    grd.max_error = parsed_args.max_error
+
+    try:
+        with grd_profile.phase(profile, "write"):
+            if manifest is not None:
+                build_manifest.update_outfile(write_outfile, grd, out_fn)
+            else:
+                generate_outfile(grd, out_fn)
+    except Exception as e:
+        read_error(e)
+
+    print_diagnostics(grd)
+    # Outputs of a damaged file are rebuilt every time, rather than skipped
+    if manifest is not None:
+        if not grd.diagnostics:
+            manifest.record(parsed_args.filename, out_fn, options)
+        manifest.save()
+
+    if parsed_args.max_error is not None:
+        print(grd.simplify_summary())
+
+    if profile is not None:
+        if parsed_args.profile:
+            profile.report()
+        if parsed_args.profile_json is not None:
+            profile.save(parsed_args.profile_json)
@@ -0,0 +1,244 @@
+"""
+Fuzz the .grd decoder with damaged files, and check that its worst-case
+parse time grows linearly with file size.
+
+Fuzzing mutates a synthetic file (see synthetic_grd) in ways uploaded files
+go wrong: flipped bytes, lengths and counts overwritten with extreme values,
+unknown type tags, truncation, and inserted or repeated data. Every mutant
+must parse without raising (and raise nothing but GrdFormatError in strict
+mode) within a time limit proportional to its size, and each problem found
+must be printable as the converters print it.
+
+Throughput is measured at several file sizes, on a valid file and on
+damaged ones: one in which every gradient is corrupt, random bytes after a
+valid header, and random bytes with a gradient header every few bytes, so
+that the decoder has to resynchronise over and over.
+The time per megabyte must not grow by more than a tolerance from the
+smallest size to the largest.
+"""
+import argparse, io, json, random, struct, sys, timeit, traceback
+
+import grd_reader, synthetic_grd
+
+DEFAULT_ITERATIONS = 1000
+DEFAULT_SIZES = (50, 200, 800)  # Gradients per file
+DEFAULT_TOLERANCE = 2.  # Allowed growth in time per byte, smallest to largest
+MAX_SECONDS_PER_MB = 20.  # Parse time limit for a single mutant
+
+_EXTREME_LONGS = (0, 1, 3, 0x7fffffff, 0x80000000, 0xfffffffe, 0xffffffff)
+_TAGS = sorted(["patt", "desc", "VlLs", "TEXT", "Objc", "UntF", "bool",
+                "long", "doub", "enum", "tdta"])
+
+
+def command_line():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS,
+                        help="Number of mutated files to parse")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed, for repeatable runs")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES),
+                        help="Numbers of gradients per file for the "
+                             "throughput test")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed growth in time per byte from the smallest "
+                             "size to the largest (default: %(default)s)")
+    parser.add_argument("--json", default=None, metavar="FILENAME",
+                        help="Save the results to this JSON file")
+
+    return parser.parse_args()
+
+
+def synthetic_file(n_gradients, n_stops=8, seed=0):
+    """Contents of a synthetic .grd file"""
+    out_f = io.BytesIO()
+    synthetic_grd.write_grd(out_f, n_gradients, n_stops, depth=1, seed=seed)
+    return out_f.getvalue()
+
+
+def _flip(data, rng):
+    data = bytearray(data)
+    for _ in range(rng.randint(1, 8)):
+        data[rng.randrange(len(data))] ^= 1 << rng.randrange(8)
+    return bytes(data)
+
+
+def _extreme_long(data, rng):
+    position = rng.randrange(len(data) - 4)
+    return (data[:position] + struct.pack(">L", rng.choice(_EXTREME_LONGS)) +
+            data[position + 4:])
+
+
+def _retag(data, rng):
+    """Replace a type tag with another, or an unknown one"""
+    tag = rng.choice(_TAGS)
+    position = data.find(tag, rng.randrange(len(data)))
+    if position < 0:
+        return data
+    return data[:position] + rng.choice(_TAGS + ["XXXX", "obj ", "\0\0\0\0"]) + data[position + 4:]
+
+
+def _truncate(data, rng):
+    return data[:rng.randrange(len(data))]
+
+
+def _insert(data, rng):
+    position = rng.randrange(len(data))
+    garbage = bytes(bytearray(rng.randrange(256) for _ in range(rng.randint(1, 64))))
+    return data[:position] + garbage + data[position:]
+
+
+def _repeat(data, rng):
+    start = rng.randrange(len(data))
+    stop = min(len(data), start + rng.randint(1, 256))
+    return data[:stop] + data[start:stop] + data[stop:]
+
+
+MUTATIONS = {"flip": _flip, "extreme_long": _extreme_long, "retag": _retag,
+             "truncate": _truncate, "insert": _insert, "repeat": _repeat}
+
+
+def parse(data, strict=False):
+    """Parse a buffer. Returns (seconds, GrdReader)"""
+    grd = grd_reader.GrdReader.from_buffer(data, strict=strict)
+    started = timeit.default_timer()
+    try:
+        grd.parse()
+    finally:
+        elapsed = timeit.default_timer() - started
+    return elapsed, grd
+
+
+def fuzz(data, iterations=DEFAULT_ITERATIONS, seed=0):
+    """
+    Parse `iterations` mutants of data, leniently and strictly.
+    Returns (list of failure dicts, {mutation: diagnostics found}, slowest
+    parse in seconds per MB)
+    """
+    rng = random.Random(seed)
+    failures = []
+    diagnostics = dict((name, 0) for name in MUTATIONS)
+    slowest = 0.
+    for i in range(iterations):
+        name = rng.choice(sorted(MUTATIONS))
+        mutant = MUTATIONS[name](data, rng)
+        try:
+            elapsed, grd = parse(mutant)
+            diagnostics[name] += len(grd.diagnostics)
+            for diagnostic in grd.diagnostics:
+                # As printed by the converters; must not raise either
+                grd_reader.describe(diagnostic)
+            try:
+                parse(mutant, strict=True)
+            except grd_reader.GrdFormatError:
+                pass
+        except Exception:
+            failures.append({"iteration": i, "mutation": name,
+                             "error": traceback.format_exc()})
+            continue
+        seconds_per_mb = elapsed / max(len(mutant), 1) * 1e6
+        slowest = max(slowest, seconds_per_mb)
+        if seconds_per_mb > MAX_SECONDS_PER_MB:
+            failures.append({"iteration": i, "mutation": name,
+                             "error": "took {0:.2f} s/MB".format(seconds_per_mb)})
+    return failures, diagnostics, slowest
+
+
+def corrupt_gradients(data):
+    """Damage every gradient right after its Grad header"""
+    return data.replace("GradObjc", "GradObjc\xff\xff\xff\xff")
+
+
+def random_body(data, seed=0):
+    """Random bytes of the same size after a valid header"""
+    rng = random.Random(seed)
+    return data[:28] + bytes(bytearray(rng.randrange(256)
+                                       for _ in range(len(data) - 28)))
+
+
+def headers_in_noise(data, seed=0, spacing=64):
+    """
+    Random bytes of the same size after a valid header, with a Grad header
+    every `spacing` bytes, so that each resynchronisation lands on garbage
+    """
+    rng = random.Random(seed)
+    chunks = [data[:28]]
+    for _ in range((len(data) - 28) // spacing):
+        chunks.append("\0\0\0\0GradObjc")
+        chunks.append(bytes(bytearray(rng.randrange(256)
+                                      for _ in range(spacing - 12))))
+    return b"".join(chunks)
+
+
+VARIANTS = (("valid", lambda data: data),
+            ("corrupt gradients", corrupt_gradients),
+            ("random", random_body),
+            ("headers in noise", headers_in_noise))
+
+
+def throughput(sizes=DEFAULT_SIZES, repeat=3):
+    """
+    Time parsing each variant of synthetic files of each size (best of
+    `repeat`). Returns a list of result dicts, smallest size first
+    """
+    results = []
+    for n_gradients in sorted(sizes):
+        data = synthetic_file(n_gradients)
+        for variant, make in VARIANTS:
+            variant_data = make(data)
+            runs = [parse(variant_data) for _ in range(repeat)]
+            seconds = min(elapsed for elapsed, _ in runs)
+            results.append({"variant": variant,
+                            "gradients": n_gradients,
+                            "bytes": len(variant_data),
+                            "seconds": seconds,
+                            "seconds_per_mb": seconds / len(variant_data) * 1e6,
+                            "diagnostics": len(runs[0][1].diagnostics)})
+    return results
+
+
+def nonlinear_variants(results, tolerance=DEFAULT_TOLERANCE):
+    """Variants whose time per byte grew by more than tolerance over the sizes"""
+    problems = []
+    for variant, _ in VARIANTS:
+        rates = [result["seconds_per_mb"] for result in results
+                 if result["variant"] == variant]
+        if len(rates) > 1 and rates[-1] > rates[0] * tolerance:
+            problems.append("{0}: {1:.3f} s/MB at the largest size, {2:.3f} at "
+                            "the smallest".format(variant, rates[-1], rates[0]))
+    return problems
+
+
+def report(results, out=None):
+    out = out or sys.stdout
+    out.write("{0:<18} {1:>9} {2:>10} {3:>9} {4:>8} {5:>11}\n".format(
+        "variant", "gradients", "bytes", "seconds", "s/MB", "diagnostics"))
+    for result in results:
+        out.write("{variant:<18} {gradients:>9} {bytes:>10} {seconds:>9.3f} "
+                  "{seconds_per_mb:>8.3f} {diagnostics:>11}\n".format(**result))
+
+
+if __name__ == "__main__":
+    parsed_args = command_line()
+
+    failures, diagnostics, slowest = fuzz(synthetic_file(20), parsed_args.iterations,
+                                          parsed_args.seed)
+    print("Parsed {0} mutants, slowest {1:.2f} s/MB; diagnostics per mutation: "
+          "{2}".format(parsed_args.iterations, slowest, ", ".join(
+              "{0} {1}".format(name, count)
+              for name, count in sorted(diagnostics.items()))))
+    for failure in failures:
+        print("FAILED  iteration {iteration} ({mutation}): {error}".format(**failure))
+
+    results = throughput(parsed_args.sizes)
+    report(results)
+    problems = nonlinear_variants(results, parsed_args.tolerance)
+    for problem in problems:
+        print("FAILED  not linear: " + problem)
+
+    if parsed_args.json is not None:
+        with open(parsed_args.json, "w") as f:
+            json.dump({"failures": failures, "throughput": results}, f,
+                      indent=1, sort_keys=True)
+
+    if failures or problems:
+        sys.exit(1)
@@ -0,0 +1,145 @@
+"""
+Index of the gradients in a .grd file, for random access to single
+gradients without parsing the whole file.
+
+The index records the name of each gradient and the byte offset of its Grad
+object. It is saved as JSON next to the file (FILE.grd.idx), along with the
+size and mtime of the file it was built from, and rebuilt when those change.
+"""
+import argparse, json, os, pprint, sys
+
+import grd_reader
+
+INDEX_EXTENSION = ".idx"
+INDEX_VERSION = 1
+
+
+def index_filename(filename):
+    return filename + INDEX_EXTENSION
+
+
+class GrdIndex(object):
+    """Names and Grad object offsets of the gradients in one .grd file"""
+    def __init__(self, filename, names, offsets):
+        self.filename = filename
+        self.names = names
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, grd):
+        """Index an open GrdReader, in one pass over the file"""
+        names, offsets = [], []
+        for name, offset in grd.iter_index():
+            names.append(name)
+            offsets.append(offset)
+        return cls(grd.filename, names, offsets)
+
+    @classmethod
+    def load(cls, filename):
+        """Load the saved index of a .grd file. Returns None if it is missing or stale"""
+        try:
+            with open(index_filename(filename), 'r') as f:
+                data = json.load(f)
+            st = os.stat(filename)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if (data.get("version") != INDEX_VERSION or
+                data.get("parser_version") != grd_reader.PARSER_VERSION or
+                data.get("size") != st.st_size or data.get("mtime") != st.st_mtime):
+            return None
+        return cls(filename, data["names"], data["offsets"])
+
+    @classmethod
+    def open(cls, filename, grd=None):
+        """
+        Load the saved index of a .grd file, or build and save it
+        grd: Optional GrdReader already open on the file
+        """
+        index = cls.load(filename)
+        if index is None:
+            if grd is None:
+                with grd_reader.GrdReader(filename) as grd:
+                    index = cls.build(grd)
+            else:
+                index = cls.build(grd)
+            index.save()
+        return index
+
+    def save(self):
+        """Write the index next to the .grd file"""
+        st = os.stat(self.filename)
+        data = {"version": INDEX_VERSION,
+                "parser_version": grd_reader.PARSER_VERSION,
+                "size": st.st_size,
+                "mtime": st.st_mtime,
+                "names": self.names,
+                "offsets": self.offsets}
+        tmp_fn = "{0}.{1}.tmp".format(index_filename(self.filename), os.getpid())
+        with open(tmp_fn, 'w') as f:
+            json.dump(data, f)
+        if os.path.exists(index_filename(self.filename)):
+            os.remove(index_filename(self.filename))
+        os.rename(tmp_fn, index_filename(self.filename))
+
+    def find(self, name):
+        """Offsets of all gradients with this name (names need not be unique)"""
+        return [offset for n, offset in zip(self.names, self.offsets) if n == name]
+
+
+def read_gradient(grd, name, index=None):
+    """
+    Decode the first gradient called `name` from an open GrdReader, using
+    the file's saved index (built if necessary). Returns its color stops
+    """
+    if index is None:
+        index = GrdIndex.open(grd.filename)
+    offsets = index.find(name)
+    if not offsets:
+        raise KeyError(name)
+    return grd.read_gradient_at(offsets[0])[1]
+
+
+def command_line():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filename",
+                        help="Path to an Adobe .grd file")
+    parser.add_argument("--name", default=None,
+                        help="Print the colormap of the gradient with this name, "
+                             "rather than listing all gradients")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Rebuild the index even if it is up to date")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    parsed_args = command_line()
+    try:
+        grd = grd_reader.GrdReader(parsed_args.filename)
+    except IOError:
+        print("File not found")
+        sys.exit(1)
+
+    with grd:
+        try:
+            if parsed_args.rebuild:
+                index = GrdIndex.build(grd)
+                index.save()
+            else:
+                index = GrdIndex.open(parsed_args.filename, grd)
+        except grd_reader.GrdFormatError as e:
+            # A damaged file is not indexed, as gradients would be missing
+            print("Error occurred while reading file: {0}".format(e))
+            sys.exit(1)
+
+        if parsed_args.name is None:
+            for name, offset in zip(index.names, index.offsets):
+                print(u"{0:>10} {1}".format(offset, name).encode("utf-8"))
+        else:
+            try:
+                gradient = read_gradient(grd, parsed_args.name.decode("utf-8"), index)
+            except KeyError:
+                print("No gradient named {0}".format(parsed_args.name))
+                sys.exit(1)
+            pprint.pprint(grd.grd_to_cmap(gradient))
@@ -0,0 +1,258 @@
+"""
+Parse one large .grd file on several processes.
+
+Parsing is split in two phases. First, a search of the file (at the speed of
+str.find) lists every position that looks like the header of a Grad object.
+Runs of consecutive gradients are then decoded from there by a pool of
+worker processes, each of which memory-maps the file, so that its contents
+are shared through the page cache rather than copied to every worker.
+
+Workers report where each Grad object ends, so the main process can then
+walk the descriptor tree structurally, jumping over the gradients, to check
+that the search found exactly the Grad objects a serial parse would (a
+header could also appear inside some other field's data). Results are merged
+in file order, so names and gradients are identical to those of
+GrdReader.parse().
+
+Files that the walk cannot account for (malformed ones, gradient fields
+outside of a Grad object, or misplaced headers) are parsed serially instead.
+"""
+import argparse, mmap, multiprocessing, struct, sys, timeit
+
+from concurrent import futures
+
+import gradient_store, grd_profile, grd_reader
+
+# Files with fewer gradients are parsed serially; workers cost more to start
+MIN_GRADIENTS = 64
+# Runs of gradients per worker process, so that slow runs even out
+RUNS_PER_WORKER = 4
+
+_LONG = struct.Struct('>L')
+
+# Bytes taken by fixed-size leaf values, after their type tag
+_FIXED_SIZES = {"patt": 0, "bool": 1, "long": 4, "doub": 8, "UntF": 12,
+                "desc": 26}
+# Fields that hold the values of a gradient, if found outside a Grad object
+_GRADIENT_PARTS = {"Clr", "Clrs", "Trns", "Nm", "Lctn", "Mdpn",
+                   "Opct"} | grd_reader.COLOR_TERMS
+
+
+def command_line():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filename",
+                        help="Path to an Adobe .grd file")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of worker processes (default: one per CPU)")
+    parser.add_argument("--compare", action="store_true",
+                        help="Also parse serially, and check that the results "
+                             "are identical")
+
+    return parser.parse_args()
+
+
+def _skip_key(buf, offset):
+    """Offset after a key (length, then characters; 0 stands for 4)"""
+    [size] = _LONG.unpack_from(buf, offset)
+    return offset + 4 + (size or 4)
+
+
+def walk_structure(buf, gradient_ends, offset=28):
+    """
+    Walk the descriptor tree as GrdReader._decode does, but without decoding
+    values, and jumping from the start of each Grad object to its end as
+    given by gradient_ends ({start offset: end offset}).
+    Returns the offsets of the Grad objects, in file order. Raises
+    GrdFormatError where the file is malformed, where a Grad object is
+    missing from gradient_ends, or where values that belong to a gradient
+    lie outside of a Grad object (a serial parse would attach them to a
+    neighbouring gradient).
+    """
+    unpack_long = _LONG.unpack_from
+    end = len(buf)
+    gradients = []
+
+    # As in GrdReader._decode: fields left and whether in a list, for the
+    #  innermost container; enclosing ones are stacked
+    left, in_list = -1, False
+    stack = []
+    try:
+        while True:
+            if left == 0:
+                if not stack:
+                    break
+                left, in_list = stack.pop()
+                continue
+            elif offset >= end:
+                if left > 0:
+                    raise grd_reader.GrdFormatError("Container ends early",
+                                                    "truncated", offset)
+                break
+            elif left > 0:
+                left -= 1
+
+            field_offset = offset
+            name = None
+            if not in_list:
+                [nlen] = unpack_long(buf, offset)
+                nlen = nlen or 4
+                if nlen > grd_reader.MAX_KEY_LENGTH:
+                    raise grd_reader.GrdFormatError("Key length {0}".format(nlen),
+                                                    "bad_length", offset)
+                name = buf[offset + 4:offset + 4 + nlen].strip()
+                offset += 4 + nlen
+            field_type = buf[offset:offset + 4]
+            offset += 4
+
+            if name in _GRADIENT_PARTS:
+                raise grd_reader.GrdFormatError(
+                    "{0} outside of a gradient".format(name), "structure",
+                    field_offset)
+
+            size = _FIXED_SIZES.get(field_type)
+            if size is not None:
+                offset += size
+            elif field_type == "TEXT":
+                offset += 4 + 2 * unpack_long(buf, offset)[0]
+            elif field_type == "tdta":
+                offset += 4 + unpack_long(buf, offset)[0]
+            elif field_type == "enum":
+                offset = _skip_key(buf, _skip_key(buf, offset))
+            elif field_type == "Objc" and name == "Grad":
+                if gradient_ends.get(field_offset) is None:
+                    raise grd_reader.GrdFormatError(
+                        "Grad object not decoded", "structure", field_offset)
+                offset = gradient_ends[field_offset]
+                gradients.append(field_offset)
+            elif field_type in grd_reader.CONTAINER_TYPES:
+                is_list = field_type == "VlLs"
+                if not is_list:
+                    # Display name (UTF-16) and class id
+                    offset += 4 + 2 * unpack_long(buf, offset)[0]
+                    offset = _skip_key(buf, offset)
+                [count] = unpack_long(buf, offset)
+                offset += 4
+                if count * (grd_reader._MIN_ITEM_SIZE if is_list else
+                            grd_reader._MIN_FIELD_SIZE) > end - offset:
+                    raise grd_reader.GrdFormatError(
+                        "{0} of {1} fields does not fit in the file".format(
+                            field_type, count), "bad_length", field_offset)
+                stack.append((left, in_list))
+                left, in_list = count, is_list
+            else:
+                raise grd_reader.GrdFormatError(
+                    "Unknown field type {0!r}".format(field_type),
+                    "unknown_type", field_offset)
+            if offset > end:
+                raise grd_reader.GrdFormatError("Field ends early", "truncated",
+                                                field_offset)
+    except struct.error:
+        raise grd_reader.GrdFormatError("Field ends early", "truncated", offset)
+    return gradients
+
+
+def decode_gradients(filename, offsets):
+    """
+    Decode the gradients at `offsets` of a .grd file. Runs in a worker
+    process, which maps the file itself. Malformed gradients don't raise;
+    their end offset is None, so the structural walk rejects the file.
+    Returns (names, GradientStore data, end offset of each Grad object)
+    """
+    with grd_reader.GrdReader(filename, strict=False) as grd:
+        names, store, ends = grd.read_gradients_at(offsets)
+    return names, store.to_data(), ends
+
+
+def split_runs(offsets, n_runs):
+    """Split offsets into at most n_runs consecutive runs of similar length"""
+    n_runs = max(1, min(n_runs, len(offsets)))
+    bounds = [len(offsets) * i // n_runs for i in range(n_runs + 1)]
+    return [offsets[start:stop] for start, stop in zip(bounds, bounds[1:])]
+
+
+def parse_parallel(grd, workers=None, executor=None, min_gradients=MIN_GRADIENTS):
+    """
+    Parse an open GrdReader, decoding its gradients on worker processes.
+    The results are loaded into grd as if grd.parse() had been called.
+    Buffers that are not backed by a file, small files, and files that the
+    structural walk cannot account for are parsed serially.
+    workers: Number of processes, if no executor is given (default: one
+        per CPU)
+    executor: concurrent.futures process pool to reuse between files
+    Returns whether the file was decoded in parallel. A malformed file is
+    handled as by grd.parse(): GrdFormatError, unless grd is not strict.
+    """
+    buf = grd.buffer
+    offsets = []
+    if isinstance(buf, mmap.mmap) and buf[:4] == grd_reader.MAGIC:
+        with grd_profile.phase(grd.profile, "scan"):
+            offsets = grd_reader.find_gradient_headers(buf)
+    if len(offsets) < min_gradients:
+        grd.parse()
+        return False
+
+    workers = workers or multiprocessing.cpu_count()
+    own_executor = executor is None
+    if own_executor:
+        executor = futures.ProcessPoolExecutor(max_workers=workers)
+    try:
+        runs = split_runs(offsets, workers * RUNS_PER_WORKER)
+        results = [executor.submit(decode_gradients, grd.filename, run)
+                   for run in runs]
+        with grd_profile.phase(grd.profile, "decode"):
+            results = [result.result() for result in results]
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    gradient_ends = {}
+    for run, (_, _, ends) in zip(runs, results):
+        gradient_ends.update(zip(run, ends))
+    try:
+        with grd_profile.phase(grd.profile, "scan"):
+            found = walk_structure(buf, gradient_ends)
+    except grd_reader.GrdFormatError:
+        found = None
+    if found != offsets:
+        # A serial parse decides what the file holds, and records any problems
+        grd.parse()
+        return False
+
+    names = []
+    store = gradient_store.GradientStore()
+    with grd_profile.phase(grd.profile, "merge"):
+        for run_names, store_data, _ in results:
+            names.extend(run_names)
+            store.extend(gradient_store.GradientStore.from_data(store_data))
+    grd.restore(names, store)
+    return True
+
+
+if __name__ == "__main__":
+    parsed_args = command_line()
+    try:
+        grd = grd_reader.GrdReader(parsed_args.filename)
+    except IOError:
+        print("File not found")
+        sys.exit(1)
+
+    started = timeit.default_timer()
+    try:
+        parallel = parse_parallel(grd, parsed_args.workers)
+    except grd_reader.GrdFormatError as e:
+        print("Error occurred while reading file: {0}".format(e))
+        sys.exit(1)
+    elapsed = timeit.default_timer() - started
+    print("Parsed {0} gradients {1} in {2:.2f} s".format(
+        len(grd.gradients), "in parallel" if parallel else "serially", elapsed))
+
+    if parsed_args.compare:
+        serial = grd_reader.GrdReader(parsed_args.filename)
+        started = timeit.default_timer()
+        serial.parse()
+        print("Parsed serially in {0:.2f} s".format(timeit.default_timer() - started))
+        if (serial.gradient_names != grd.gradient_names or
+                serial.gradients.to_data() != grd.gradients.to_data()):
+            print("FAILED  results differ from a serial parse")
+            sys.exit(1)
+        print("Results are identical")
@@ -0,0 +1,144 @@
+"""
+Minimal staged pipeline: pools of threads connected by bounded queues, so
+that I/O-bound stages (reading inputs, writing outputs) overlap with work
+done elsewhere, and a slow stage holds back the ones feeding it rather than
+letting items pile up in memory.
+
+Each stage records how long its threads spent working, waiting for input
+and waiting for room downstream, which shows where the bottleneck is.
+"""
+import Queue, sys, threading, timeit
+
+_DONE = object()  # Sent down a queue when no more items will follow
+
+DEFAULT_QUEUE_SIZE = 8
+
+
+class Stage(object):
+    """
+    A pool of `workers` threads applying func to items taken from inbox.
+    Results are put on outbox (if any), unless func returns None.
+    """
+    def __init__(self, name, func, workers, inbox, outbox=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.inbox = inbox
+        self.outbox = outbox
+
+        self.items = 0
+        self.busy = 0.  # Seconds, summed over threads
+        self.waiting_input = 0.
+        self.waiting_output = 0.
+        self.error = None  # First exception that escaped func
+
+        self._lock = threading.Lock()
+        self._running = workers
+        self._threads = []
+        self._clock = timeit.default_timer
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run,
+                                      name="{0}-{1}".format(self.name, i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        clock = self._clock
+        busy = waiting_input = waiting_output = 0.
+        items = 0
+        try:
+            while True:
+                started = clock()
+                item = self.inbox.get()
+                waiting_input += clock() - started
+                if item is _DONE:
+                    # Pass it on to the other threads of this stage
+                    self.inbox.put(_DONE)
+                    break
+
+                started = clock()
+                result = self.func(item)
+                busy += clock() - started
+                items += 1
+
+                if self.outbox is not None and result is not None:
+                    started = clock()
+                    self.outbox.put(result)
+                    waiting_output += clock() - started
+        except Exception:
+            with self._lock:
+                if self.error is None:
+                    self.error = sys.exc_info()[1]
+            # Keep draining, so upstream stages are not blocked forever
+            while self.inbox.get() is not _DONE:
+                pass
+            self.inbox.put(_DONE)
+        finally:
+            with self._lock:
+                self.items += items
+                self.busy += busy
+                self.waiting_input += waiting_input
+                self.waiting_output += waiting_output
+                self._running -= 1
+                last = self._running == 0
+            if last and self.outbox is not None:
+                self.outbox.put(_DONE)
+
+    def utilisation(self, elapsed):
+        """Fraction of the available thread time spent working"""
+        return self.busy / max(elapsed * self.workers, 1e-9)
+
+
+class Pipeline(object):
+    """
+    Stages run in sequence over a stream of items. Build with add_stage,
+    then run() with the input items.
+    """
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.stages = []
+        self.elapsed = 0.
+        self._inbox = Queue.Queue(queue_size)
+
+    def add_stage(self, name, func, workers=1):
+        """Add a stage after the existing ones. The last stage's results are dropped"""
+        inbox = self.stages[-1].outbox if self.stages else self._inbox
+        stage = Stage(name, func, workers, inbox, Queue.Queue(self.queue_size))
+        self.stages.append(stage)
+        return stage
+
+    def run(self, items):
+        """Feed items through every stage, and wait for them all to finish"""
+        self.stages[-1].outbox = None
+        started = timeit.default_timer()
+        for stage in self.stages:
+            stage.start()
+        for item in items:
+            self._inbox.put(item)
+        self._inbox.put(_DONE)
+        for stage in self.stages:
+            stage.join()
+        self.elapsed = timeit.default_timer() - started
+
+        for stage in self.stages:
+            if stage.error is not None:
+                raise stage.error
+
+    def report(self, out=None):
+        """Print per-stage utilisation and waiting times"""
+        out = out or sys.stdout
+        out.write("{0:<8} {1:>7} {2:>7} {3:>9} {4:>6} {5:>11} {6:>12}\n".format(
+            "stage", "threads", "items", "busy s", "util", "wait input",
+            "wait output"))
+        for stage in self.stages:
+            out.write("{0:<8} {1:>7} {2:>7} {3:>9.3f} {4:>5.0%} {5:>11.3f} {6:>12.3f}\n".format(
+                stage.name, stage.workers, stage.items, stage.busy,
+                stage.utilisation(self.elapsed), stage.waiting_input,
+                stage.waiting_output))
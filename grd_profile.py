@@ -0,0 +1,135 @@
+"""
+Opt-in profiling of .grd parsing and conversion.
+
+A ParseProfile passed to GrdReader records, for each field type tag, how
+many fields were decoded, how many payload bytes they took up and the time
+spent in their handlers. It also records the time spent in each phase of a
+conversion (read, decode, convert, write). Phases may nest (gradients are
+decoded and converted while the output is written), so each phase is only
+charged for the time not spent in an inner one, and the phase times add up
+to the total.
+"""
+import contextlib, functools, json, sys, timeit
+
+
+class ParseProfile(object):
+    """Counters and timers for one or more parses"""
+    def __init__(self):
+        self.fields = {}  # tag: [count, bytes, seconds]
+        self.phases = {}  # name: [calls, seconds]
+        self._active = []  # [name, started] of open phases, innermost last
+        self._clock = timeit.default_timer
+
+    def _enter(self, name):
+        now = self._clock()
+        if self._active:
+            self._charge(self._active[-1], now)
+        self._active.append([name, now])
+        self.phases.setdefault(name, [0, 0.])[0] += 1
+
+    def _exit(self):
+        now = self._clock()
+        self._charge(self._active.pop(), now)
+        if self._active:
+            # Resume timing the enclosing phase
+            self._active[-1][1] = now
+
+    def _charge(self, active, now):
+        name, started = active
+        self.phases[name][1] += now - started
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time the enclosed block as phase `name`"""
+        self._enter(name)
+        try:
+            yield
+        finally:
+            self._exit()
+
+    def timed(self, name, iterator):
+        """Wrap an iterator, timing each step of it as phase `name`"""
+        iterator = iter(iterator)
+        while True:
+            self._enter(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._exit()
+            yield item
+
+    def wrap_handler(self, tag, handler, sized=True):
+        """
+        Wrap a GrdReader field handler so that calls to it are counted and
+        timed under `tag`. Handlers return the offset after the field (or a
+        tuple starting with it), from which the payload size is taken.
+        """
+        stats = self.fields.setdefault(tag, [0, 0, 0.])
+        clock = self._clock
+
+        @functools.wraps(handler)
+        def profiled_handler(buf, offset, name, shift):
+            started = clock()
+            result = handler(buf, offset, name, shift)
+            stats[2] += clock() - started
+            stats[0] += 1
+            if sized:
+                stats[1] += (result[0] if type(result) is tuple else result) - offset
+            return result
+        return profiled_handler
+
+    def to_dict(self):
+        return {"phases": dict((name, {"calls": calls, "seconds": seconds})
+                               for name, (calls, seconds) in self.phases.items()),
+                "fields": dict((tag, {"count": count, "bytes": nbytes,
+                                      "seconds": seconds})
+                               for tag, (count, nbytes, seconds) in self.fields.items())}
+
+    def save(self, filename):
+        """Export the results as JSON"""
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1, sort_keys=True)
+
+    def report(self, out=None):
+        """Print the results as tables, slowest first"""
+        out = out or sys.stdout
+        out.write("{0:<10} {1:>8} {2:>10}\n".format("phase", "calls", "seconds"))
+        for name, (calls, seconds) in sorted(self.phases.items(),
+                                             key=lambda item: -item[1][1]):
+            out.write("{0:<10} {1:>8} {2:>10.4f}\n".format(name, calls, seconds))
+        total = sum(seconds for _, seconds in self.phases.values())
+        out.write("{0:<10} {1:>8} {2:>10.4f}\n\n".format("total", "", total))
+
+        out.write("{0:<10} {1:>8} {2:>10} {3:>10} {4:>10}\n".format(
+            "field", "count", "bytes", "seconds", "us/field"))
+        for tag, (count, nbytes, seconds) in sorted(self.fields.items(),
+                                                    key=lambda item: -item[1][2]):
+            if count == 0:
+                continue
+            out.write("{0:<10} {1:>8} {2:>10} {3:>10.4f} {4:>10.2f}\n".format(
+                tag, count, nbytes, seconds, seconds / count * 1e6))
+
+
+def profiled(phase_name):
+    """Decorate a GrdReader method to be timed as a phase, when profiling"""
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.profile is None:
+                return method(self, *args, **kwargs)
+            with self.profile.phase(phase_name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorate
+
+
+@contextlib.contextmanager
+def phase(profile, name):
+    """profile.phase(name), or nothing if profile is None"""
+    if profile is None:
+        yield
+    else:
+        with profile.phase(name):
+            yield
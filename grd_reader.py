@@ -7,23 +7,189 @@ Adapted from work by Valek Filippov (c) 2010:
  https://gitorious.org/re-lab/graphics/source/781a65604d405f29c2da487820f64de8ddb0724d:photoshop/grd
 """
 
-import functools, sys, struct
+import collections, functools, itertools, mmap, sys, struct
 
-import chroma
+import imp
+
+import gradient_store, grd_profile
+
+# Imported on first use, so that entry points which never convert colors
+#  with them (eg --help, or reading stops only) don't pay for loading them
+chroma = None
+vector_color = None  # Needs NumPy, which dominates startup time
+gradient_eval = None  # Needs NumPy
 
 shift_buf = "                                    "
 
+# Precompiled decoders; handlers unpack straight from the mapped file
+_LONG = struct.Struct('>L')
+_DOUBLE = struct.Struct('>d')
+_BYTE = struct.Struct('>B')
+
+# Bump whenever parse() output changes, so that cached results are not reused
+PARSER_VERSION = 5
+
+COLOR_ENGINES = ("chroma", "numpy")
+
+# Type tags whose handlers open a container of further fields
+CONTAINER_TYPES = {"Objc", "VlLs"}
+
 COLOR_TERMS = {"Cyn", "Mgnt", "Ylw", "Blck",
                "Rd", "Grn", "Bl",
                "H", "Strt", "Brgh"}
 
+MAGIC = "8BGR"
+FORMAT_VERSION = 5  # Descriptor-based files, Photoshop 6 onwards
+
+# Longest field key accepted; real keys are far shorter
+MAX_KEY_LENGTH = 255
+# Smallest encoded size of a list item (its type tag) and of a named field
+#  (key length, 1-character key, type tag), used to reject impossible counts
+_MIN_ITEM_SIZE = 4
+_MIN_FIELD_SIZE = 9
+
+# After a malformed field, decoding resumes at the next gradient (a Grad
+#  object, keyed with length 0 or 4) found within this many bytes
+RESYNC_WINDOW = 1 << 20
+_GRAD_HEADERS = ("\0\0\0\0GradObjc", "\0\0\0\x04GradObjc")
+# The Nm field (gradient name) that a Grad object opens with
+_NAME_FIELDS = ("\0\0\0\0Nm  TEXT", "\0\0\0\x04Nm  TEXT")
+# Decoding state at a resynchronised Grad object: the only field of a Grdn
+#  item of the top-level GrdL list, whose length is no longer known
+_RESYNC_STACK = ((-1, False, None, False), (-1, True, "GrdL", False))
+_RESYNC_CONTAINER = (1, False, "----", False)
+
+# A problem found while decoding: offset of the malformed field, kind (one
+#  of "header", "unknown_type", "bad_length", "truncated"), description
+#  (unicode), and the offset decoding resumed at (None if it stopped there)
+Diagnostic = collections.namedtuple("Diagnostic",
+                                    "offset kind message resumed_at")
+
+
+def describe(diagnostic):
+    """One line of text describing a Diagnostic"""
+    return u"{0} at offset {1}, {2}".format(
+        diagnostic.message, diagnostic.offset,
+        "stopped" if diagnostic.resumed_at is None else
+        "resuming at offset {0}".format(diagnostic.resumed_at))
+
+
+class GrdFormatError(ValueError):
+    """A malformed .grd file, raised by readers in strict mode"""
+    def __init__(self, message, kind="corrupt", offset=None):
+        if offset is not None:
+            message = "{0} at offset {1}".format(message, offset)
+        ValueError.__init__(self, message)
+        self.kind = kind
+        self.offset = offset
+
+
+def _import_chroma():
+    global chroma
+    import chroma
+    return chroma
+
+
+def _import_vector_color(purpose):
+    """Import vector_color (and NumPy); purpose is named if NumPy is missing"""
+    global vector_color
+    if vector_color is None:
+        try:
+            import vector_color
+        except ImportError:
+            raise ImportError(purpose + " requires NumPy")
+    return vector_color
+
+
+def _import_gradient_eval():
+    """Import gradient_eval (and NumPy), needed for midpoints and opacity"""
+    global gradient_eval
+    if gradient_eval is None:
+        try:
+            import gradient_eval
+        except ImportError:
+            raise ImportError("Gradients with opacity stops or midpoints "
+                              "other than 50% require NumPy")
+    return gradient_eval
+
+
+def have_numpy():
+    """Whether NumPy can be imported, without importing it"""
+    try:
+        imp.find_module("numpy")
+    except ImportError:
+        return False
+    return True
+
+
+class TraceSink(object):
+    """
+    Event sink that prints a textual dump of each field as it is decoded.
+    Pass an instance to GrdReader.parse() to trace the descriptor tree.
+    """
+    def __init__(self, out=None):
+        self.out = out or sys.stdout
+
+    def field(self, shift, name, field_type, *values):
+        """One decoded field, indented by `shift` spaces"""
+        parts = [shift * " ", name, "({0})".format(field_type)]
+        parts.extend(values)
+        self._write(u" ".join(self._text(p) for p in parts))
+
+    def message(self, text):
+        """Free-form diagnostic text (unknown keys, hex dumps)"""
+        self._write(self._text(text))
+
+    @staticmethod
+    def _text(value):
+        if isinstance(value, unicode):
+            return value
+        if isinstance(value, str):
+            # Raw bytes from the file; show them one character per byte
+            return value.decode("latin-1")
+        return unicode(value)
+
+    def _write(self, line):
+        encoding = getattr(self.out, "encoding", None) or "utf-8"
+        self.out.write((line + u"\n").encode(encoding, "replace"))
+
 
 class GrdReader(object):
     """Read an Adobe .grd format file"""
-    def __init__(self, filename):
+    def __init__(self, filename, color_engine="chroma", profile=None,
+                 buffer=None, strict=True):
+        """
+        color_engine: "chroma" converts one stop at a time; "numpy" converts
+            all stops of a gradient in one vectorized pass (see vector_color)
+        profile: Optional grd_profile.ParseProfile, to record counts and
+            times per field type and per phase
+        buffer: Contents of the file, if already in memory; filename is
+            then only used for messages (see from_buffer)
+        strict: Raise GrdFormatError on the first malformed field (the
+            default). If False, the damaged gradient is dropped, decoding
+            resumes at the next one, and the problem is recorded in
+            self.diagnostics, which callers should then check.
+        """
+        if color_engine not in COLOR_ENGINES:
+            raise ValueError("Unknown color engine: " + color_engine)
+        if color_engine == "numpy":
+            _import_vector_color("The numpy color engine")
+        self.color_engine = color_engine
+        self.strict = strict
+        # Problems found by the last parse (see Diagnostic)
+        self.diagnostics = []
+        # Set to merge stops that lie within this RGB error (0..1) of the
+        #  line between their neighbours; stops_in/out count the effect
+        self.max_error = None
+        self.stops_in = self.stops_out = 0
+
         self.filename = filename
-        with open(filename, 'r') as f:
-            self.buffer = f.read()
+        self.profile = profile
+        if buffer is not None:
+            self.buffer = buffer
+        else:
+            with grd_profile.phase(profile, "read"):
+                self.buffer = self._map_file(filename)
 
         # Define functions used to handle particular types of data
         self.types = {"patt": self._p_patt, "desc": self._p_desc,
@@ -36,35 +202,376 @@ class GrdReader(object):
         # Store data about gradients
         # Because gradient names do not have to be unique, store names and gradients separately
         # TODO: API is a bit clumsy
-        self.gradients = []  # File can contain multiple gradient entries
+        # File can contain multiple gradient entries, stored column-wise
+        self.gradients = gradient_store.GradientStore()
         self.gradient_names = []
 
+        self._parsed = False
+        self._pending = collections.deque()  # Gradients read but not yet yielded
+
         self._cur_obj_name = ""
+        self._cur_name = ""
+        self._cur_offset = None  # Where the current Grad object starts
         self._cur_gradient = []  # Single gradient is a list of color entries
         self._cur_clr = {}  # Each color is dict with colors + location + type
+        self._cur_opacities = []  # Opacity stops of the current gradient
+        self._cur_opacity = None  # Opacity stop being read, if any
+        self._store = None  # GradientStore that read gradients are added to
+        self._sink = None  # Optional TraceSink-like receiver of field events
+        self._resync_marks = {}
+        self._end_offset = None  # Where the last _decode stopped
+
+    @classmethod
+    def from_buffer(cls, data, color_engine="chroma", profile=None,
+                    filename="<buffer>", strict=True):
+        """Read a .grd file that is already in memory, eg received over a network"""
+        return cls(filename, color_engine, profile, buffer=data, strict=strict)
+
+    @staticmethod
+    def _map_file(filename):
+        """Memory-map the file read-only, so that fields are decoded in place"""
+        with open(filename, 'rb') as f:
+            try:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files cannot be mapped
+                return f.read()
+
+    def close(self):
+        """Release the file mapping. Parsed gradients remain available."""
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.buffer = ""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def parse(self, sink=None):
+        """
+        Parse file and load into a list of gradients
+        sink: Optional object with `field` and `message` methods (see
+            TraceSink) that receives every decoded field. By default
+            nothing is formatted or printed.
+        """
+        if self._parsed:
+            return
+        store = gradient_store.GradientStore()
+        for name, gradient, _ in self._iter_parse(sink, store):
+            self.gradient_names.append(name)
+        self.gradients = store
+        self._parsed = True
+
+    def restore(self, gradient_names, gradients, diagnostics=()):
+        """
+        Load previously parsed results (eg from a GrdCache) instead of parsing
+        gradients: A GradientStore, or lists of color stop dicts
+        diagnostics: Problems found by that parse (see parse_buffer)
+        """
+        if not isinstance(gradients, gradient_store.GradientStore):
+            gradients = gradient_store.GradientStore.from_gradients(gradients)
+        self.gradient_names = list(gradient_names)
+        self.gradients = gradients
+        self.diagnostics = list(diagnostics)
+        self._parsed = True
+
+    def iter_gradients(self, sink=None):
+        """
+        Iterate over (name, color stops) pairs, yielding each gradient as soon
+        as its Grad object has been read. Unlike parse(), gradients are not
+        kept on the reader, so memory use does not grow with the file.
+        If the file has already been parsed, the stored gradients are used.
+        """
+        if self._parsed:
+            return itertools.izip(self.gradient_names, self.gradients)
+        return ((name, gradient) for name, gradient, _ in self._iter_parse(sink))
 
-    def parse(self):
-        """Parse file and load into a list of gradients"""
-        offset = 28
-        shift = 0  # spaces from the left edge
-        while offset < len(self.buffer):
-            offset = self._parse_entry(self.buffer, offset, shift)
+    def scan_names(self):
+        """
+        Names of the gradients in the file: the parsed ones if the file has
+        been parsed, or else a quick guide from scan_gradient_names
+        """
+        if self._parsed:
+            return list(self.gradient_names)
+        return scan_gradient_names(self.buffer)
+
+    def iter_index(self):
+        """
+        Iterate over (name, offset) pairs giving the position in the file of
+        each gradient's Grad object, for use with read_gradient_at.
+        Color stops are read but not kept, nor converted.
+        """
+        return ((name, offset) for name, _, offset in self._iter_parse(None))
+
+    def read_gradient_at(self, offset, sink=None):
+        """
+        Decode only the gradient whose Grad object starts at `offset` (as
+        found by iter_index). Returns (name, color stops)
+        """
+        for name, gradient, _ in self._iter_parse(sink, offset=offset, count=1):
+            return name, gradient
+        raise ValueError("No gradient at offset {0}".format(offset))
+
+    def read_gradients_at(self, offsets):
+        """
+        Decode the gradients whose Grad objects start at each of `offsets`
+        into one GradientStore, eg a run of them for one worker process
+        (see grd_parallel). Returns (names, store, offset where each Grad
+        object ends, or None where it is malformed)
+        """
+        names, ends = [], []
+        store = gradient_store.GradientStore()
+        diagnostics = []
+        for offset in offsets:
+            for name, _, _ in self._iter_parse(None, store, offset=offset, count=1):
+                names.append(name)
+            ends.append(None if self.diagnostics else self._end_offset)
+            diagnostics.extend(self.diagnostics)
+        self.diagnostics = diagnostics
+        return names, store, ends
+
+    def _iter_parse(self, sink, store=None, offset=28, count=-1):
+        """
+        Yield (name, color stops, offset of the Grad object) of each gradient
+        store: GradientStore to add gradients to. By default each gradient
+            gets a store of its own, which is dropped once it is used.
+        offset, count: Decode `count` fields from `offset`, rather than the
+            whole file
+        """
+        self._sink = sink
+        self._store = store
+        self._pending.clear()
+        self._cur_obj_name = ""
+        self._cur_name = ""
+        self._cur_offset = None
+        self._cur_gradient = []
+        self._cur_clr = {}
+        self._cur_opacities = []
+        self._cur_opacity = None
+        self.diagnostics = []
+        self._resync_marks = {}  # Grad header: (last found, searched up to)
+
+        if offset == 28 and not self._check_header(self.buffer):
+            return
+        decoder = self._decode(self.buffer, offset, count)
+        if self.profile is not None:
+            decoder = self.profile.timed("decode", decoder)
+        for _ in decoder:
+            while self._pending:
+                yield self._pending.popleft()
 
         self._flush_gradient()
+        while self._pending:
+            yield self._pending.popleft()
+
+    def _decode(self, buf, offset, count=-1):
+        """
+        Walk the descriptor tree from `offset` to the end of the buffer, or
+        for `count` fields if that is not -1.
+        Objc and VlLs containers are tracked on an explicit stack instead of
+        by recursion, so stack depth stays constant however deeply the file
+        nests. Leaf fields are dispatched through the self.types table.
+        Every length is checked against the end of the buffer; a malformed
+        field is handed to _recover, and decoding either resumes at the next
+        gradient or stops, so each byte is visited a bounded number of times.
+        This is a generator, which pauses whenever gradients are pending.
+        """
+        types = self.types
+        if self.profile is not None:
+            types = dict((tag, self.profile.wrap_handler(tag, handler))
+                         for tag, handler in types.items())
+        leaves = dict((tag, handler) for tag, handler in types.items()
+                      if tag not in CONTAINER_TYPES)
+        unpack_long = _LONG.unpack_from
+        end = len(buf)
+
+        # The innermost open container: fields left (-1 at the top level,
+        #  which runs to the end of the buffer), whether it is a list, its
+        #  name, and whether it is a Grad object. Enclosing ones are stacked.
+        left, in_list, container, is_gradient = count, False, None, False
+        stack = []
+        shift = 0  # spaces from the left edge
+        while True:
+            if left == 0:
+                if not stack:
+                    self._end_offset = offset
+                    return
+                closed_gradient = is_gradient
+                left, in_list, container, is_gradient = stack.pop()
+                shift -= 2
+                if closed_gradient:
+                    # All color stops of this gradient have now been read
+                    self._flush_gradient()
+                    yield
+                continue
+            elif offset >= end:
+                if left > 0:
+                    offset = self._recover(buf, offset, GrdFormatError(
+                        "{0!r} ends early".format(container), "truncated"),
+                        count == -1)
+                    if offset is None:
+                        return
+                    stack[:] = _RESYNC_STACK
+                    left, in_list, container, is_gradient = _RESYNC_CONTAINER
+                    shift = 0
+                    continue
+                self._end_offset = offset
+                return
+            elif left > 0:
+                left -= 1
+
+            field_offset = offset
+            try:
+                if in_list:
+                    # List items carry a type tag but no name of their own
+                    name = "----"
+                else:
+                    # Named field; 4-character names are stored with length 0
+                    [nlen] = unpack_long(buf, offset)
+                    if nlen == 0:
+                        nlen = 4
+                    elif nlen > MAX_KEY_LENGTH:
+                        raise GrdFormatError("Key length {0}".format(nlen),
+                                             "bad_length")
+                    offset += 4
+                    # Keys repeat for every stop; share one copy of each
+                    name = intern(buf[offset:offset + nlen])
+                    offset += nlen
+                field_type = buf[offset:offset + 4]
+                offset += 4
+                if offset > end:
+                    raise GrdFormatError("Field ends early", "truncated")
+
+                handler = leaves.get(field_type)
+                if handler is not None:  # Call appropriate func for field type
+                    offset = handler(buf, offset, name, shift)
+                    if offset > end:
+                        raise GrdFormatError(
+                            "{0} field {1!r} ends early".format(field_type, name),
+                            "truncated")
+                elif field_type in CONTAINER_TYPES:
+                    offset, size = types[field_type](buf, offset, name, shift)
+                    is_list = field_type == "VlLs"
+                    if size * (_MIN_ITEM_SIZE if is_list else _MIN_FIELD_SIZE) > end - offset:
+                        raise GrdFormatError("{0} {1!r} of {2} fields does not fit "
+                                             "in the file".format(field_type, name, size),
+                                             "bad_length")
+                    stack.append((left, in_list, container, is_gradient))
+                    left, container = size, name
+                    in_list = is_list
+                    is_gradient = not in_list and self._cur_obj_name == "Grad"
+                    if is_gradient:
+                        self._cur_offset = field_offset
+                    shift += 2
+                else:
+                    raise GrdFormatError("Unknown field type {0!r} in {1!r}".format(
+                        field_type, container if in_list else name), "unknown_type")
+            except (GrdFormatError, struct.error) as error:
+                if isinstance(error, struct.error):
+                    error = GrdFormatError("Field ends early", "truncated")
+                offset = self._recover(buf, field_offset, error, count == -1)
+                if offset is None:
+                    return
+                # Carry on from the Grad object, as if inside the GrdL list
+                stack[:] = _RESYNC_STACK
+                left, in_list, container, is_gradient = _RESYNC_CONTAINER
+                shift = 0
+
+    def _find_gradient(self, buf, start):
+        """
+        Offset of the first Grad object header from `start`, within
+        RESYNC_WINDOW bytes, or None. Where each form of header was last
+        found (or searched up to without success) is remembered, so that
+        a file with many damaged gradients is still only scanned once.
+        """
+        limit = min(len(buf), start + RESYNC_WINDOW)
+        found = []
+        for header in _GRAD_HEADERS:
+            position, scanned = self._resync_marks.get(header, (-1, start))
+            if position < start and not (position < 0 and scanned >= limit):
+                position = buf.find(header, max(start, scanned - len(header) + 1)
+                                    if position < 0 else start, limit)
+                self._resync_marks[header] = position, limit
+            if start <= position < limit:
+                found.append(position)
+        return min(found) if found else None
+
+    def _check_header(self, buf):
+        """Whether the file starts with a version 5 .grd header"""
+        if buf[:4] == MAGIC and len(buf) >= 28:
+            [version] = struct.unpack_from(">H", buf, 4)
+            if version == FORMAT_VERSION:
+                return True
+            message = "Unsupported .grd version {0}".format(version)
+        else:
+            message = "Not an Adobe .grd file"
+        self._recover(buf, 0, GrdFormatError(message, "header"), False)
+        return False
+
+    def _recover(self, buf, offset, error, resync):
+        """
+        Deal with the malformed field at `offset`: raise if strict, else
+        record a Diagnostic and drop the gradient it belongs to. With resync,
+        returns the offset of the next Grad object within RESYNC_WINDOW
+        bytes, else (or if there is none) None to stop decoding.
+        """
+        if self.strict:
+            raise GrdFormatError(error.args[0], error.kind, offset)
+
+        resume = self._find_gradient(buf, offset + 1) if resync else None
+        # Names are quoted with repr in messages, which are then plain ASCII
+        message = unicode(error.args[0])
+        if self._cur_gradient or self._cur_clr:
+            message += u"; dropped gradient {0!r}".format(self._cur_name)
+        diagnostic = Diagnostic(offset, error.kind, message, resume)
+        self.diagnostics.append(diagnostic)
+        if self._sink is not None:
+            self._sink.message(describe(diagnostic))
+            self._sink.message(self._hex_dump(buf, offset))
+
+        self._cur_obj_name = ""
+        self._cur_name = ""
+        self._cur_gradient = []
+        self._cur_clr = {}
+        self._cur_opacities = []
+        self._cur_opacity = None
+        return resume
+
+    @staticmethod
+    def _hex_dump(buf, offset, size=16):
+        """Bytes from offset in hex and printable ASCII, for trace output"""
+        data = buf[offset:offset + size]
+        return u"{0:<{1}} {2}".format(
+            u" ".join(u"{0:02x}".format(ord(c)) for c in data), size * 3 - 1,
+            u"".join(c if 32 <= ord(c) < 127 else u"." for c in data))
 
     def _flush_gradient(self):
         """Clear previous gradients"""
         self._flush_color()
+        self._flush_opacity()
 
         if self._cur_gradient:
-            self.gradients.append(self._cur_gradient)
+            store = self._store
+            if store is None:
+                store = gradient_store.GradientStore()
+            store.append(self._cur_gradient, self._cur_opacities)
+            self._pending.append((self._cur_name, store[-1], self._cur_offset))
             self._cur_gradient = []
+        self._cur_opacities = []
+        self._cur_name = ""
 
     def _flush_color(self):
         if self._cur_clr:
             self._cur_gradient.append(self._cur_clr)  # New color stop; store previous one
             self._cur_clr = {}
 
+    def _flush_opacity(self):
+        if self._cur_opacity:
+            self._cur_opacities.append(self._cur_opacity)
+        self._cur_opacity = None
+
     def _convert_color(self, clr_data):
         """Parse color object (when field name = Clr). Return RGB triplet"""
         # TODO: Get color data.
@@ -93,248 +600,375 @@ class GrdReader(object):
         else:
             raise NotImplementedError("Unknown color type: " + palette)
 
-        color = chroma.Color(color_tuple, format=fmt)
+        color = (chroma or _import_chroma()).Color(color_tuple, format=fmt)
         return color.rgb
 
-    def _cleanup_gradient(self, gradient_spec):
-        """Ensure that locations are 0..1, and convert colors to rgb"""
+    def _normalize_stops(self, gradient_spec):
+        """
+        Color stop locations stretched to 0..1 (.grd files can sometimes omit
+        these endpoints), and colors converted to rgb, both rounded.
+        Returns (locations, rgb, function that normalizes other locations)
+        """
         roundoff = functools.partial(round, ndigits=3)
 
-        # First, adjust the color stop positions to cover the full range 0..1:
-        #  .grd files can sometimes omit these endpoints. So stretch range
-        gradient_locations = [c["Lctn"] for c in gradient_spec]
+        gradient_locations = gradient_spec.locations
         min_loc = min(gradient_locations)
-        max_loc = max(gradient_locations)
+        scale = 1. / (max(gradient_locations) - min_loc)
+        normalize = lambda loc: roundoff((loc - min_loc) * scale)
 
-        gradient_locations = [roundoff((loc-min_loc)*(1./(max_loc-min_loc)))
-                              for loc in gradient_locations]
+        gradient_locations = [normalize(loc) for loc in gradient_locations]
 
-        gradient_rgb = [map(roundoff, self._convert_color(c))
-                        for c in gradient_spec]
+        if self.color_engine == "numpy":
+            gradient_rgb = vector_color.convert_stops(gradient_spec).round(3).tolist()
+        else:
+            gradient_rgb = [map(roundoff, self._convert_color(c))
+                            for c in gradient_spec]
+        return gradient_locations, gradient_rgb, normalize
 
+    @staticmethod
+    def is_linear(gradient_spec):
+        """
+        Whether a gradient is opaque, with all midpoints at 50%, so that its
+        stops convert without NumPy
+        """
+        return (all(mid == gradient_store.DEFAULT_MIDPOINT or mid != mid
+                    for mid in gradient_spec.midpoints) and
+                all(stop.get("Opct", 100.) >= 100. and
+                    stop.get("Mdpn", gradient_store.DEFAULT_MIDPOINT) ==
+                    gradient_store.DEFAULT_MIDPOINT
+                    for stop in gradient_spec.opacity_stops))
+
+    def _gradient_eval(self, gradient_spec, gradient_locations, gradient_rgb,
+                       normalize):
+        """A gradient_eval.Gradient of normalized stops"""
+        opacity_stops = [stop for stop in gradient_spec.opacity_stops
+                         if "Lctn" in stop and "Opct" in stop]
+        return _import_gradient_eval().Gradient(
+            gradient_locations, gradient_rgb, gradient_spec.midpoints,
+            [normalize(stop["Lctn"]) for stop in opacity_stops],
+            [min(max(stop["Opct"] / 100., 0.), 1.) for stop in opacity_stops],
+            [stop.get("Mdpn", gradient_store.MISSING) for stop in opacity_stops])
+
+    @grd_profile.profiled("convert")
+    def _cleanup_gradient(self, gradient_spec, alpha=False):
+        """
+        Ensure that locations are 0..1, and convert colors to rgb (rgba if
+        alpha). Midpoints and opacity are represented by further stops, so
+        that linear interpolation between stops reproduces them
+        (see gradient_eval).
+        """
+        gradient_spec = gradient_store.as_view(gradient_spec)
+        gradient_locations, gradient_rgb, normalize = self._normalize_stops(
+            gradient_spec)
+
+        if not self.is_linear(gradient_spec):
+            gradient = self._gradient_eval(gradient_spec, gradient_locations,
+                                           gradient_rgb, normalize)
+            knot_locations, knot_rgba = gradient.knots()
+            gradient_locations = knot_locations.round(3).tolist()
+            gradient_rgb = knot_rgba[:, :4 if alpha else 3].round(3).tolist()
+        elif alpha:
+            gradient_rgb = [rgb + [1.] for rgb in gradient_rgb]
+
+        if self.max_error is not None:
+            gradient_locations, gradient_rgb = self._simplify(gradient_locations,
+                                                              gradient_rgb)
         return gradient_locations, gradient_rgb
 
+    def _simplify(self, gradient_locations, gradient_rgb):
+        """Drop stops that interpolation reproduces within self.max_error"""
+        simplify_stops = _import_vector_color("Stop simplification").simplify_stops
+        keep = simplify_stops(gradient_locations, gradient_rgb, self.max_error)
+        self.stops_in += len(gradient_locations)
+        self.stops_out += len(keep)
+        return ([gradient_locations[i] for i in keep],
+                [gradient_rgb[i] for i in keep])
+
+    def simplify_summary(self):
+        """Describe how many stops simplification has dropped so far"""
+        return "Simplified {0} color stops to {1} ({2:.1%})".format(
+            self.stops_in, self.stops_out,
+            self.stops_out / float(max(self.stops_in, 1)))
+
+    def evaluate(self, gradient_spec, samples):
+        """
+        Evaluate a gradient, including its midpoints and opacity, at an
+        array of positions in 0..1, in one vectorized pass.
+        Returns an array of RGBA values (0..1), of shape samples.shape + (4,)
+        """
+        gradient_spec = gradient_store.as_view(gradient_spec)
+        stops = self._normalize_stops(gradient_spec)
+        return self._gradient_eval(gradient_spec, *stops)(samples)
+
     def grd_to_cmap(self, gradient_spec):
         """
         Convert Adobe PS gradient information to a matplotlib cmap spec
         gradient_spec: A list of color stops for one single gradient
+        The spec has an alpha channel if the gradient is not opaque.
         """
-        gradient_locations, gradient_rgb = self._cleanup_gradient(gradient_spec)
+        gradient_locations, gradient_rgba = self._cleanup_gradient(gradient_spec,
+                                                                   alpha=True)
 
         cmap_dict = {'red': [],
                      'green': [],
                      'blue': []}
+        if any(rgba[3] < 1. for rgba in gradient_rgba):
+            cmap_dict['alpha'] = []
 
-        for loc, rgb in zip(gradient_locations, gradient_rgb):
+        for loc, rgba in zip(gradient_locations, gradient_rgba):
             cmap_dict["red"].append((
-                loc, rgb[0], rgb[0]))
+                loc, rgba[0], rgba[0]))
             cmap_dict["green"].append(
-                (loc, rgb[1], rgb[1]))
+                (loc, rgba[1], rgba[1]))
             cmap_dict["blue"].append(
-                (loc, rgb[2], rgb[2]))
+                (loc, rgba[2], rgba[2]))
+            if "alpha" in cmap_dict:
+                cmap_dict["alpha"].append((loc, rgba[3], rgba[3]))
 
         return cmap_dict
 
     def grd_to_js(self, gradient_spec):
         """Convert Adobe PS information data to a JS-format list of colorstops, suitable for use with an HTML5 gradient"""
-        gradient_locations, gradient_rgb = self._cleanup_gradient(gradient_spec)
+        gradient_locations, gradient_rgba = self._cleanup_gradient(gradient_spec,
+                                                                   alpha=True)
 
         colorstops = []
-        for loc, rgb in zip(gradient_locations, gradient_rgb):
-            scaled_rgb = [int(c * 255) for c in rgb]
-            color_str = "rgb({0}, {1}, {2})".format(*scaled_rgb)
+        for loc, rgba in zip(gradient_locations, gradient_rgba):
+            scaled_rgb = [int(c * 255) for c in rgba[:3]]
+            if rgba[3] < 1.:
+                color_str = "rgba({0}, {1}, {2}, {3})".format(*scaled_rgb + [rgba[3]])
+            else:
+                color_str = "rgb({0}, {1}, {2})".format(*scaled_rgb)
             colorstops.append([loc, color_str])
 
         return colorstops
 
-    def _parse_entry(self, buf, offset, shift):
-        [nlen] = struct.unpack('>L', buf[offset:offset + 4])
-        if nlen == 0:
-            nlen = 4
-        offset += 4
-
-        name = buf[offset:offset + nlen]
-        offset = offset + nlen
-        field_type = buf[offset:offset + 4]
-        offset += 4
-        if field_type in self.types:  # Call appropriate func for field type
-            offset = self.types[field_type](buf, offset, name, shift)
-        else:
-            print "Unknown key:\t", name, field_type
-            self.p_unkn(buf, offset, name, shift)
-        return offset
+    def grd_to_lut(self, gradient_spec, size=256, alpha=False):
+        """
+        Sample a gradient into a lookup table of `size` evenly spaced uint8
+        RGB (or RGBA, with the gradient's opacity) entries, so that colormaps
+        can be applied by array index
+        """
+        sample_lut = _import_vector_color("Lookup tables").sample_lut
+        gradient_locations, gradient_rgb = self._cleanup_gradient(gradient_spec,
+                                                                  alpha)
+        return sample_lut(gradient_locations, gradient_rgb, size, alpha)
 
     def _p_patt(self, buf, offset, name, shift):
         """Not rev engineered yet"""
         return offset
 
     def _p_tdta(self, buf, offset, name, shift):
-        [size] = struct.unpack('>L', buf[offset:offset + 4])
+        [size] = _LONG.unpack_from(buf, offset)
         offset += 4
         string = buf[offset:offset + size]
         offset += size
-        print shift * " ", name, "(tdta", size, ")", string
+        if self._sink is not None:
+            self._sink.field(shift, name, "tdta", size, string)
         return offset
 
     def _p_desc(self, buf, offset, name, shift):
         # convert 4 bytes as big-endian unsigned long
-        [size] = struct.unpack('>L', buf[offset:offset + 4])
+        [size] = _LONG.unpack_from(buf, offset)
         return offset + 26
 
     def _p_long(self, buf, offset, name, shift):
-        [size] = struct.unpack('>L', buf[offset:offset + 4])
-        print shift * " ", name, "(long)", size
+        [size] = _LONG.unpack_from(buf, offset)
+        if self._sink is not None:
+            self._sink.field(shift, name, "long", size)
 
-        if self._cur_obj_name == "Clr" and name == "Lctn":
+        if self._cur_obj_name == "Clr" and name in ("Lctn", "Mdpn"):
             # Represents color info in gradient
             self._cur_clr[name] = size
+        elif self._cur_opacity is not None and name in ("Lctn", "Mdpn"):
+            self._cur_opacity[name] = size
         return offset + 4
 
     def _p_vlls(self, buf, offset, name, shift):
-        [size] = struct.unpack('>L', buf[offset:offset + 4])
+        """Read a list header. Returns (offset of first item, item count)"""
+        [size] = _LONG.unpack_from(buf, offset)
         offset += 4
-        print shift * " ", name, "(VlLs)", size
-        shift += 2
-        for i in range(size):
-            field_type = buf[offset:offset + 4]
-            offset += 4
-            if field_type in self.types:
-                offset = self.types[field_type](buf, offset, "----", shift)
-            else:
-                print "Unknown key:\t", name, field_type
-                self.p_unkn(buf, offset, "", shift)
-        shift -= 2
-        return offset
+        if self._sink is not None:
+            self._sink.field(shift, name, "VlLs", size)
+        return offset, size
 
     def _p_objc(self, buf, offset, name, shift):
-        """Unpack data from an object that contains multiple fields/values"""
-        [objnamelen] = struct.unpack('>L', buf[offset:offset + 4])
+        """
+        Read the header of an object that contains multiple fields/values.
+        Returns (offset of first field, field count)
+        """
+        [objnamelen] = _LONG.unpack_from(buf, offset)
         offset += 4
-        objname = buf[offset:offset + objnamelen * 2]
+        objname_offset = offset
         offset += objnamelen * 2
-        [objtypelen] = struct.unpack('>L', buf[offset:offset + 4])
+        [objtypelen] = _LONG.unpack_from(buf, offset)
         if objtypelen == 0:
             objtypelen = 4
         offset += 4
         typename = buf[offset:offset + objtypelen]
         offset += objtypelen
-        [value] = struct.unpack('>L', buf[offset:offset + 4])
+        [value] = _LONG.unpack_from(buf, offset)
         offset += 4
-        print shift * " ", name, "(Objc)", objname, typename, value
+        if self._sink is not None:
+            # The display name is only of interest when tracing
+            objname = self._decode_text(buf, objname_offset, objnamelen)
+            self._sink.field(shift, name, "Objc", objname, typename, value)
 
         self._cur_obj_name = name.strip()
-        if self._cur_obj_name == "Grad":
+        self._flush_opacity()
+        if typename == "TrnS":
+            # Opacity stop, in the Trns list of a gradient
+            self._cur_opacity = {}
+        elif self._cur_obj_name == "Grad":
             self._flush_gradient()
         elif self._cur_obj_name == "Clr":
             self._flush_color()
-            self._cur_clr = {"palette": typename.strip()}
+            self._cur_clr = {"palette": intern(typename.strip())}
 
-        shift += 2
-        for i in range(value):
-            offset = self._parse_entry(buf, offset, shift)
-        shift -= 2
-        return offset
+        return offset, value
+
+    @staticmethod
+    def _decode_text(buf, offset, size):
+        """
+        Decode `size` UTF-16BE code units in one pass, dropping the null
+        that terminates the string
+        """
+        string = buf[offset:offset + size * 2].decode("utf-16-be", "replace")
+        return string[:-1] if string.endswith(u"\x00") else string
 
     def _p_text(self, buf, offset, name, shift):
-        [size] = struct.unpack('>L', buf[offset:offset + 4])
-        string = ""
-        for i in range(size - 1):
-            string += str(
-                buf[offset + 4 + i * 2 + 1:offset + 4 + i * 2 + 2])
-        print shift * " ", name, "(TEXT", size, ")", string
+        [size] = _LONG.unpack_from(buf, offset)
+        string = self._decode_text(buf, offset + 4, size)
+        if self._sink is not None:
+            self._sink.field(shift, name, "TEXT", size, string)
 
         if self._cur_obj_name == "Grad" and name.strip() == "Nm":
-            self.gradient_names.append(string.strip())
+            self._cur_name = string.strip()
 
         return offset + 4 + size * 2
 
     def _p_untf(self, buf, offset, name, shift):
         field_type = buf[offset:offset + 4]
-        [value] = struct.unpack('>d', buf[offset + 4:offset + 4 + 8])
-        print shift * " ", name, "(UntF)", field_type, value
+        [value] = _DOUBLE.unpack_from(buf, offset + 4)
+        if self._sink is not None:
+            self._sink.field(shift, name, "UntF", field_type, value)
 
         name = name.strip()
         if self._cur_obj_name == "Clr" and name in COLOR_TERMS:
             # Store color information is this is a recognized palette
-            self._cur_clr[name] = value
+            self._cur_clr[intern(name)] = value
+        elif self._cur_opacity is not None and name == "Opct":
+            self._cur_opacity[name] = value
         return offset + 12
 
     def _p_bool(self, buf, offset, name, shift):
-        # ord converts 1 byte number
-        print shift * " ", name, "(bool)", ord(buf[offset:offset + 1])
+        [value] = _BYTE.unpack_from(buf, offset)
+        if self._sink is not None:
+            self._sink.field(shift, name, "bool", value)
         return offset + 1
 
     def _p_doub(self, buf, offset, name, shift):
         # unpack 8 bytes ieee 754 value to floating point number
-        [value] = struct.unpack('>d', buf[offset:offset + 8])
-        print shift * " ", name, "(doub)", value
+        [value] = _DOUBLE.unpack_from(buf, offset)
+        if self._sink is not None:
+            self._sink.field(shift, name, "doub", value)
         name = name.strip()
         if self._cur_obj_name == "Clr" and name in COLOR_TERMS:
             # Store color information is this is a recognized palette
-            self._cur_clr[name] = value
+            self._cur_clr[intern(name)] = value
         return offset + 8
 
     def _p_enum(self, buf, offset, name, shift):
-        [size1] = struct.unpack('>L', buf[offset:offset + 4])
+        [size1] = _LONG.unpack_from(buf, offset)
         offset += 4
         if size1 == 0:
             size1 = 4
         name1 = buf[offset:offset + size1]
         offset += size1
-        [size2] = struct.unpack('>L', buf[offset:offset + 4])
+        [size2] = _LONG.unpack_from(buf, offset)
         if size2 == 0:
             size2 = 4
         offset += 4
         name2 = buf[offset:offset + size2]
         offset += size2
-        print shift * " ", name, "(enum)", name1, name2
+        if self._sink is not None:
+            self._sink.field(shift, name, "enum", name1, name2)
         return offset
 
-    def p_unkn(self, buf, offset, name, shift):
-        # assume 4 bytes value
-        # in such case offset+4:offset+8 is next length
-        # and offset+8:offset+12 is next enum
-        # check for it
-        name = buf[offset + 8:offset + 12]
-        if name in self.types:
-            # everything is fine
-            [size] = struct.unpack('>L', buf[offset:offset + 4])
-            return size, offset + 4
-        else:
-            print "Failed with simple case\n"
-            str_hex = ""
-            str_asc = ""
-            ml = 15
-            for i in range(ml):
-                try:
-                    str_hex += "%02x " % ord(buf[offset + i])
-                    if ord(buf[offset + i]) < 32 or 126 < ord(buf[offset + i]):
-                        str_asc += '.'
-                    else:
-                        str_asc += buf[offset + i]
-                    print str_hex, str_asc
-                except:
-                    print "Something failed"
-            return str_hex + " " + str_asc, len(buf) + 1
+
+def find_gradient_headers(buf, offset=28):
+    """
+    Sorted offsets of everything that looks like the header of a Grad
+    object: the key "Grad" (stored with length 0 or 4) and the Objc type
+    """
+    found = set()
+    for header in _GRAD_HEADERS:
+        position = buf.find(header, offset)
+        while position >= 0:
+            found.add(position)
+            position = buf.find(header, position + 1)
+    return sorted(found)
+
+
+def scan_gradient_names(buf, offset=28):
+    """
+    Names of the gradients in a .grd file, found without decoding it: the Nm
+    field that opens each Grad object (see find_gradient_headers). This is
+    far faster than parsing, but only a guide; headers not followed by a Nm
+    field are skipped, and the names of damaged gradients are included.
+    """
+    names = []
+    for position in find_gradient_headers(buf, offset):
+        try:
+            position += len(_GRAD_HEADERS[0])
+            # Display name, class id and field count of the Objc
+            [size] = _LONG.unpack_from(buf, position)
+            position += 4 + 2 * size
+            [size] = _LONG.unpack_from(buf, position)
+            position += 4 + (size or 4) + 4
+            if buf[position:position + 12] not in _NAME_FIELDS:
+                continue
+            [size] = _LONG.unpack_from(buf, position + 12)
+        except struct.error:
+            continue
+        if position + 16 + 2 * size <= len(buf):
+            names.append(GrdReader._decode_text(buf, position + 16, size).strip())
+    return names
+
+
+def parse_buffer(data, strict=True):
+    """
+    Parse the contents of a .grd file, returning the results in compact,
+    picklable form for use in worker processes: (names, GradientStore data,
+    list of Diagnostic). Load them with GrdReader.restore and
+    GradientStore.from_data.
+    strict: Raise GrdFormatError if the file is malformed. If False, the
+        gradients that could be read are returned, and the diagnostics say
+        what was dropped.
+    """
+    grd = GrdReader.from_buffer(data, strict=strict)
+    grd.parse()
+    return grd.gradient_names, grd.gradients.to_data(), grd.diagnostics
 
 
 def main():
     if len(sys.argv) >= 2:
         filename = sys.argv[1]
         try:
-            data = GrdReader(filename)
+            # Show what can be read of a damaged file, and where it is damaged
+            data = GrdReader(filename, strict=False)
         except IOError:
             print "No file"
             sys.exit(1)
 
-        data.parse()
+        data.parse(sink=TraceSink())
 
         print "JSON BELOW"
         from pprint import pprint as pp
         # Sample display of data in internal structure
 
         print "Gradient information"
-        pp(zip(data.gradient_names, data.gradients))
+        pp(zip(data.gradient_names, [list(g) for g in data.gradients]))
 
         print "Modified gradients (consistent RGB)"
         mod_gradients = [[data._convert_color(c) for c in gradient]
@@ -345,5 +979,9 @@ def main():
         for g in data.gradients:
             pp(data.grd_to_cmap(g))
 
+        if data.diagnostics:
+            print "{0} problems found in the file".format(len(data.diagnostics))
+            sys.exit(1)
+
 if __name__ == '__main__':
     main()
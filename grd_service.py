@@ -0,0 +1,316 @@
+"""
+Long-running HTTP service that converts .grd files, so that callers do not
+pay interpreter startup, imports and a full parse on every request.
+
+Files are parsed and converted on a pool of worker processes. Parsed
+results are kept in a bounded in-memory LRU keyed by a hash of the file
+contents, so repeated requests for the same file skip parsing altogether.
+
+    POST /convert?format=js    with the .grd file as the request body
+    GET  /convert?path=FILE.grd&format=cmap
+    GET  /stats
+
+format is js (HTML5 color stops), cmap (matplotlib cmap specs) or lut
+(.npz lookup tables); optional parameters are engine, name (convert one
+gradient only), and size and alpha for lut. JSON responses map each unique
+gradient name to its converted data, in file order.
+
+Malformed files are refused (422). With recover=1, the gradients that can be
+read are converted, and the number of damaged gradients dropped is given in
+an X-Grd-Diagnostics header.
+"""
+import argparse, collections, hashlib, json, os, sys, threading, urlparse
+import BaseHTTPServer, SocketServer
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from concurrent import futures
+
+import gradient_store, grd_convert, grd_reader, lut_converter
+
+DEFAULT_PORT = 8765
+DEFAULT_CACHE_ENTRIES = 64
+
+FORMATS = ("js", "cmap", "lut")
+
+
+def convert_parsed(names, store_data, fmt, color_engine, name=None, size=256,
+                   alpha=False):
+    """
+    Convert parsed gradients, as returned by grd_reader.parse_buffer. Runs
+    in a worker process. Returns (content type, response body)
+    """
+    try:
+        grd = grd_reader.GrdReader.from_buffer("", color_engine)
+    except (ValueError, ImportError) as e:
+        raise RequestError(400, str(e))
+    grd.restore(names, gradient_store.GradientStore.from_data(store_data))
+
+    gradients = list(grd_convert.iter_named_gradients(grd))
+    if name is not None:
+        gradients = [(n, g) for n, g in gradients if n == name]
+        if not gradients:
+            raise RequestError(404, "No gradient named {0}".format(name))
+
+    if fmt == "lut":
+        out_f = StringIO()
+        luts = [grd.grd_to_lut(g, size, alpha) for _, g in gradients]
+        lut_converter.write_luts(out_f, [n for n, _ in gradients],
+                                 lut_converter.stack_luts(luts, size, alpha))
+        return "application/octet-stream", out_f.getvalue()
+
+    convert = grd.grd_to_js if fmt == "js" else grd.grd_to_cmap
+    result = collections.OrderedDict((n, convert(g)) for n, g in gradients)
+    return "application/json", json.dumps(result)
+
+
+class RequestError(Exception):
+    """A request that cannot be served; carries the HTTP status to return"""
+    def __init__(self, status, message):
+        Exception.__init__(self, status, message)
+        self.status = status
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+class ParsedFileCache(object):
+    """
+    LRU of parsed files, keyed by content hash. Entries are futures, so a
+    file that is requested again while it is being parsed is parsed once.
+    """
+    def __init__(self, executor, max_entries=DEFAULT_CACHE_ENTRIES):
+        self.executor = executor
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, data, strict=True):
+        """
+        Returns (names, GradientStore data, diagnostics) for the contents of
+        a .grd file, as grd_reader.parse_buffer
+        """
+        key = (hashlib.sha1(data).hexdigest(), strict)
+        with self._lock:
+            future = self._entries.pop(key, None)
+            if future is None:
+                self.misses += 1
+                future = self.executor.submit(grd_reader.parse_buffer, data,
+                                              strict)
+            else:
+                self.hits += 1
+            self._entries[key] = future  # Now the most recently used
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        try:
+            return future.result()
+        except Exception:
+            # Don't keep failures around
+            with self._lock:
+                if self._entries.get(key) is future:
+                    del self._entries[key]
+            raise
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries),
+                    "max_entries": self.max_entries,
+                    "hits": self.hits,
+                    "misses": self.misses}
+
+
+class ConversionService(object):
+    """Converts .grd file contents to the formats of the converter scripts"""
+    def __init__(self, workers=None, max_entries=DEFAULT_CACHE_ENTRIES):
+        self.executor = futures.ProcessPoolExecutor(max_workers=workers)
+        self.cache = ParsedFileCache(self.executor, max_entries)
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()  # Requests are counted from many threads
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+    def convert(self, data, fmt="js", color_engine="chroma", name=None,
+                size=256, alpha=False, recover=False):
+        """
+        Returns (content type, response body, diagnostics)
+        recover: Convert what can be read of a damaged file, rather than fail;
+            diagnostics then lists the problems found
+        """
+        if fmt not in FORMATS:
+            raise RequestError(400, "Unknown format: {0}".format(fmt))
+        if fmt == "lut" and not grd_reader.have_numpy():
+            raise RequestError(400, "Lookup tables require NumPy")
+
+        try:
+            names, store_data, diagnostics = self.cache.get(data, not recover)
+        except Exception as e:
+            raise RequestError(422, "Error occurred while reading file: {0}: {1}".format(
+                type(e).__name__, e))
+
+        try:
+            content_type, body = self.executor.submit(
+                convert_parsed, names, store_data, fmt, color_engine, name,
+                size, alpha).result()
+        except RequestError:
+            raise
+        except Exception as e:
+            raise RequestError(422, "Error occurred while converting file: {0}: {1}".format(
+                type(e).__name__, e))
+        return content_type, body, diagnostics
+
+    def count_request(self, error=False):
+        """Count a request served, and whether it failed"""
+        with self._lock:
+            self.requests += 1
+            if error:
+                self.errors += 1
+
+    def stats(self):
+        stats = self.cache.stats()
+        with self._lock:
+            stats.update(requests=self.requests, errors=self.errors)
+        return stats
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep connections alive between requests
+    # Headers and body are written separately; don't wait for an ACK between
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path == "/stats":
+            self._respond(200, "application/json",
+                          json.dumps(self.server.service.stats()))
+            return
+        self._convert(url, posted=False)
+
+    def do_POST(self):
+        self._convert(urlparse.urlparse(self.path), posted=True)
+
+    def _convert(self, url, posted):
+        """Answer a conversion request; posted: whether the file is the body"""
+        service = self.server.service
+        try:
+            # Read the body first, so that it is never left on the connection
+            data = self._read_body() if posted else None
+            if url.path != "/convert":
+                raise RequestError(404, "Unknown path: {0}".format(url.path))
+            query = dict(urlparse.parse_qsl(url.query))
+            if data is None:
+                data = self._read_file(query.get("path"))
+            content_type, body, diagnostics = service.convert(
+                data, query.get("format", "js"),
+                query.get("engine", self.server.color_engine),
+                query.get("name"),
+                int(query.get("size", 256)),
+                query.get("alpha", "0").lower() in ("1", "true", "yes"),
+                query.get("recover", "0").lower() in ("1", "true", "yes"))
+        except RequestError as e:
+            status, message = e.status, str(e)
+        except ValueError as e:  # Malformed query parameters
+            status, message = 400, str(e)
+        except Exception as e:
+            # Answer rather than drop the connection, whatever went wrong
+            status, message = 500, "{0}: {1}".format(type(e).__name__, e)
+        else:
+            service.count_request()
+            headers = {}
+            if diagnostics:  # Damaged gradients dropped, with recover
+                headers["X-Grd-Diagnostics"] = str(len(diagnostics))
+            self._respond(200, content_type, body, headers)
+            return
+        service.count_request(error=True)
+        if isinstance(message, str):  # Could hold bytes of the file
+            message = message.decode("utf-8", "replace")
+        self._respond(status, "application/json", json.dumps({"error": message}))
+
+    def _read_body(self):
+        try:
+            length = int(self.headers.getheader("Content-Length", 0))
+            if length < 0:
+                raise ValueError
+        except ValueError:
+            # Where the body ends is unknown, so the connection can't be reused
+            self.close_connection = 1
+            raise RequestError(400, "Bad Content-Length: {0}".format(
+                self.headers.getheader("Content-Length")))
+        return self.rfile.read(length)
+
+    @staticmethod
+    def _read_file(path):
+        if path is None:
+            raise RequestError(400, "GET /convert needs a path parameter")
+        if os.path.splitext(path)[1] != ".grd":
+            raise RequestError(400, "File must be an Adobe PS gradient file with .grd extension")
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except IOError:
+            raise RequestError(404, "File not found: {0}".format(path))
+
+    def _respond(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class ConversionServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server handling each connection on its own thread"""
+    daemon_threads = True
+
+    def __init__(self, address, service, color_engine="chroma", quiet=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, RequestHandler)
+        self.service = service
+        self.color_engine = color_engine
+        self.quiet = quiet
+
+
+def command_line():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of parsing processes (default: one per CPU)")
+    parser.add_argument("--cache-entries", type=int, default=DEFAULT_CACHE_ENTRIES,
+                        help="Number of parsed files to keep in memory")
+    parser.add_argument("--engine", choices=grd_reader.COLOR_ENGINES,
+                        default="chroma",
+                        help="Default color conversion engine")
+    parser.add_argument("--quiet", action="store_true",
+                        help="Don't log each request")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    parsed_args = command_line()
+    service = ConversionService(parsed_args.workers, parsed_args.cache_entries)
+    server = ConversionServer((parsed_args.host, parsed_args.port), service,
+                              parsed_args.engine, parsed_args.quiet)
+    print("Serving on http://{0}:{1}/".format(*server.server_address[:2]))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
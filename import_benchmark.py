@@ -0,0 +1,205 @@
+"""
+Measure the startup cost of each entry point, and fail if it regresses.
+
+Each module is imported in a fresh interpreter, which reports the modules
+that were loaded. Importing an entry point is what `--help` costs, before
+any work is done; a pure JS conversion can be measured too (--grd).
+
+Two things are checked:
+    - heavy dependencies (NumPy, matplotlib, chroma) are not loaded by
+      entry points that don't need them until they do work
+    - with --baseline, times have not grown beyond a tolerance since the
+      baseline was saved (with --json), on the same machine
+
+Times are the best of several runs. On Python 3.7+ import times are taken
+from `-X importtime`; on older versions, the child process times the
+import itself.
+"""
+import argparse, json, os, subprocess, sys
+
+HEAVY_MODULES = ("numpy", "matplotlib", "chroma")
+
+# None of these may load a heavy module on import
+ENTRY_POINTS = ["jsgradient_converter", "matplotlib_converter",
+                "binary_converter", "lut_converter", "batch_converter",
+                "grd_index", "grd_service", "display_colormaps"]
+
+# Converts a file to JS in memory, as jsgradient_converter.py does with the
+#  default engine, which needs chroma, and NumPy only for gradients with
+#  opacity or midpoints (see js_conversion_modules)
+JS_CONVERSION = """
+import StringIO, grd_convert, jsgradient_converter
+grd = grd_convert.open_file({0!r})
+jsgradient_converter.write_outfile(grd, StringIO.StringIO())
+"""
+
+# Wrapped around the measured code: time it, and report how long it took
+#  and what was loaded, on a line of its own
+TIMED_CODE = """
+import sys as _sys, timeit as _timeit
+_started = _timeit.default_timer()
+{0}
+_elapsed = _timeit.default_timer() - _started
+_sys.stdout.write("\\nELAPSED %r MODULES %s" % (_elapsed, " ".join(sorted(
+    _name for _name, _module in _sys.modules.items() if _module is not None))))
+"""
+
+DEFAULT_REPEAT = 5
+DEFAULT_TOLERANCE = 0.25  # Allowed slowdown, as a fraction of the baseline
+NOISE = 0.005  # Seconds; smaller slowdowns are never reported
+
+
+def command_line():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("modules", nargs="*",
+                        help="Entry points to measure (default: all)")
+    parser.add_argument("--grd", default=None,
+                        help="Also measure a JS conversion of this .grd file")
+    parser.add_argument("--python", default=sys.executable,
+                        help="Interpreter to measure")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT,
+                        help="Runs per measurement; the fastest is reported")
+    parser.add_argument("--json", default=None, metavar="FILENAME",
+                        help="Save the results to this JSON file")
+    parser.add_argument("--baseline", default=None, metavar="FILENAME",
+                        help="Fail if slower than the results saved in this "
+                             "JSON file")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed slowdown against the baseline, as a "
+                             "fraction (default: %(default)s)")
+
+    return parser.parse_args()
+
+
+def has_importtime(python):
+    """Whether the interpreter supports -X importtime (Python 3.7+)"""
+    code = "import sys; sys.exit(sys.version_info < (3, 7))"
+    return subprocess.call([python, "-c", code]) == 0
+
+
+def _parse_importtime(stderr, module):
+    """Cumulative seconds spent importing `module`, from -X importtime output"""
+    for line in stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].strip() == module:
+            return int(parts[1]) / 1e6
+    return None
+
+
+def run(python, code, module=None, importtime=False):
+    """
+    Run code in a fresh interpreter. Returns (seconds, loaded module names):
+    the import time of `module` if importtime, else the time taken by code
+    """
+    command = [python]
+    if importtime:
+        command += ["-X", "importtime"]
+    command += ["-c", TIMED_CODE.format(code.strip())]
+
+    process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError("{0} failed:\n{1}".format(code.strip(), stderr))
+
+    stdout, stderr = stdout.decode("utf-8"), stderr.decode("utf-8")
+    elapsed, _, modules = stdout.rsplit("\nELAPSED ", 1)[1].split(" ", 2)
+    elapsed = float(elapsed)
+    if importtime and module is not None:
+        elapsed = _parse_importtime(stderr, module)
+    return elapsed, modules.split()
+
+
+def measure(python, code, module=None, repeat=DEFAULT_REPEAT, importtime=False):
+    """Best of `repeat` runs. Returns (seconds, loaded module names)"""
+    runs = [run(python, code, module, importtime) for _ in range(repeat)]
+    return min(seconds for seconds, _ in runs), runs[0][1]
+
+
+def heavy_modules(modules):
+    return sorted(set(name.split(".")[0] for name in modules) &
+                  set(HEAVY_MODULES))
+
+
+def js_conversion_modules(grd):
+    """Heavy modules that converting this .grd file to JS may load"""
+    import grd_reader
+    with grd_reader.GrdReader(grd) as reader:
+        reader.parse()
+    if all(reader.is_linear(gradient) for gradient in reader.gradients):
+        return ("chroma",)
+    return ("chroma", "numpy")
+
+
+def benchmark(python, entry_points, grd=None, repeat=DEFAULT_REPEAT,
+              baseline=None, tolerance=DEFAULT_TOLERANCE):
+    """
+    Measure importing each entry point module (and a JS conversion of grd).
+    baseline: Optional {entry point: seconds} to compare against
+    Returns a list of result dicts, with a list of problems in each
+    """
+    baseline = baseline or {}
+    importtime = has_importtime(python)
+
+    # (label, code, module to time, heavy modules it may load)
+    cases = [(module, "import " + module, module, ())
+             for module in entry_points]
+    if grd is not None:
+        cases.append(("js conversion", JS_CONVERSION.format(os.path.abspath(grd)),
+                      None, js_conversion_modules(grd)))
+
+    results = []
+    for label, code, module, allowed in cases:
+        seconds, modules = measure(python, code, module, repeat,
+                                   importtime and module is not None)
+        problems = ["loads {0}".format(name) for name in heavy_modules(modules)
+                    if name not in allowed]
+        limit = baseline.get(label)
+        if limit is not None:
+            limit = max(limit * (1 + tolerance), limit + NOISE)
+            if seconds > limit:
+                problems.append("takes {0:.1f} ms (baseline {1:.1f} ms)".format(
+                    seconds * 1e3, baseline[label] * 1e3))
+        results.append({"entry_point": label,
+                        "seconds": seconds,
+                        "modules": len(modules),
+                        "heavy_modules": heavy_modules(modules),
+                        "problems": problems})
+    return results
+
+
+def report(results, out=None):
+    out = out or sys.stdout
+    out.write("{0:<22} {1:>8} {2:>8}  {3}\n".format(
+        "entry point", "ms", "modules", "heavy modules"))
+    for result in results:
+        out.write("{0:<22} {1:>8.1f} {2:>8}  {3}\n".format(
+            result["entry_point"], result["seconds"] * 1e3, result["modules"],
+            ", ".join(result["heavy_modules"]) or "-"))
+    for result in results:
+        for problem in result["problems"]:
+            out.write("FAILED  {0}: {1}\n".format(result["entry_point"], problem))
+
+
+if __name__ == "__main__":
+    parsed_args = command_line()
+    entry_points = [module for module in ENTRY_POINTS
+                    if not parsed_args.modules or module in parsed_args.modules]
+    baseline = None
+    if parsed_args.baseline is not None:
+        with open(parsed_args.baseline) as f:
+            baseline = dict((result["entry_point"], result["seconds"])
+                            for result in json.load(f))
+
+    results = benchmark(parsed_args.python, entry_points, parsed_args.grd,
+                        parsed_args.repeat, baseline, parsed_args.tolerance)
+    report(results)
+
+    if parsed_args.json is not None:
+        with open(parsed_args.json, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if any(result["problems"] for result in results):
+        sys.exit(1)
@@ -2,87 +2,46 @@
 Read in an adobe gradient file (.grd) and output a JS file describing
 colorstops for an HTML canvas
 """
-# TODO: Quick hack script; clean up to reduce duplication with matplotlib converter
+import json
 
-import argparse, collections, json, keyword, os, re, sys
-
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
-
-import grd_reader
+import grd_convert
 
 
 def command_line():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("filename",
-                        help="Path to an Adobe .grd file")
-
-    return parser.parse_args()
-
-
-#### Functions to process the input file
-def parse_file(filename):
-    """Parse a grd file to extract gradient information"""
-    if os.path.splitext(filename)[1] != ".grd":
-        print("File must be an Adobe PS gradient file with .grd extension")
-        sys.exit(1)
-
-    try:
-        grd = grd_reader.GrdReader(filename)
-    except IOError:
-        print "File not found"
-        sys.exit(1)
-
-    try:
-        grd.parse()
-    except:
-        print("Error occurred while reading file")
-        sys.exit(1)
+    return grd_convert.argument_parser().parse_args()
 
-    return grd
 
+def write_outfile(grd, out_f):
+    """
+    Write colorstop data to an open file, one gradient at a time as each is
+    read from the .grd file. Output matches json.dumps(..., indent=4) of the
+    whole mapping, without building it in memory.
+    """
+    out_f.write("var gradients = {")
 
-def unique_grd_names(grd_names_list):
-    """Adobe GRD format allows gradient names to be non-unique.
+    separator = "\n"
+    for name, gradient in grd_convert.iter_named_gradients(grd):
+        data_str = json.dumps(grd.grd_to_js(gradient), indent=4)
+        out_f.write("{0}    {1}: {2}".format(separator, json.dumps(name),
+                                             data_str.replace("\n", "\n    ")))
+        separator = ", \n"
 
-     Modify gradient names so that each can be referenced uniquely"""
-
-    # First, the gradient names must be valid python variables and len > 0
-    python_names = [re.sub("[^_A-Za-z][^_a-zA-Z0-9]*", "", n)
-                    for n in grd_names_list]
-    python_names = [n if len(n) > 0 and not keyword.iskeyword(n) else "grd"
-                    for n in python_names]
-
-    # Then, the gradient names must be unique
-    counter = collections.Counter(python_names)
-    new_grd_names = [n if counter[n] == 1 else "{}_{}".format(n, i)
-                     for i, n in enumerate(python_names)]
-
-    return new_grd_names
+    out_f.write("\n};" if separator != "\n" else "};")
+    return out_f
 
 
 def generate_outfile(grd, out_fn):
-    """Generate a python file containing colormap data"""
-    out_str = StringIO()
-
-    new_grd_names = unique_grd_names(grd.gradient_names)
-    js_gradients = [grd.grd_to_js(g) for g in grd.gradients]
+    """Generate a JS file containing colorstop data"""
+    grd_convert.stream_outfile(lambda out_f: write_outfile(grd, out_f), out_fn)
 
-    gradient_data = {name: data
-                     for name, data in zip(new_grd_names, js_gradients)}
 
-    data_str = json.dumps(gradient_data, indent=4)
-    out_str.write("var gradients = {0};".format(data_str))
-
-    with open(out_fn, 'w') as out_f:
-        out_f.write(out_str.getvalue())
+def generator_options(color_engine="chroma", max_error=None):
+    """Options that affect the output, as recorded in a build manifest"""
+    return grd_convert.generator_options("js", color_engine, max_error)
 
 if __name__ == "__main__":
     parsed_args = command_line()
-    grd = parse_file(parsed_args.filename)
-
-    out_fn = os.path.splitext(parsed_args.filename)[0] + ".js"
-
-    generate_outfile(grd, out_fn)
+    grd_convert.convert(parsed_args, ".js",
+                        generator_options(parsed_args.engine,
+                                          max_error=parsed_args.max_error),
+                        write_outfile, generate_outfile)
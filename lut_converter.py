@@ -0,0 +1,102 @@
+"""
+Read in an adobe gradient file (.grd) and output precomputed colormap
+lookup tables: each gradient sampled to N evenly spaced uint8 RGB(A)
+entries, packed into a single NumPy .npz file
+"""
+import io, zipfile
+
+import grd_convert
+
+DEFAULT_SIZE = 256
+# Date of every entry in .npz files (the earliest a zip file can hold)
+_ZIP_DATE = (1980, 1, 1, 0, 0, 0)
+
+
+def command_line():
+    parser = grd_convert.argument_parser()
+    parser.add_argument("--size", type=int, default=DEFAULT_SIZE,
+                        help="Number of entries in each lookup table, "
+                             "eg 256, 1024, 4096")
+    parser.add_argument("--alpha", action="store_true",
+                        help="Write RGBA rather than RGB entries")
+
+    return parser.parse_args()
+
+
+def build_luts(grd, size=DEFAULT_SIZE, alpha=False):
+    """
+    Sample every gradient in the file.
+    Returns (names, luts): luts has shape (gradients, size, 3 or 4), so that
+    luts[i][values] applies gradient i to an array of integer indices
+    """
+    names = []
+    luts = []
+    for name, gradient in grd.iter_gradients():
+        names.append(name)
+        luts.append(grd.grd_to_lut(gradient, size, alpha))
+    return names, stack_luts(luts, size, alpha)
+
+
+def stack_luts(luts, size=DEFAULT_SIZE, alpha=False):
+    """Pack a list of lookup tables into one (gradients, size, channels) array"""
+    import numpy as np  # Imported when needed, so --help starts quickly
+
+    channels = 4 if alpha else 3
+    if not luts:
+        return np.empty((0, size, channels), dtype=np.uint8)
+    return np.stack(luts)
+
+
+def write_luts(out_f, names, luts):
+    """
+    Write gradient names and packed lookup tables to an open binary file, in
+    the .npz format of np.savez. Zip entries get a fixed date rather than
+    the current time, so that the same tables always give the same bytes
+    and unchanged outputs are not rewritten by incremental builds.
+    """
+    import numpy as np
+    with zipfile.ZipFile(out_f, "w", zipfile.ZIP_STORED) as zip_f:
+        for key, array in (("names", np.array(names)), ("luts", luts)):
+            npy = io.BytesIO()
+            np.lib.format.write_array(npy, np.asanyarray(array),
+                                      allow_pickle=False)
+            zip_f.writestr(zipfile.ZipInfo(key + ".npy", _ZIP_DATE),
+                           npy.getvalue())
+    return out_f
+
+
+def write_outfile(grd, out_f, size=DEFAULT_SIZE, alpha=False):
+    """Write the lookup tables of every gradient to an open binary file"""
+    names, luts = build_luts(grd, size, alpha)
+    return write_luts(out_f, names, luts)
+
+
+def generate_outfile(grd, out_fn, size=DEFAULT_SIZE, alpha=False):
+    """Generate a .npz file containing colormap lookup tables"""
+    grd_convert.stream_outfile(
+        lambda out_f: write_outfile(grd, out_f, size, alpha), out_fn, 'wb')
+
+
+def load_luts(filename):
+    """Read a file written by generate_outfile. Returns (names, luts)"""
+    import numpy as np
+    data = np.load(filename)
+    return list(data["names"]), data["luts"]
+
+
+def generator_options(color_engine="chroma", size=DEFAULT_SIZE, alpha=False,
+                      max_error=None):
+    """Options that affect the output, as recorded in a build manifest"""
+    return grd_convert.generator_options("lut", color_engine, max_error,
+                                         size=size, alpha=alpha)
+
+if __name__ == "__main__":
+    parsed_args = command_line()
+    grd_convert.convert(
+        parsed_args, ".npz",
+        generator_options(parsed_args.engine, parsed_args.size,
+                          parsed_args.alpha, parsed_args.max_error),
+        lambda grd, out_f: write_outfile(grd, out_f, parsed_args.size,
+                                         parsed_args.alpha),
+        lambda grd, out_fn: generate_outfile(grd, out_fn, parsed_args.size,
+                                             parsed_args.alpha))
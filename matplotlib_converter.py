@@ -4,63 +4,34 @@ set of matplotlib colormaps
 """
 __author__ = 'abought'
 
-import argparse, collections, keyword, os, pprint, re, sys
+import pprint
 
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
-
-import grd_reader
+import grd_convert
 
 
 def command_line():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("filename",
-                        help="Path to an Adobe .grd file")
+    parser = grd_convert.argument_parser()
+    parser.add_argument("--lazy", action="store_true",
+                        help="Generate a module that builds and registers each "
+                             "colormap on first use, rather than at import")
 
     return parser.parse_args()
 
 
-#### Functions to process the input file
-def parse_file(filename):
-    """Parse a grd file to extract gradient information"""
-    if os.path.splitext(filename)[1] != ".grd":
-        print("File must be an Adobe PS gradient file with .grd extension")
-        sys.exit(1)
-
-    try:
-        grd = grd_reader.GrdReader(filename)
-    except IOError:
-        print "File not found"
-        sys.exit(1)
+# Bump whenever the generated code changes, so that outputs are rebuilt
+MODULE_VERSION = 3
 
+# Registers colormaps without importing matplotlib.pyplot, which would load
+#  a plotting backend as a side effect of importing the generated module
+REGISTER_FUNCTION = '''\
+def _register(cmap):
+    import matplotlib
     try:
-        grd.parse()
-    except:
-        print("Error occurred while reading file")
-        sys.exit(1)
-
-    return grd
-
-
-def unique_grd_names(grd_names_list):
-    """Adobe GRD format allows gradient names to be non-unique.
-
-     Modify gradient names so that each can be referenced uniquely"""
-
-    # First, the gradient names must be valid python variables and len > 0
-    python_names = [re.sub("[^_A-Za-z][^_a-zA-Z0-9]*", "", n)
-                    for n in grd_names_list]
-    python_names = [n if len(n) > 0 and not keyword.iskeyword(n) else "grd"
-                    for n in python_names]
-
-    # Then, the gradient names must be unique
-    counter = collections.Counter(python_names)
-    new_grd_names = [n if counter[n] == 1 else "{}_{}".format(n, i)
-                     for i, n in enumerate(python_names)]
-
-    return new_grd_names
+        matplotlib.colormaps.register(cmap)
+    except AttributeError:  # matplotlib < 3.5
+        from matplotlib import cm
+        cm.register_cmap(cmap=cmap)
+'''
 
 
 ### Functions to write the output file
@@ -68,8 +39,8 @@ def write_headers(out_str):
     """
     Write header section that is independent of any specific gradient
     """
-    out_str.write("import matplotlib.pyplot as plt\n"
-                  "from matplotlib.colors import LinearSegmentedColormap\n\n")
+    out_str.write("from matplotlib.colors import LinearSegmentedColormap\n\n\n")
+    out_str.write(REGISTER_FUNCTION + "\n\n")
 
     return out_str   # TODOL refactor to oop
 
@@ -83,7 +54,7 @@ def write_gradient(gradient_name, gradient_data, out_str):
         "{0} = LinearSegmentedColormap('{0}', {0}_data)\n".format(
             gradient_name))
 
-    out_str.write("plt.register_cmap(cmap={0})\n\n".format(gradient_name))
+    out_str.write("_register({0})\n\n".format(gradient_name))
     return out_str
 
 
@@ -94,27 +65,132 @@ def write_gradients_list(gradient_names, out_str):
     return out_str
 
 
-def generate_outfile(grd, out_fn):
-    """Generate a python file containing colormap data"""
-    out_str = StringIO()
+# Lazily-loading module: colormaps are built from the compact _DATA table
+#  on first access, so importing the module costs almost nothing
+LAZY_HEADER = '''\
+import sys
 
-    out_str = write_headers(out_str)
+# name: (locations, red, green, blue[, alpha])
+_DATA = {
+'''
 
-    new_grd_names = unique_grd_names(grd.gradient_names)
-    mpl_gradients = [grd.grd_to_cmap(g) for g in grd.gradients]
+LAZY_FOOTER = '''\
+_CHANNELS = ("red", "green", "blue", "alpha")
+_CMAPS = {}
 
-    for name, data in zip(new_grd_names, mpl_gradients):
-        out_str = write_gradient(name, data, out_str)
 
-    write_gradients_list(new_grd_names, out_str)
+''' + REGISTER_FUNCTION + '''
 
-    with open(out_fn, 'w') as out_f:
-        out_f.write(out_str.getvalue())
+def get_cmap(name):
+    """Build (once) and register the named colormap"""
+    try:
+        return _CMAPS[name]
+    except KeyError:
+        pass
+
+    from matplotlib.colors import LinearSegmentedColormap
+    locations, channels = _DATA[name][0], _DATA[name][1:]
+    cmap_data = dict((channel, [(loc, c, c) for loc, c in zip(locations, values)])
+                     for channel, values in zip(_CHANNELS, channels))
+    cmap = _CMAPS[name] = LinearSegmentedColormap(name, cmap_data)
+    _register(cmap)
+    return cmap
+
+
+def register_all():
+    """Build and register every colormap in this module"""
+    for name in ALL_GRADIENTS:
+        get_cmap(name)
+
+
+def __getattr__(name):
+    if name in _DATA:
+        return get_cmap(name)
+    raise AttributeError(
+        "module {0!r} has no attribute {1!r}".format(__name__, name))
+
+if sys.version_info < (3, 7):
+    # No module-level __getattr__ (PEP 562): wrap this module instead
+    import types
+
+    class _LazyModule(types.ModuleType):
+        def __getattr__(self, name):
+            return __getattr__(name)
+
+    _module = _LazyModule(__name__, __doc__)
+    _module.__dict__.update(sys.modules[__name__].__dict__)
+    _module._original = sys.modules[__name__]  # Keeps our globals alive
+    sys.modules[__name__] = _module
+'''
+
+
+def write_lazy_gradient(gradient_name, gradient_data, out_str):
+    """Write one gradient as a row of the lazy module's _DATA table"""
+    locations = tuple(loc for loc, _, _ in gradient_data["red"])
+    columns = [tuple(c for _, c, _ in gradient_data[channel])
+               for channel in ("red", "green", "blue", "alpha")
+               if channel in gradient_data]
+    out_str.write("    {0!r}: {1!r},\n".format(
+        str(gradient_name), (locations,) + tuple(columns)))
+    return out_str
 
-if __name__ == "__main__":
-    parsed_args = command_line()
-    grd = parse_file(parsed_args.filename)
 
-    out_fn = os.path.splitext(parsed_args.filename)[0] + ".py"
+def write_lazy_outfile(grd, out_f):
+    """
+    Write a lazily-loading colormap module to an open file. Colormaps are
+    built on first access as module attributes (or through get_cmap), and
+    registered with matplotlib as they are built, or all at once with
+    register_all()
+    """
+    out_f.write(LAZY_HEADER)
 
-    generate_outfile(grd, out_fn)
+    new_grd_names = []
+    for name, gradient in grd_convert.iter_named_gradients(grd):
+        write_lazy_gradient(name, grd.grd_to_cmap(gradient), out_f)
+        new_grd_names.append(name)
+    out_f.write("}\n\n")
+
+    write_gradients_list(new_grd_names, out_f)
+    out_f.write(LAZY_FOOTER)
+    return out_f
+
+
+def write_outfile(grd, out_f, lazy=False):
+    """
+    Write colormap data to an open file, one gradient at a time as each is
+    read from the .grd file
+    lazy: Write a module that builds colormaps on first use
+    """
+    if lazy:
+        return write_lazy_outfile(grd, out_f)
+
+    write_headers(out_f)
+
+    new_grd_names = []
+    for name, gradient in grd_convert.iter_named_gradients(grd):
+        write_gradient(name, grd.grd_to_cmap(gradient), out_f)
+        new_grd_names.append(name)
+
+    write_gradients_list(new_grd_names, out_f)
+    return out_f
+
+
+def generate_outfile(grd, out_fn, lazy=False):
+    """Generate a python file containing colormap data"""
+    grd_convert.stream_outfile(lambda out_f: write_outfile(grd, out_f, lazy),
+                               out_fn)
+
+
+def generator_options(color_engine="chroma", lazy=False, max_error=None):
+    """Options that affect the output, as recorded in a build manifest"""
+    return grd_convert.generator_options("matplotlib", color_engine, max_error,
+                                         lazy=lazy, module_version=MODULE_VERSION)
+
+if __name__ == "__main__":
+    parsed_args = command_line()
+    grd_convert.convert(
+        parsed_args, ".py",
+        generator_options(parsed_args.engine, parsed_args.lazy,
+                          max_error=parsed_args.max_error),
+        lambda grd, out_f: write_outfile(grd, out_f, parsed_args.lazy),
+        lambda grd, out_fn: generate_outfile(grd, out_fn, parsed_args.lazy))
@@ -0,0 +1,132 @@
+"""
+Load generator for grd_service.py: sends conversion requests from a number
+of concurrent clients, then reports throughput and latency percentiles.
+"""
+import argparse, httplib, itertools, json, sys, threading, time, urllib, urlparse
+
+import grd_service
+
+
+def command_line():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filenames", nargs="+",
+                        help="Adobe .grd files to send, in rotation")
+    parser.add_argument("--url", default="http://127.0.0.1:{0}/".format(
+                            grd_service.DEFAULT_PORT),
+                        help="Address of the service")
+    parser.add_argument("--requests", type=int, default=200,
+                        help="Total number of requests")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="Number of clients sending requests at once")
+    parser.add_argument("--format", choices=grd_service.FORMATS, default="js")
+    parser.add_argument("--engine", default=None,
+                        help="Color engine (default: the service's)")
+    parser.add_argument("--by-path", action="store_true",
+                        help="Have the service read files from disk, rather "
+                             "than uploading them")
+    parser.add_argument("--out", default=None,
+                        help="Save results to this JSON file")
+
+    return parser.parse_args()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_load(url, payloads, n_requests, concurrency, params, by_path=False):
+    """
+    Send n_requests, cycling through payloads ((filename, data) pairs), from
+    `concurrency` threads each with its own keep-alive connection.
+    Returns (elapsed seconds, latencies of successful requests, failures)
+    """
+    address = urlparse.urlparse(url)
+    jobs = itertools.islice(itertools.cycle(payloads), n_requests)
+    jobs_lock = threading.Lock()
+    latencies = []
+    failures = []
+
+    def client():
+        connection = httplib.HTTPConnection(address.hostname, address.port)
+        while True:
+            with jobs_lock:
+                job = next(jobs, None)
+            if job is None:
+                break
+            filename, data = job
+            query = dict(params)
+            started = time.time()
+            try:
+                if by_path:
+                    query["path"] = filename
+                    connection.request("GET", "/convert?" + urllib.urlencode(query))
+                else:
+                    connection.request("POST", "/convert?" + urllib.urlencode(query), data)
+                response = connection.getresponse()
+                response.read()
+            except (httplib.HTTPException, IOError) as e:
+                failures.append("{0}: {1}".format(filename, e))
+                connection.close()
+                connection = httplib.HTTPConnection(address.hostname, address.port)
+                continue
+            if response.status == 200:
+                latencies.append(time.time() - started)
+            else:
+                failures.append("{0}: HTTP {1}".format(filename, response.status))
+        connection.close()
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - started, sorted(latencies), failures
+
+
+def summarize(elapsed, latencies, failures):
+    elapsed = max(elapsed, 1e-9)
+    return {"requests": len(latencies) + len(failures),
+            "failed": len(failures),
+            "seconds": elapsed,
+            "requests_per_s": len(latencies) / elapsed,
+            "latency_p50": percentile(latencies, 0.5),
+            "latency_p90": percentile(latencies, 0.9),
+            "latency_p99": percentile(latencies, 0.99),
+            "latency_max": latencies[-1] if latencies else 0.}
+
+
+if __name__ == "__main__":
+    parsed_args = command_line()
+    payloads = []
+    for filename in parsed_args.filenames:
+        with open(filename, 'rb') as f:
+            payloads.append((filename, "" if parsed_args.by_path else f.read()))
+
+    params = {"format": parsed_args.format}
+    if parsed_args.engine is not None:
+        params["engine"] = parsed_args.engine
+
+    elapsed, latencies, failures = run_load(
+        parsed_args.url, payloads, parsed_args.requests,
+        parsed_args.concurrency, params, parsed_args.by_path)
+    for failure in failures[:10]:
+        print("FAILED  {0}".format(failure))
+
+    summary = summarize(elapsed, latencies, failures)
+    print("{0} requests, {1} failed in {2:.2f} s ({3:.1f} requests/s)".format(
+        summary["requests"], summary["failed"], summary["seconds"],
+        summary["requests_per_s"]))
+    print("latency p50 {0:.1f} ms, p90 {1:.1f} ms, p99 {2:.1f} ms, max {3:.1f} ms".format(
+        *[summary[k] * 1e3 for k in ("latency_p50", "latency_p90",
+                                     "latency_p99", "latency_max")]))
+
+    if parsed_args.out is not None:
+        with open(parsed_args.out, "w") as f:
+            json.dump(summary, f, indent=1, sort_keys=True)
+
+    if failures:
+        sys.exit(1)
@@ -0,0 +1,159 @@
+"""
+Write synthetic Adobe .grd files, for use as benchmark and test fixtures
+"""
+import argparse, random, struct
+
+PALETTES = ("RGBC", "HSBC", "CMYC")
+
+
+def _key(name):
+    """4-character keys are written with a zero length, as Photoshop does"""
+    if not isinstance(name, bytes):
+        name = name.encode("ascii")
+    if len(name) == 4:
+        return struct.pack(">L", 0) + name
+    return struct.pack(">L", len(name)) + name
+
+
+def _unicode(text):
+    """Null-terminated UTF-16BE string with a length prefix (in characters)"""
+    data = (text + u"\x00").encode("utf-16-be")
+    return struct.pack(">L", len(data) // 2) + data
+
+
+def _objc(name, display_name, class_id, fields):
+    out = [_key(name), b"Objc", _unicode(display_name), _key(class_id),
+           struct.pack(">L", len(fields))]
+    out.extend(fields)
+    return b"".join(out)
+
+
+def _vlls_objc(display_name, class_id, fields):
+    """An Objc item inside a VlLs list (no key; caller writes the type tag)"""
+    out = [b"Objc", _unicode(display_name), _key(class_id),
+           struct.pack(">L", len(fields))]
+    out.extend(fields)
+    return b"".join(out)
+
+
+def _vlls(name, items):
+    return b"".join([_key(name), b"VlLs", struct.pack(">L", len(items))] +
+                    list(items))
+
+
+def _doub(name, value):
+    return _key(name) + b"doub" + struct.pack(">d", value)
+
+
+def _untf(name, unit, value):
+    return _key(name) + b"UntF" + unit + struct.pack(">d", value)
+
+
+def _long(name, value):
+    return _key(name) + b"long" + struct.pack(">L", value)
+
+
+def _enum(name, type_id, value):
+    return _key(name) + b"enum" + _key(type_id) + _key(value)
+
+
+def _text(name, value):
+    return _key(name) + b"TEXT" + _unicode(value)
+
+
+def _bool(name, value):
+    return _key(name) + b"bool" + struct.pack(">B", int(bool(value)))
+
+
+def _color(rng, palette):
+    if palette == "RGBC":
+        fields = [_doub("Rd  ", rng.uniform(0, 255)),
+                  _doub("Grn ", rng.uniform(0, 255)),
+                  _doub("Bl  ", rng.uniform(0, 255))]
+    elif palette == "HSBC":
+        fields = [_untf("H   ", b"#Ang", rng.uniform(0, 360)),
+                  _doub("Strt", rng.uniform(0, 100)),
+                  _doub("Brgh", rng.uniform(0, 100))]
+    else:
+        fields = [_doub("Cyn ", rng.uniform(0, 100)),
+                  _doub("Mgnt", rng.uniform(0, 100)),
+                  _doub("Ylw ", rng.uniform(0, 100)),
+                  _doub("Blck", rng.uniform(0, 100))]
+    return _objc("Clr ", u"", palette, fields)
+
+
+def _nested(rng, depth):
+    """Unused descriptor payload, nested `depth` levels deep"""
+    if depth <= 0:
+        return _bool("Vsbl", rng.random() < 0.5)
+    item = _vlls_objc(u"", "Nstd", [_nested(rng, depth - 1),
+                                     _long("Dpth", depth)])
+    return _vlls("Nstd", [item])
+
+
+def gradient(rng, name, n_stops, palettes=PALETTES, depth=0,
+             n_opacity_stops=2):
+    """Serialize one Grad object with `n_stops` color stops"""
+    locations = sorted(rng.randint(0, 4096) for _ in range(n_stops))
+    locations[0], locations[-1] = 0, 4096
+    stops = []
+    for loc in locations:
+        palette = rng.choice(palettes)
+        stops.append(_vlls_objc(u"", "Clrt", [
+            _color(rng, palette),
+            _enum("Type", "Clry", "UsrS"),
+            _long("Lctn", loc),
+            _long("Mdpn", rng.choice((50, 50, rng.randint(5, 95))))]))
+
+    opacity = []
+    for i in range(n_opacity_stops):
+        loc = 4096 * i // max(n_opacity_stops - 1, 1)
+        opacity.append(_vlls_objc(u"", "TrnS", [
+            _untf("Opct", b"#Prc", rng.choice((100., rng.uniform(0, 100)))),
+            _long("Lctn", loc),
+            _long("Mdpn", 50)]))
+
+    fields = [_text("Nm  ", name),
+              _enum("GrdF", "GrdF", "CstS"),
+              _doub("Intr", 4096.),
+              _vlls("Clrs", stops),
+              _vlls("Trns", opacity)]
+    if depth:
+        fields.append(_nested(rng, depth))
+    grad = _objc("Grad", u"Gradient", "Grdn", fields)
+    return _vlls_objc(u"", "Grdn", [grad])
+
+
+def write_grd(out_f, n_gradients=10, n_stops=8, palettes=PALETTES, depth=0,
+              seed=0, names=None):
+    """Write a complete .grd file to the open binary file `out_f`"""
+    rng = random.Random(seed)
+    header = (b"8BGR" + struct.pack(">H", 5) + struct.pack(">L", 16) +
+              _unicode(u"") + _key("null") + struct.pack(">L", 1))
+    items = []
+    for i in range(n_gradients):
+        name = names[i] if names else u"Gradient {0}".format(i)
+        items.append(gradient(rng, name, n_stops, palettes, depth))
+    out_f.write(header)
+    out_f.write(_vlls("GrdL", items))
+
+
+def command_line():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("out_fn", help="Path of the .grd file to write")
+    parser.add_argument("--gradients", type=int, default=10)
+    parser.add_argument("--stops", type=int, default=8)
+    parser.add_argument("--depth", type=int, default=0,
+                        help="Nesting depth of extra VlLs/Objc payload")
+    parser.add_argument("--palettes", default=",".join(PALETTES),
+                        help="Comma-separated palette types to draw from")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    parsed_args = command_line()
+    with open(parsed_args.out_fn, "wb") as out_f:
+        write_grd(out_f, parsed_args.gradients, parsed_args.stops,
+                  parsed_args.palettes.split(","), parsed_args.depth,
+                  parsed_args.seed)
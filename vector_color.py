@@ -0,0 +1,167 @@
+"""
+Vectorized conversion of Adobe .grd color stops to RGB, using NumPy.
+
+All stops of one palette type are converted in a single pass. Results follow
+the same formulas as the chroma library (including its clamping of inputs
+to 0..1), and agree with GrdReader's chroma engine to within 1e-12 before
+rounding; after rounding to 3 digits they agree to within 0.001.
+"""
+
+import numpy as np
+
+from gradient_store import CHANNELS
+
+# Channel keys for each palette, and the scale that maps PS values to 0..1
+PALETTE_CHANNELS = {"RGBC": (("Rd", "Grn", "Bl"), 255.),
+                    "HSBC": (("H", "Strt", "Brgh"), (360., 100., 100.)),
+                    "CMYC": (("Cyn", "Mgnt", "Ylw", "Blck"), 100.)}
+
+
+def rgb_to_rgb(r, g, b):
+    return np.clip(np.column_stack((r, g, b)), 0., 1.)
+
+
+def hsv_to_rgb(h, s, v):
+    """Vectorized colorsys.hsv_to_rgb, for h, s, v arrays in range 0..1"""
+    h, s, v = [np.clip(c, 0., 1.) for c in (h, s, v)]
+    i = np.floor(h * 6.)
+    f = h * 6. - i
+    p = v * (1. - s)
+    q = v * (1. - s * f)
+    t = v * (1. - s * (1. - f))
+    i = i.astype(int) % 6
+
+    r = np.choose(i, (v, q, p, p, t, v))
+    g = np.choose(i, (t, v, v, q, p, p))
+    b = np.choose(i, (p, p, t, v, v, q))
+
+    # colorsys returns pure grey when there is no saturation
+    grey = s == 0.
+    return np.column_stack((np.where(grey, v, r),
+                            np.where(grey, v, g),
+                            np.where(grey, v, b)))
+
+
+def cmyk_to_rgb(c, m, y, k):
+    """CMYK (range 0..1) to RGB, via CMY as chroma does"""
+    c, m, y, k = [np.clip(x, 0., 1.) for x in (c, m, y, k)]
+    cmy = np.column_stack((c, m, y)) * (1. - k)[:, np.newaxis] + k[:, np.newaxis]
+    return 1. - np.clip(cmy, 0., 1.)
+
+
+CONVERTERS = {"RGBC": rgb_to_rgb, "HSBC": hsv_to_rgb, "CMYC": cmyk_to_rgb}
+
+# Linear sRGB to CIE XYZ, and the reference white (both D65)
+_RGB_TO_XYZ = np.array([[0.4124564, 0.3575761, 0.1804375],
+                        [0.2126729, 0.7151522, 0.0721750],
+                        [0.0193339, 0.1191920, 0.9503041]])
+_WHITE = np.array([0.95047, 1., 1.08883])
+
+
+def rgb_to_lab(rgb):
+    """sRGB values (range 0..1) in an (..., 3) array to CIE L*a*b* (D65)"""
+    rgb = np.clip(np.asarray(rgb, dtype=float), 0., 1.)
+    linear = np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+    xyz = linear.dot(_RGB_TO_XYZ.T) / _WHITE
+    delta = 6. / 29.
+    f = np.where(xyz > delta ** 3, np.cbrt(xyz), xyz / (3. * delta ** 2) + 4. / 29.)
+    lab = np.empty(f.shape)
+    lab[..., 0] = 116. * f[..., 1] - 16.
+    lab[..., 1] = 500. * (f[..., 0] - f[..., 1])
+    lab[..., 2] = 200. * (f[..., 1] - f[..., 2])
+    return lab
+
+
+def convert_palette(palette, values):
+    """
+    Convert an (n, channels) array of raw PS values for one palette type
+    to an (n, 3) array of RGB values in range 0..1
+    """
+    try:
+        keys, scale = PALETTE_CHANNELS[palette]
+    except KeyError:
+        raise NotImplementedError("Unknown color type: " + palette)
+    values = np.asarray(values, dtype=float) / scale
+    return CONVERTERS[palette](*values.T)
+
+
+def convert_stops(gradient):
+    """
+    Convert the color stops of one gradient (a gradient_store.GradientView)
+    to an (n, 3) array of RGB values, one vectorized pass per palette type
+    """
+    store, start, stop = gradient.store, gradient.start, gradient.stop
+    codes = np.frombuffer(store.palettes[start:stop], dtype=np.uint8)
+    values = np.frombuffer(
+        store.channels[start * CHANNELS:stop * CHANNELS],
+        dtype=float).reshape(-1, CHANNELS)
+
+    rgb = np.empty((len(codes), 3))
+    for code in np.unique(codes):
+        palette = store.palette_names[code]
+        n_channels = len(PALETTE_CHANNELS.get(palette, ((),))[0])
+        selected = codes == code
+        rgb[selected] = convert_palette(palette, values[selected, :n_channels])
+    return rgb
+
+
+def sample_lut(locations, colors, size=256, alpha=False):
+    """
+    Sample a piecewise linear gradient at `size` evenly spaced points in
+    0..1, returning a (size, 3) uint8 lookup table, or (size, 4) with alpha.
+    locations: stop positions in 0..1; colors: matching 0..1 channel values
+    """
+    locations = np.asarray(locations, dtype=float)
+    colors = np.asarray(colors, dtype=float).reshape(len(locations), -1)
+
+    # np.interp needs increasing positions; keep file order for ties
+    order = np.argsort(locations, kind="mergesort")
+    locations, colors = locations[order], colors[order]
+
+    samples = np.linspace(0., 1., size)
+    channels = 4 if alpha else 3
+    lut = np.empty((size, channels), dtype=np.uint8)
+    for c in range(min(colors.shape[1], channels)):
+        lut[:, c] = np.rint(np.clip(np.interp(samples, locations, colors[:, c]),
+                                    0., 1.) * 255)
+    if alpha and colors.shape[1] < 4:
+        lut[:, 3] = 255
+    return lut
+
+
+def simplify_stops(locations, colors, max_error):
+    """
+    Choose the stops to keep so that linear interpolation between them
+    reproduces every dropped stop to within max_error in each channel (an
+    L-infinity bound, in the 0..1 units of `colors`). End points and stops
+    that share a location (hard edges) are always kept.
+    Returns the indices of the kept stops, in order.
+    """
+    locations = np.asarray(locations, dtype=float)
+    colors = np.asarray(colors, dtype=float).reshape(len(locations), -1)
+    n_stops = len(locations)
+    if n_stops <= 2 or np.any(np.diff(locations) < 0):
+        # Nothing to drop, or stops out of order: interpolation is undefined
+        return np.arange(n_stops)
+
+    keep = np.zeros(n_stops, dtype=bool)
+    keep[[0, -1]] = True
+    hard_edge = locations[1:] == locations[:-1]
+    keep[1:][hard_edge] = True
+    keep[:-1][hard_edge] = True
+
+    # Split segments at their worst stop until every dropped stop is close
+    #  enough (Douglas-Peucker); the error of a whole segment is one array op
+    anchors = np.flatnonzero(keep)
+    segments = [(a, b) for a, b in zip(anchors[:-1], anchors[1:]) if b - a > 1]
+    while segments:
+        a, b = segments.pop()
+        t = (locations[a + 1:b] - locations[a]) / (locations[b] - locations[a])
+        predicted = colors[a] + t[:, np.newaxis] * (colors[b] - colors[a])
+        error = np.abs(predicted - colors[a + 1:b]).max(axis=1)
+        worst = error.argmax()
+        if error[worst] > max_error:
+            split = a + 1 + worst
+            keep[split] = True
+            segments.extend(s for s in ((a, split), (split, b)) if s[1] - s[0] > 1)
+    return np.flatnonzero(keep)